@@ -0,0 +1,299 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+from load_original_data import old_app_columns, new_app_columns
+from pipeline import current_rss
+
+'''
+The BP exports are proprietary, so this generates synthetic ones with the same
+columns, then times each stage of the pipeline on them.  The synthetic old
+export has every column of old_safety_app_cols but only fills the handful the
+pipeline reads (plus a scattering of the checklist columns), like the real one.
+Descriptions are drawn from a different word list for each immediateActionsTaken
+label, so the SVD has some structure to find.
+
+    python benchmark.py --rows 10000 100000 --output results.json
+
+Each stage records wall time, cpu time, peak traced memory, the resident
+memory after it and how much that grew during it, and the number of rows.  The
+process's peak rss is recorded too, but it only ever goes up, so it says which
+stage first reached a new high, not how much any one stage needed.  The results
+are written as json along with the git commit, so runs from different commits
+can be compared.
+'''
+
+actions = {'No Action Necessary': 0.55,
+           'Action Completed Onsite': 0.35,
+           'Further Action Necessary': 0.08,
+           'Stop the Job': 0.02}
+
+event_types = {'Verification': 0.50,
+               'Hazard Identification': 0.35,
+               'Near Miss': 0.06,
+               'Property Damage': 0.03,
+               'Material Release': 0.03,
+               'Security': 0.01,
+               'Injury/Illness': 0.01,
+               'Fire/Explosion': 0.01}
+
+words = {
+    'common': 'the a and to of on was were at for with site crew job work we all'.split(),
+    'No Action Necessary': ('discussed everyone understood all good checklist jsa reviewed '
+                            'form conversation meeting talked plan ppe').split(),
+    'Action Completed Onsite': ('fixed replaced cleaned tightened plug valve leak wellhead '
+                                'tank line repaired removed installed').split(),
+    'Further Action Necessary': ('road grass mowing fence gate culvert repair needed '
+                                 'ordered contractor lease erosion').split(),
+    'Stop the Job': ('stopped unsafe hazard spotted pressure h2s lifting dropped '
+                     'intervened exclusion zone permit').split()
+}
+
+operating_centers = ['Wamsutter', 'East Texas', 'Farmington', 'Anadarko', 'Durango', 'Arkoma']
+job_groups = ['Operations', 'Maintenance', 'Wells Intervention', 'Construction', 'Drilling',
+              'Completions', 'Automation', 'Rig Move', 'Produced Fluid Management']
+
+
+def choice(random, options, size):
+    return random.choice(list(options), size=size, p=list(options.values()))
+
+def descriptions(random, labels):
+    '''
+    A short free-text description for each label, mostly from that label's words.
+    '''
+    lengths = random.randint(3, 30, size=len(labels))
+    texts = []
+    for label, length in zip(labels, lengths):
+        topical = random.choice(words[label], size=length)
+        common = random.choice(words['common'], size=length)
+        mix = np.where(random.rand(length) < 0.6, topical, common)
+        texts.append('[{}]'.format(' '.join(mix)))
+    return texts
+
+def event_type_lists(random, size):
+    first = choice(random, event_types, size)
+    second = choice(random, event_types, size)
+    both = random.rand(size) < 0.1
+    return ["['{}', '{}']".format(a, b) if two and a != b else "['{}']".format(a)
+            for a, b, two in zip(first, second, both)]
+
+def dates(random, size, start='2015-01-01', days=900):
+    created = pd.Timestamp(start) + pd.to_timedelta(random.randint(0, days * 86400, size), 's')
+    modified = created + pd.to_timedelta(random.exponential(3 * 86400, size).astype(int), 's')
+    processed = created + pd.to_timedelta(random.exponential(86400, size).astype(int), 's')
+    return created, modified, processed
+
+def replicate_groups(random, size, n_groups=200):
+    return np.array(['RG{:04d}'.format(i) for i in random.randint(0, n_groups, size)])
+
+def asset_ids(random, size):
+    kinds = random.choice(['well', 'facility', 'pad', 'other'], size=size, p=[.6, .25, .1, .05])
+    lengths = np.where(kinds == 'well', 16, 10)
+    ids = [''.join(random.choice(list('0123456789ABCDEF'), size=n)) for n in lengths]
+    ids = np.array(ids, dtype=object)
+    ids[kinds == 'pad'] = ['PAD-' + i for i in ids[kinds == 'pad']]
+    ids[kinds == 'other'] = 'Other'
+    return ids
+
+def common_columns(random, size, first_seq):
+    created, modified, processed = dates(random, size)
+    users = np.array(['user{}'.format(i) for i in random.randint(0, 500, size)])
+    transferred = random.rand(size) < 0.2
+    labels = choice(random, actions, size)
+    return {'_id': ['{:032x}'.format(i) for i in random.randint(0, 2**62, size)],
+            '_rev': ['{}-{:08x}'.format(r, h) for r, h in
+                     zip(random.randint(1, 4, size), random.randint(0, 2**31, size))],
+            'createdBy': users,
+            'modifiedBy': np.where(transferred, 'reviewer', users),
+            'createdDate': created.strftime('%Y-%m-%dT%H:%M:%S'),
+            'modifiedDate': modified.strftime('%Y-%m-%dT%H:%M:%S'),
+            'serverCreatedDate': created.strftime('%Y-%m-%dT%H:%M:%S'),
+            'serverModifiedDate': modified.strftime('%Y-%m-%dT%H:%M:%S'),
+            'adapterProcessedDate': processed.strftime('%Y-%m-%dT%H:%M:%S'),
+            'businessUnit': 'Lower 48',
+            'operatingCenter': random.choice(operating_centers, size=size),
+            'area': ['Area {}'.format(i) for i in random.randint(0, 30, size)],
+            'companyInvolved': np.where(random.rand(size) < 0.5, 'BP', 'Contractor'),
+            'replicateGroup': replicate_groups(random, size),
+            'immediateActionsTaken': labels,
+            'seq': np.arange(first_seq, first_seq + size)}, labels
+
+def generate_old_reports(size, random, first_seq=0):
+    columns, labels = common_columns(random, size, first_seq)
+    ids = asset_ids(random, size)
+    in_well_site = random.rand(size) < 0.7
+    texts = np.array(descriptions(random, labels), dtype=object)
+    columns.update({
+        'locationWellSite': np.where(in_well_site, ids, None),
+        'assetId': np.where(~in_well_site & (random.rand(size) < 0.8), ids, None),
+        'locationWellSiteName': ['Site {}'.format(i) for i in random.randint(0, 5000, size)],
+        'userFunction': random.choice(['Operations', 'Development'], size=size),
+        'jobGroup': random.choice(job_groups, size=size),
+        'eventTitle': [s.strip("[]'").split("', '")[0] for s in event_type_lists(random, size)],
+        'actualConsequences': np.where(random.rand(size) < 0.8, '[]', "['Injury']"),
+        'eventDescription': texts,
+        'actionCompletedOnsiteDetail': np.where(labels == 'Action Completed Onsite', texts, None),
+    })
+    reports = pd.DataFrame(columns)
+    # the checklist columns are mostly empty, but not all of them all the time
+    checklist = [col for col in old_app_columns if col not in reports.columns]
+    for col in random.choice(checklist, size=40, replace=False):
+        reports[col] = np.where(random.rand(size) < 0.02, 'Yes', None)
+    return reports.reindex(columns=old_app_columns)
+
+def generate_new_reports(size, random, first_seq=0):
+    columns, labels = common_columns(random, size, first_seq)
+    groups = columns['replicateGroup']
+    group_numbers = np.array([int(g[2:]) for g in groups])
+    columns.update({
+        'latitude': 31 + (group_numbers % 20) * 0.5 + random.normal(0, 0.05, size),
+        'longitude': -110 + (group_numbers // 20) * 0.8 + random.normal(0, 0.05, size),
+        'assetId': asset_ids(random, size),
+        'assetType': random.choice(['Well', 'Facility', 'Other'], size=size, p=[.6, .35, .05]),
+        'name': ['Site {}'.format(i) for i in random.randint(0, 5000, size)],
+        'incidentDescription': descriptions(random, labels),
+        'operationOrDevelopment': random.choice(['Operations', 'Development'], size=size),
+        'eventClassification': random.choice(['Verification', 'Observation'], size=size),
+        'jobTypeObserved': random.choice(job_groups, size=size),
+        'event': np.where(random.rand(size) < 0.8, 'Observation', 'Incident'),
+        'eventType': event_type_lists(random, size),
+    })
+    reports = pd.DataFrame(columns)
+    # the export has businessUnit twice, so build it column by column
+    return pd.DataFrame({i: reports[col] if col in reports.columns else None
+                         for i, col in enumerate(new_app_columns)})
+
+def write_export(path, generate, rows, seed, first_seq, chunksize=20000):
+    random = np.random.RandomState(seed)
+    for start in range(0, rows, chunksize):
+        size = min(chunksize, rows - start)
+        chunk = generate(size, random, first_seq + start)
+        chunk.to_csv(path, header=False, index=False, mode='w' if start == 0 else 'a')
+
+def generate_exports(directory, rows, old_fraction=0.6, seed=0):
+    old_rows = int(rows * old_fraction)
+    data = os.path.join(directory, 'data')
+    for sub in ['data', 'my_data']:
+        os.makedirs(os.path.join(directory, sub), exist_ok=True)
+    write_export(os.path.join(data, 'BPDataSafetyPlusOldApp.csv'), generate_old_reports,
+                 old_rows, seed, 0)
+    write_export(os.path.join(data, 'BPDataSafetyPlusNewApp.csv'), generate_new_reports,
+                 rows - old_rows, seed + 1, old_rows)
+
+
+trace_memory = False
+
+def measure(results, stage, rows, function, *args, **kwargs):
+    '''
+    Run function and record how long it took and how much memory it used.
+    Tracing allocations slows everything down, so peak memory is only measured
+    when trace_memory is set.
+    '''
+    if trace_memory:
+        tracemalloc.start()
+    rss = current_rss()
+    wall, cpu = time.perf_counter(), time.process_time()
+    value = function(*args, **kwargs)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    rss_before, rss = rss, current_rss()
+    peak = None
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    results.append({'stage': stage,
+                    'rows': rows,
+                    'wall_seconds': wall,
+                    'cpu_seconds': cpu,
+                    'peak_traced_bytes': peak,
+                    'rss_kb': rss // 1024,
+                    'rss_growth_kb': (rss - rss_before) // 1024,
+                    # cumulative over the whole run, not this stage's own peak
+                    'process_peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+    print('{:>10} rows  {:<40} {:8.2f}s'.format(rows, stage, wall))
+    return value
+
+def run_stages(rows, n_jobs=1):
+    import load_original_data
+    import combine_data
+    import make_data_numerical
+    import scorer
+    import combined_store
+    results = []
+    old_reports = measure(results, 'load_original_data.load_old_reports', rows,
+                          load_original_data.load_old_reports,
+                          usecols=combine_data.required_old_columns())
+    new_reports = measure(results, 'load_original_data.load_new_reports', rows,
+                          load_original_data.load_new_reports)
+    measure(results, 'load_original_data.load_old_reports (cached)', rows,
+            load_original_data.load_old_reports, usecols=combine_data.required_old_columns())
+    combined = measure(results, 'combine_data.concatenate_data', rows,
+                       combine_data.concatenate_data, old_reports, new_reports)
+    measure(results, 'combined_store.write_partitions', rows,
+            combined_store.write_partitions, combined)
+    reports = measure(results, 'combined_store.read_combined', rows, combined_store.read_combined)
+    measure(results, 'combined_store.read_combined (3 columns)', rows,
+            combined_store.read_combined,
+            columns=['seq', 'immediateActionsTaken', 'incidentDescription'])
+    measure(results, 'scorer.get_pipeline (fit)', rows, scorer.get_pipeline)
+    make_data_numerical.save_feature_schema(make_data_numerical.build_feature_schema(reports))
+    measure(results, 'make_data_numerical.concat', rows, make_data_numerical.concat,
+            reports.set_index('seq'), n_jobs=n_jobs)
+    sorter = measure(results, 'scorer.ReportSorter()', rows, scorer.ReportSorter)
+    labeled = reports.dropna(subset=['immediateActionsTaken', 'incidentDescription'])
+    measure(results, 'scorer.ReportSorter.sort_reports', len(labeled), sorter.sort_reports, labeled)
+    measure(results, 'scorer.ReportSorter.sort_reports (cached)', len(labeled),
+            sorter.sort_reports, labeled)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the pipeline on synthetic exports.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000],
+                        help='total reports (old and new) to generate for each run')
+    parser.add_argument('--old-fraction', type=float, default=0.6)
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--keep', action='store_true', help="don't delete the generated data")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='measure the peak memory of each stage with tracemalloc')
+    args = parser.parse_args()
+    trace_memory = args.trace_memory
+    output = os.path.abspath(args.output)
+    here = os.getcwd()
+    runs = []
+    for rows in args.rows:
+        directory = tempfile.mkdtemp(prefix='stay_safe_benchmark_')
+        try:
+            generate_exports(directory, rows, args.old_fraction, args.seed)
+            os.chdir(directory)
+            runs.append({'rows': rows, 'stages': run_stages(rows, args.n_jobs)})
+        finally:
+            os.chdir(here)
+            if args.keep:
+                print('data kept in {}'.format(directory))
+            else:
+                shutil.rmtree(directory)
+    with open(output, 'w') as f:
+        json.dump({'commit': git_commit(),
+                   'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python': sys.version.split()[0],
+                   'pandas': pd.__version__,
+                   'trace_memory': trace_memory,
+                   'runs': runs}, f, indent=4)
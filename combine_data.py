@@ -1,6 +1,20 @@
+import os
+import json
+import shutil
+import argparse
 import pandas as pd
 import numpy as np
-from load_original_data import old_reports, new_reports
+from instrumentation import stage
+from event_types import with_event_mask
+from combined_store import combined_dir, write_partitions, replace_store, remove_ids,\
+                           store_signature, read_combined
+from report_store import report_store_file, ReportStore
+from rollups import rollup_file, load_rollups, update_rollups
+from similar_reports import index_signature, update_similarity_index
+from load_original_data import load_old_reports, load_new_reports, iter_old_reports,\
+                               iter_new_reports, old_column_types, new_column_types,\
+                               old_app_columns, new_app_columns, old_app_file, cache_key,\
+                               default_chunksize
 
 
 '''
@@ -12,7 +26,9 @@ from the old data.
 '''
 
 # keep if the column already exists in both datasets
-shared = list(set(old_reports.columns) & set(new_reports.columns))
+def shared_columns(old_reports, new_reports):
+    return [col for col in new_reports.columns if col in set(old_reports.columns)]
+
 # the following column names don't exist in the old dataset but can be derived
 derived = ['assetType',
            'incidentDescription',
@@ -25,94 +41,370 @@ derived = ['assetType',
            'longitude',
            'name']
 
+# the old columns that prepare_old_data reads in order to derive the columns above
+old_source_columns = ['locationWellSite',
+                      'assetId',
+                      'locationWellSiteName',
+                      'userFunction',
+                      'replicateGroup',
+                      'eventTitle',
+                      'jobGroup',
+                      'actualConsequences']
+
 # The new data has an assetType column that I love, but which doesn't exist in
 # the old data.  However, the old data has an id (spread across two columns)
 # which is indicative of assetType
-def get_id(row):
-    if not pd.isnull(row.locationWellSite):
-        return row.locationWellSite
-    if not pd.isnull(row.assetId):
-        return row.assetId
-    return np.nan
-
-def well_or_fac(id_string):
-    if id_string == 'Other':
-        return "Other"
-    if 'PAD' in str(id_string):
-        return "Well"  #Confirm with Ben because he knows what PADs are
-    if 'CDP' in str(id_string):
-        return "Well"
-    if 'FAC' in str(id_string):
-        return "Facility"
-    len_dict = {16: "Well",
-                38: "Well",
-                10: "Facility",
-                17: "Facility",
-                18: "Facility",
-                19: "Other"}
-    if pd.isnull(id_string):
-        return np.nan
-    if len(id_string) in len_dict:
-        return len_dict[len(id_string)]
-    return "Well"
-
-def old_assetType():
-    return old_reports.apply(lambda row: well_or_fac(get_id(row)), axis=1)
+def get_id(old_reports):
+    return old_reports.locationWellSite.combine_first(old_reports.assetId)
+
+asset_types = ['Well', 'Facility', 'Other']
+
+def well_or_fac(ids):
+    '''
+    Classify each id by the rules below, checked in order.  Anything that
+    matches no rule is a Well; a missing id stays missing.
+    '''
+    id_strings = ids.astype(str)
+    id_lengths = id_strings.str.len()
+    rules = [(ids.isnull(), ''),
+             (id_strings == 'Other', 'Other'),
+             (id_strings.str.contains('PAD', regex=False), 'Well'), #Confirm with Ben because he knows what PADs are
+             (id_strings.str.contains('CDP', regex=False), 'Well'),
+             (id_strings.str.contains('FAC', regex=False), 'Facility'),
+             (id_lengths.isin([16, 38]), 'Well'),
+             (id_lengths.isin([10, 17, 18]), 'Facility'),
+             (id_lengths == 19, 'Other')]
+    labels = np.select([rule for rule, _ in rules], [label for _, label in rules], 'Well')
+    labels = np.where(labels == '', None, labels)
+    return pd.Series(pd.Categorical(labels, categories=asset_types), index=ids.index)
+
+def old_assetType(old_reports):
+    return well_or_fac(get_id(old_reports))
 
 
 # The old data doesn't have longitude or latitude, but that's pretty much determined
 # by replicateGroup.
 
-def get_lon(string):
-    try:
-        return new_reports.groupby('replicateGroup')['longitude'].mean()[string]
-    except:
-        return np.nan
+centroids_file = 'my_data/replicate_group_centroids.csv'
+# how far (in degrees) a centroid can move before the old reports' locations
+# are worth recomputing, about 100 m
+centroid_tolerance = 0.001
+
+def replicate_group_centroids(new_reports, how='mean', counts=False):
+    '''
+    One row per replicateGroup with the mean (or median, etc.) latitude and
+    longitude of its new reports, and optionally how many reports that was.
+    '''
+    groups = new_reports.groupby('replicateGroup')
+    centroids = groups[['latitude', 'longitude']].agg(how)
+    if counts:
+        centroids['count'] = groups.size()
+    return centroids
+
+def stream_centroids(chunksize=default_chunksize):
+    '''
+    replicate_group_centroids(load_new_reports(), counts=True), from one pass
+    over the new export that only keeps a chunk of three columns in memory.
+    '''
+    columns = ['latitude', 'longitude']
+    sums = counts = sizes = None
+    for chunk in iter_new_reports(['replicateGroup'] + columns, chunksize):
+        groups = chunk.groupby('replicateGroup')
+        parts = groups[columns].sum(), groups[columns].count(), groups.size()
+        if sums is None:
+            sums, counts, sizes = parts
+        else:
+            sums = sums.add(parts[0], fill_value=0)
+            counts = counts.add(parts[1], fill_value=0)
+            sizes = sizes.add(parts[2], fill_value=0)
+    if sums is None:
+        return pd.DataFrame(columns=columns + ['count'],
+                            index=pd.Index([], name='replicateGroup'))
+    # a group with no locations has a count of 0, and a mean of NaN
+    centroids = sums / counts.where(counts > 0)
+    centroids['count'] = sizes.astype(np.int64)
+    return centroids
 
-def get_lat(string):
+def stream_replicate_groups(chunksize=default_chunksize):
+    '''
+    The replicateGroup of every report in both exports, written the way the
+    combined data writes them, from a pass over that one column of each.
+    '''
+    groups = set()
+    for types, iter_reports in [(old_column_types(required_old_columns()), iter_old_reports),
+                                (new_column_types(), iter_new_reports)]:
+        for chunk in iter_reports(['replicateGroup'], chunksize, types):
+            groups.update(chunk.replicateGroup.dropna().astype(str).unique())
+    return pd.DataFrame({'replicateGroup': sorted(groups)})
+
+def load_centroids():
     try:
-        return new_reports.groupby('replicateGroup')['latitude'].mean()[string]
-    except:
-        return np.nan
+        return pd.read_csv(centroids_file, index_col='replicateGroup')
+    except FileNotFoundError:
+        return None
+
+def centroids_drifted(stored, current, path=combined_dir):
+    '''
+    Whether the old reports in the store at path, located with the stored
+    centroids, would get locations more than centroid_tolerance away from
+    the ones the current centroids give them.
+    '''
+    if stored is None:
+        return True
+    if len(stored.index.difference(current.index)):
+        return True
+    stored_locations = stored[['latitude', 'longitude']]
+    current_locations = current.loc[stored.index, ['latitude', 'longitude']]
+    if ((current_locations - stored_locations).abs() > centroid_tolerance).any().any():
+        return True
+    if (stored_locations.notnull() & current_locations.isnull()).any().any():
+        return True
+    # a group that just got a location matters if stored reports of it don't have one
+    located = current.index[current.latitude.notnull()]
+    added = located.difference(stored.index[stored.latitude.notnull()])
+    if len(added) == 0:
+        return False
+    reports = read_combined(path, columns=['latitude'],
+                            filters=[('replicateGroup', 'in', [str(g) for g in added])])
+    return bool(reports.latitude.isnull().any())
 
 # There's only one comment column in the new data, but multiple free-text columns
 # in the old data, which I've put together into one string.
-def combined_comments():
+def free_text_columns(columns):
     key_words = ['other', 'description', 'detail', 'comment', 'notlisted']
-    free_text_cols = [col for col in old_reports.columns for word in key_words\
-                      if word in col.lower()]
-    comments = old_reports[free_text_cols].fillna('')
-    combined_comments = comments.apply(\
-                      lambda row: reduce(lambda x, y: x + ' ' + str(y), row), axis=1)
-    return combined_comments
-
-def prepare_old_data():
+    return [col for col in columns for word in key_words if word in col.lower()]
+
+def combined_comments(old_reports):
+    free_text_cols = free_text_columns(old_reports.columns)
+    comments = old_reports[free_text_cols].fillna('').astype(str)
+    # a column that matches two key words is in there twice, like it always was
+    combined = comments.iloc[:, 0]
+    for i in range(1, comments.shape[1]):
+        combined = combined + ' ' + comments.iloc[:, i]
+    return combined
+
+def required_old_columns():
+    '''
+    All of the old columns that end up in the combined data, so the old export
+    can be read without the hundreds of columns that are never used.
+    '''
+    shared = [col for col in old_app_columns if col in set(new_app_columns)]
+    required = shared + old_source_columns + free_text_columns(old_app_columns)
+    return list(dict.fromkeys(required))
+
+def prepare_old_data(old_reports, new_reports, centroids=None):
+    if centroids is None:
+        centroids = replicate_group_centroids(new_reports)
+    shared = shared_columns(old_reports, new_reports)
+    rows = len(old_reports)
     # start with what's already there
-    df = old_reports[shared]
+    df = old_reports[shared].copy()
     # derive from old data
-    df['assetType'] = old_assetType()
-    df['assetId'] = old_reports.apply(lambda row: get_id(row), axis=1)
-    df['incidentDescription'] = combined_comments()
+    with stage('combine_data.assetType', rows):
+        df['assetType'] = old_assetType(old_reports)
+        df['assetId'] = get_id(old_reports)
+    with stage('combine_data.combined_comments', rows):
+        df['incidentDescription'] = combined_comments(old_reports)
     df['operationOrDevelopment'] = old_reports['userFunction']
-    df['latitude'] = old_reports.replicateGroup.apply(get_lat)
-    df['longitude'] = old_reports.replicateGroup.apply(get_lon)
+    with stage('combine_data.latlon', rows):
+        df['latitude'] = old_reports.replicateGroup.map(centroids.latitude)
+        df['longitude'] = old_reports.replicateGroup.map(centroids.longitude)
     df['name'] = old_reports.locationWellSiteName
     df['eventType'] = old_reports.eventTitle
     df['jobTypeObserved'] = old_reports.jobGroup
-    df['eventClassification'] = old_reports.eventTitle.apply(lambda s: "Verification" if\
-                       "Verification" in s else "Unknown")
-    df['event'] = old_reports.actualConsequences.apply(lambda s: "Observation" if\
-                     s == '[]' else "Incident")
-    return df[shared + derived] # make sure order is consistent
+    df['eventClassification'] = np.where(
+                    old_reports.eventTitle.str.contains('Verification', regex=False, na=False),
+                    'Verification', 'Unknown')
+    df['event'] = np.where(old_reports.actualConsequences == '[]', 'Observation', 'Incident')
+    # make sure order is consistent, and parse the event types once for everyone downstream
+    return with_event_mask(df[shared + derived])
+
+def prepare_new_data(old_reports, new_reports):
+    shared = shared_columns(old_reports, new_reports)
+    return with_event_mask(new_reports[shared + derived])
+
+def concatenate_data(old_reports=None, new_reports=None, centroids=None):
+    if old_reports is None:
+        old_reports = load_old_reports(usecols=required_old_columns())
+    if new_reports is None:
+        new_reports = load_new_reports()
+    with stage('combine_data.concatenate_data', len(old_reports) + len(new_reports)):
+        cleaned_old = prepare_old_data(old_reports, new_reports, centroids)
+        cleaned_new = prepare_new_data(old_reports, new_reports)
+        if len(cleaned_old) == 0:
+            # an empty old frame can have object columns, which would make seq text
+            return cleaned_new
+        return pd.concat([cleaned_old, cleaned_new])
+
+def iter_combined_data(chunksize, centroids=None, new_reports=None):
+    '''
+    Yield the combined data one chunk of the old export at a time, followed by
+    the new reports, so only one chunk of old reports is in memory at once.
+    Without new_reports the new export is read in chunks too (and the
+    centroids found with stream_centroids), so no export is ever held whole.
+    Every chunk is read with the columns and dtypes a read of the whole export
+    would have (see column_types), so the rows are the same as concatenate_data's.
+    chunksize can be a function, as for iter_export.
+    '''
+    new_types = None
+    if new_reports is None:
+        new_types = new_column_types()
+        # prepare_old_data only needs the new columns, to know which are shared
+        new_columns = pd.DataFrame(columns=list(new_types))
+    else:
+        new_columns = new_reports
+    if centroids is None:
+        centroids = stream_centroids() if new_reports is None else \
+                    replicate_group_centroids(new_reports)
+    old_types = old_column_types(required_old_columns())
+    old_columns = pd.DataFrame(columns=list(old_types))
+    for old_chunk in iter_old_reports(list(old_types), chunksize, old_types):
+        yield prepare_old_data(old_chunk, new_columns, centroids)
+    if new_reports is not None:
+        yield prepare_new_data(old_columns, new_reports)
+        return
+    for new_chunk in iter_new_reports(list(new_types), chunksize, new_types):
+        yield prepare_new_data(old_columns, new_chunk)
+
+'''
+Each day only a few hundred reports arrive, so rather than rebuilding the
+combined data from scratch, a manifest records the _id, _rev and
+serverModifiedDate of every report that has been combined.  An incremental
+update only prepares the reports that are new or have changed since.
+
+The old export hardly ever changes, so the state file remembers its size and
+modification time (and which of its columns weren't empty), and an update
+doesn't read it at all unless it has changed.  The old reports are located
+with the centroids the store was built with, so all of them agree; once the
+new reports have moved a centroid by more than centroid_tolerance (or given a
+location to a group that had none), the update rebuilds the store instead.
+'''
+manifest_file = 'my_data/combined_manifest.csv'
+manifest_columns = ['_id', '_rev', 'serverModifiedDate']
+state_file = 'my_data/combined_state.json'
+
+def manifest_keys(reports):
+    keys = reports[manifest_columns].astype(str)
+    return keys._id + '|' + keys._rev + '|' + keys.serverModifiedDate
+
+def load_manifest():
+    try:
+        return pd.read_csv(manifest_file, dtype=str)
+    except FileNotFoundError:
+        return pd.DataFrame(columns=manifest_columns)
+
+def save_manifest(manifest):
+    manifest[manifest_columns].to_csv(manifest_file, index=False)
+
+def old_export_signature():
+    return cache_key(old_app_file)
+
+def save_state(old_columns):
+    with open(state_file, 'w') as f:
+        json.dump({'old_export': old_export_signature(), 'old_columns': list(old_columns)}, f)
+
+def load_state():
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def unseen_reports(reports, manifest):
+    '''
+    The reports whose _id, _rev or serverModifiedDate is not in the manifest.
+    '''
+    return reports[~manifest_keys(reports).isin(set(manifest_keys(manifest)))]
 
-def prepare_new_data():
-    return new_reports[shared + derived]
+def write_combined_data(path=combined_dir, chunksize=None, centroid_stat='mean'):
+    '''
+    Write the combined reports to the store at path (see combined_store), along
+    with the replicateGroup centroids that were used to fill in the old
+    reports' locations and the manifest of which reports were combined.
+    '''
+    if chunksize is not None and centroid_stat == 'mean':
+        centroids = stream_centroids(chunksize)
+    else:
+        centroids = replicate_group_centroids(load_new_reports(), how=centroid_stat, counts=True)
+    centroids.to_csv(centroids_file)
+    partial_path = path + '.partial'
+    if os.path.isdir(partial_path):
+        shutil.rmtree(partial_path)
+    if chunksize is None:
+        old_reports = load_old_reports(usecols=required_old_columns())
+        combined = concatenate_data(old_reports, centroids=centroids)
+        write_partitions(combined, partial_path)
+        replace_store(partial_path, path)
+        save_manifest(combined)
+        save_state(old_reports.columns)
+        return
+    manifest = []
+    for chunk in iter_combined_data(chunksize, centroids):
+        write_partitions(chunk, partial_path)
+        manifest.append(chunk[manifest_columns])
+    replace_store(partial_path, path)
+    save_manifest(pd.concat(manifest))
+    save_state(old_column_types(required_old_columns()))
 
-def concatenate_data():
-    cleaned_old = prepare_old_data()
-    cleaned_new = prepare_new_data()
-    return pd.concat([cleaned_old, cleaned_new])
+def update_combined_data(path=combined_dir, centroid_stat='mean'):
+    '''
+    Combine only the reports that are new or revised since the last run and
+    upsert them into the store at path.  New reports are added as new files in
+    their months; only the months that held a revised report are rewritten.
+    The whole store is rebuilt instead when the centroids have drifted.
+    Returns the number of reports that were combined.
+    '''
+    new_reports = load_new_reports()
+    centroids = load_centroids()
+    if store_signature(path) is None or centroids_drifted(
+            centroids, replicate_group_centroids(new_reports, how=centroid_stat), path):
+        write_combined_data(path, centroid_stat=centroid_stat)
+        return len(load_manifest())
+    manifest = load_manifest()
+    state = load_state()
+    old_changed = state.get('old_export') != old_export_signature()
+    if old_changed:
+        old_reports = unseen_reports(load_old_reports(usecols=required_old_columns()), manifest)
+    else:
+        # nothing in an old export that was already combined can be unseen
+        old_reports = pd.DataFrame(columns=state['old_columns'])
+    changes = concatenate_data(old_reports, unseen_reports(new_reports, manifest), centroids)
+    if len(changes) == 0:
+        if old_changed:
+            save_state(old_reports.columns)
+        return 0
+    # only keep the report store and rollups in step if they matched before this update
+    signature = store_signature(path)
+    store = ReportStore(report_store_file) if os.path.isfile(report_store_file) else None
+    store_in_step = store is not None and store.source() == signature
+    rollups_in_step = load_rollups(rollup_file)[1] == signature
+    index_in_step = index_signature() == signature
+    revised = manifest._id.isin(set(changes._id.astype(str)))
+    replaced = None
+    if revised.any():
+        replaced = remove_ids(manifest._id[revised], path)
+    write_partitions(changes, path)
+    save_manifest(pd.concat([manifest[~revised], changes[manifest_columns].astype(str)]))
+    if old_changed:
+        save_state(old_reports.columns)
+    if store_in_step:
+        store.upsert(changes, path)
+    if store is not None:
+        store.close()
+    if rollups_in_step:
+        update_rollups(changes, replaced, path, rollup_file)
+    if index_in_step:
+        update_similarity_index(changes, path)
+    return len(changes)
 
 if __name__ == '__main__':
-    combined_df = concatenate_data()
-    combined_df.to_csv('my_data/combined_reports.csv', index=False)
+    parser = argparse.ArgumentParser(description='Combine the old and new safety reports.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only combine reports that are new or revised since the last run')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='read the old export this many rows at a time')
+    args = parser.parse_args()
+    if args.incremental:
+        update_combined_data()
+    else:
+        write_combined_data(chunksize=args.chunksize)
@@ -0,0 +1,231 @@
+import os
+import uuid
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+
+'''
+The combined reports, kept as parquet files partitioned by the month they were
+created in, instead of one big csv that every reader has to parse (and whose
+dates every reader has to infer again):
+
+    my_data/combined_reports/
+        month=2016-03/part-<uuid>.parquet
+        month=2016-04/...
+        month=unknown/...            reports without a serverCreatedDate
+        _version                     changes on every write
+
+The files are typed: the date columns are datetimes, the low-cardinality
+columns are categoricals and eventTypeMask is a uint16.  Readers ask only for
+the columns and months they need:
+
+    read_combined(columns=['seq', 'incidentDescription'],
+                  start='2017-01-01', filters=[('immediateActionsTaken', '==', 'Stop the Job')])
+
+Months outside start and end are never opened, only the columns asked for are
+read, and filters are handed to pyarrow, which skips row groups that can't match.
+
+Adding reports writes a new file in each month they belong to, so an
+incremental update only touches the months it has to.
+'''
+
+combined_dir = 'my_data/combined_reports'
+date_columns = ['serverCreatedDate', 'serverModifiedDate', 'adapterProcessedDate']
+categorical_columns = ['immediateActionsTaken',
+                       'operatingCenter',
+                       'replicateGroup',
+                       'assetType',
+                       'jobTypeObserved',
+                       'eventClassification',
+                       'event',
+                       'operationOrDevelopment']
+partition_column = 'serverCreatedDate'
+unknown_month = 'unknown'
+version_file = '_version'
+
+
+def typed(reports):
+    '''
+    reports with the store's dtypes.  Columns that already have them are left alone.
+    '''
+    conversions = {}
+    for col in reports.columns:
+        values = reports[col]
+        if col in date_columns:
+            if not pd.api.types.is_datetime64_any_dtype(values):
+                conversions[col] = pd.to_datetime(values, errors='coerce')
+        elif col in categorical_columns:
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.where(values.isnull(), values.astype(str))
+                conversions[col] = values.astype('category')
+        elif col == 'eventTypeMask':
+            conversions[col] = values.fillna(0).astype(np.uint16)
+        elif values.dtype == object:
+            # parquet wants one type per column, and csv chunks can mix numbers and text
+            conversions[col] = values.where(values.isnull(), values.astype(str))
+    return reports.assign(**conversions) if conversions else reports
+
+def month_keys(reports):
+    dates = pd.to_datetime(reports[partition_column], errors='coerce')
+    return dates.dt.strftime('%Y-%m').fillna(unknown_month)
+
+def partition_path(directory, month):
+    return os.path.join(directory, 'month={}'.format(month))
+
+def months(directory=combined_dir):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name[len('month='):] for name in os.listdir(directory)
+                  if name.startswith('month='))
+
+def month_files(directory, month):
+    path = partition_path(directory, month)
+    if not os.path.isdir(path):
+        return []
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+                  if name.endswith('.parquet'))
+
+def select_months(all_months, start=None, end=None):
+    '''
+    The months that can hold reports created between start and end (inclusive).
+    '''
+    if start is None and end is None:
+        return list(all_months)
+    first = pd.Timestamp(start).strftime('%Y-%m') if start is not None else ''
+    last = pd.Timestamp(end).strftime('%Y-%m') if end is not None else '9999-99'
+    return [month for month in all_months
+            if month != unknown_month and first <= month <= last]
+
+def store_signature(directory=combined_dir):
+    '''
+    Something that changes whenever the store does, or None if there's no store.
+    '''
+    try:
+        with open(os.path.join(directory, version_file)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def bump_version(directory):
+    with open(os.path.join(directory, version_file), 'w') as f:
+        f.write(uuid.uuid4().hex)
+
+def write_file(reports, path):
+    temporary_path = path + '.tmp'
+    reports.to_parquet(temporary_path, index=False)
+    os.replace(temporary_path, path)
+
+def write_partitions(reports, directory=combined_dir):
+    '''
+    Add reports to the store, as a new file in each month they were created in.
+    '''
+    reports = typed(reports)
+    for month, part in reports.groupby(month_keys(reports).values, sort=False):
+        path = partition_path(directory, month)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        write_file(part, os.path.join(path, 'part-{}.parquet'.format(uuid.uuid4().hex)))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    bump_version(directory)
+
+def replace_store(partial_directory, directory=combined_dir):
+    '''
+    Put a store that was written to partial_directory in place of the one at
+    directory.
+    '''
+    old_directory = directory + '.old'
+    if os.path.isdir(directory):
+        os.rename(directory, old_directory)
+    os.rename(partial_directory, directory)
+    if os.path.isdir(old_directory):
+        shutil.rmtree(old_directory)
+
+def read_month(directory, month, columns=None, filters=None):
+    frames = [pd.read_parquet(path, columns=columns, filters=filters)
+              for path in month_files(directory, month)]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+def iter_combined(directory=combined_dir, columns=None, start=None, end=None, filters=None):
+    '''
+    Yield the stored reports a month at a time, oldest first.  columns picks
+    the columns to read, start and end (anything pd.Timestamp understands)
+    limit serverCreatedDate, and filters are pyarrow filters, e.g.
+    [('operatingCenter', 'in', ['Wamsutter', 'Arkoma'])].
+    '''
+    dated = start is not None or end is not None
+    read_columns = columns
+    if dated and columns is not None and partition_column not in columns:
+        read_columns = list(columns) + [partition_column]
+    for month in select_months(months(directory), start, end):
+        reports = read_month(directory, month, read_columns, filters)
+        if dated:
+            created = reports[partition_column]
+            keep = np.ones(len(reports), dtype=bool)
+            if start is not None:
+                keep &= (created >= pd.Timestamp(start)).values
+            if end is not None:
+                keep &= (created <= pd.Timestamp(end)).values
+            reports = reports[keep]
+            if read_columns is not columns:
+                reports = reports[list(columns)]
+        if len(reports):
+            yield reports
+
+def read_combined(directory=combined_dir, columns=None, start=None, end=None, filters=None):
+    '''
+    The stored reports (see iter_combined) as one DataFrame.
+    '''
+    frames = list(iter_combined(directory, columns, start, end, filters))
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    # months with different categories come back from concat as plain objects
+    return typed(pd.concat(frames, ignore_index=True))
+
+def remove_ids(ids, directory=combined_dir):
+    '''
+    Take the reports with these _ids out of the store, rewriting only the
+    months that hold one of them, and return what was taken out.
+    '''
+    ids = set(str(i) for i in ids)
+    removed = []
+    for month in months(directory):
+        if not read_month(directory, month, ['_id'])._id.astype(str).isin(ids).any():
+            continue
+        old_files = month_files(directory, month)
+        reports = read_month(directory, month)
+        hit = reports._id.astype(str).isin(ids).values
+        removed.append(reports[hit])
+        if not hit.all():
+            write_file(reports[~hit], os.path.join(partition_path(directory, month),
+                                                   'part-{}.parquet'.format(uuid.uuid4().hex)))
+        for path in old_files:
+            os.remove(path)
+    bump_version(directory)
+    return typed(pd.concat(removed, ignore_index=True)) if removed else None
+
+def convert_csv(csv_path, directory=combined_dir, chunksize=100000):
+    '''
+    Make a store from a combined_reports.csv written before the store existed.
+    '''
+    partial_directory = directory + '.partial'
+    if os.path.isdir(partial_directory):
+        shutil.rmtree(partial_directory)
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize, low_memory=False):
+        write_partitions(chunk, partial_directory)
+    replace_store(partial_directory, directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='The month-partitioned combined reports.')
+    parser.add_argument('--from-csv', default=None, metavar='CSV',
+                        help='convert a combined_reports.csv into the store')
+    parser.add_argument('--directory', default=combined_dir)
+    args = parser.parse_args()
+    if args.from_csv is not None:
+        convert_csv(args.from_csv, args.directory)
+    for month in months(args.directory):
+        print(month, sum(os.path.getsize(path) for path in month_files(args.directory, month)))
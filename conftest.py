@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scorer import ReportSorter
+
+'''
+A ReportSorter that doesn't need the combined reports or a fitted pipeline,
+and synthetic reports to sort with it.
+'''
+
+class LengthPipeline(object):
+    '''
+    Stands in for the SVD pipeline: a description's coordinates only depend on
+    its length, so identical descriptions get identical scores.
+    '''
+
+    def transform(self, descriptions):
+        lengths = np.array([len(text) for text in descriptions], dtype=float)
+        return np.column_stack([lengths, lengths % 7, lengths % 5, lengths % 3])
+
+@pytest.fixture
+def sorter(tmp_path, monkeypatch):
+    # the sorter keeps the coordinates it computes under my_data/
+    monkeypatch.chdir(tmp_path)
+    return ReportSorter(pipe_SVD=LengthPipeline(), completed_line=(0.0, 1.0),
+                        stop_job_center=(0.0, 0.0), version='test')
+
+def sample_reports(n=300, seed=0):
+    random = np.random.RandomState(seed)
+    actions = ['Stop the Job', 'Further Action Necessary', 'Action Completed Onsite',
+               'No Action Necessary', None]
+    event_types = ['[]', "['Near Miss']", "['Hazard Identification']",
+                   "['Near Miss', 'Property Damage']", "['Fire/Explosion', 'Injury/Illness']"]
+    descriptions = ['valve left open', 'spill near tank', 'no hard hat', 'dropped object',
+                    'truck backed into fence', '[]']
+    return pd.DataFrame({
+        'seq': np.arange(n),
+        'immediateActionsTaken': random.choice(actions, n),
+        'eventType': random.choice(event_types, n),
+        'incidentDescription': random.choice(descriptions, n)})
+
+@pytest.fixture
+def reports():
+    return sample_reports()
@@ -0,0 +1,295 @@
+import os
+import uuid
+import shutil
+import numpy as np
+import pandas as pd
+from instrumentation import stage
+from svd_model import pipeline_file, load_transformer, pipeline_version
+
+
+coordinates_dir = 'my_data/svd_coordinates'
+
+'''
+Transforming every incident description into SVD space is the slow part of
+scoring and plotting, and the answer only depends on the text and the pipeline.
+The store keeps the coordinates of every description it has seen in .npy files
+(one directory per pipeline version), keyed by a hash of the text, so identical
+descriptions (like all the empty '[]' comments) are transformed once.  A second
+index remembers which text each report seq had, so coordinates can also be
+looked up by seq.
+
+The .npy files are sorted by hash (and seq) and only ever rewritten whole, as
+a new generation directory that the 'current' file is then pointed at, so the
+four of them always change together.  Texts and seqs seen since are appended
+to two small delta files in that generation, which cost the same to add to
+however big the store is, and are merged into a new generation once they hold
+more than merge_fraction of the store:
+
+    my_data/svd_coordinates/<version>/
+        current                     name of the current generation
+        <generation>/hashes.npy, coordinates.npy, seqs.npy, seq_hashes.npy
+        <generation>/added.bin      hash and coordinates of each text since
+        <generation>/seq_changes.bin    seq and text hash of each report since
+'''
+
+added_dtype = np.dtype([('hash', np.uint64), ('coordinates', np.float64, (4,))])
+seq_change_dtype = np.dtype([('seq', np.int64), ('hash', np.uint64)])
+# merge the delta files into the .npy files once they hold this fraction of the store
+merge_fraction = 0.1
+min_merge_rows = 10000
+
+def hash_texts(texts):
+    return pd.util.hash_pandas_object(pd.Series(texts, dtype=object), index=False).values
+
+def read_records(path, dtype):
+    '''
+    The whole records in a delta file; a record cut short by a crash is ignored.
+    '''
+    if not os.path.isfile(path):
+        return np.empty(0, dtype=dtype)
+    return np.fromfile(path, dtype=dtype, count=os.path.getsize(path) // dtype.itemsize)
+
+def append_records(path, records):
+    with open(path, 'ab') as f:
+        records.tofile(f)
+
+
+class CoordinateStore(object):
+
+    def __init__(self, pipeline_path=pipeline_file, directory=coordinates_dir,
+                 pipeline=None, version=None):
+        '''
+        Use the pipeline saved at pipeline_path, or a pipeline that was loaded
+        some other way along with the version it was saved as.
+        '''
+        self.pipeline_path = pipeline_path
+        self.pipeline = pipeline
+        self.version = version if version is not None else pipeline_version(pipeline_path)
+        self.root = os.path.join(directory, self.version)
+        # with autosave off, new coordinates are only kept in memory until save()
+        self.autosave = True
+        self.load()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def current_generation(self):
+        try:
+            with open(os.path.join(self.root, 'current')) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        generation = self.current_generation()
+        # stores written before there were generations keep their files in root
+        self.directory = os.path.join(self.root, generation) if generation else self.root
+        if os.path.isfile(self.path('coordinates.npy')):
+            self.hashes = np.load(self.path('hashes.npy'))
+            self.coordinates = np.load(self.path('coordinates.npy'), mmap_mode='r')
+            self.seqs = np.load(self.path('seqs.npy'))
+            self.seq_hashes = np.load(self.path('seq_hashes.npy'))
+        else:
+            self.hashes = np.array([], dtype=np.uint64)
+            self.coordinates = np.empty((0, 4))
+            self.seqs = np.array([], dtype=np.int64)
+            self.seq_hashes = np.array([], dtype=np.uint64)
+        # the delta: texts and seqs that aren't in the .npy files yet
+        self.added = {}
+        self.added_coordinates = np.empty((64, 4))
+        self.seq_changes = {}
+        self.unsaved_added = []
+        self.unsaved_seq_changes = []
+        self.remember_added(read_records(self.path('added.bin'), added_dtype))
+        self.remember_seq_changes(read_records(self.path('seq_changes.bin'), seq_change_dtype))
+
+    def remember_added(self, records):
+        start = len(self.added)
+        if start + len(records) > len(self.added_coordinates):
+            grown = np.empty((2 * (start + len(records)), 4))
+            grown[:start] = self.added_coordinates[:start]
+            self.added_coordinates = grown
+        self.added_coordinates[start:start + len(records)] = records['coordinates']
+        for row, key in enumerate(records['hash'].tolist(), start):
+            self.added[key] = row
+
+    def remember_seq_changes(self, records):
+        self.seq_changes.update(zip(records['seq'].tolist(), records['hash'].tolist()))
+
+    def delta_size(self):
+        return len(self.added) + len(self.seq_changes)
+
+    def save(self):
+        '''
+        Append what hasn't been saved to the delta files, and merge them into
+        a new generation if they've grown too big.
+        '''
+        if not self.unsaved_added and not self.unsaved_seq_changes:
+            return
+        if self.directory == self.root:
+            # no generation yet, so start one with everything in it
+            self.merge()
+            return
+        for name, unsaved in [('added.bin', self.unsaved_added),
+                              ('seq_changes.bin', self.unsaved_seq_changes)]:
+            if unsaved:
+                append_records(self.path(name), np.concatenate(unsaved))
+                del unsaved[:]
+        if self.delta_size() > max(min_merge_rows, merge_fraction * len(self.hashes)):
+            self.merge()
+
+    def merge(self):
+        '''
+        Write the store and its delta as a new generation of .npy files, and
+        make that the current one.
+        '''
+        added_hashes = np.fromiter(self.added.keys(), dtype=np.uint64, count=len(self.added))
+        all_hashes = np.concatenate([self.hashes, added_hashes])
+        all_coordinates = np.concatenate([np.asarray(self.coordinates),
+                                          self.added_coordinates[:len(self.added)]])
+        order = np.argsort(all_hashes, kind='stable')
+        changes = pd.Series(list(self.seq_changes.values()),
+                            index=list(self.seq_changes.keys()), dtype=np.uint64)
+        index = pd.concat([pd.Series(self.seq_hashes, index=self.seqs), changes])
+        index = index[~index.index.duplicated(keep='last')].sort_index()
+        generation = uuid.uuid4().hex
+        directory = os.path.join(self.root, generation)
+        os.makedirs(directory)
+        np.save(os.path.join(directory, 'hashes.npy'), all_hashes[order])
+        np.save(os.path.join(directory, 'coordinates.npy'), all_coordinates[order])
+        np.save(os.path.join(directory, 'seqs.npy'), index.index.values.astype(np.int64))
+        np.save(os.path.join(directory, 'seq_hashes.npy'), index.values.astype(np.uint64))
+        temporary_path = os.path.join(self.root, 'current.{}.tmp'.format(os.getpid()))
+        with open(temporary_path, 'w') as f:
+            f.write(generation)
+        os.replace(temporary_path, os.path.join(self.root, 'current'))
+        old_directory = self.directory
+        self.load()
+        if old_directory == self.root:
+            for name in ['hashes.npy', 'coordinates.npy', 'seqs.npy', 'seq_hashes.npy']:
+                if os.path.isfile(os.path.join(self.root, name)):
+                    os.remove(os.path.join(self.root, name))
+        else:
+            shutil.rmtree(old_directory, ignore_errors=True)
+
+    def lookup(self, hashes):
+        '''
+        The stored coordinates of each hash (NaN where it isn't stored), and
+        which ones were found.
+        '''
+        result = np.full((len(hashes), 4), np.nan)
+        found = np.zeros(len(hashes), dtype=bool)
+        if len(self.hashes):
+            positions = np.searchsorted(self.hashes, hashes)
+            positions[positions == len(self.hashes)] = 0
+            found = self.hashes[positions] == hashes
+            result[found] = np.asarray(self.coordinates[positions[found]])
+        if self.added and not found.all():
+            missing = np.flatnonzero(~found)
+            rows = np.array([self.added.get(key, -1) for key in hashes[missing].tolist()],
+                            dtype=np.int64)
+            hit = rows >= 0
+            result[missing[hit]] = self.added_coordinates[rows[hit]]
+            found[missing[hit]] = True
+        return result, found
+
+    def seq_hash(self, seqs):
+        '''
+        The hash of the last text seen for each seq, and which seqs have one.
+        '''
+        hashes = np.zeros(len(seqs), dtype=np.uint64)
+        found = np.zeros(len(seqs), dtype=bool)
+        if len(self.seqs):
+            index = np.searchsorted(self.seqs, seqs)
+            index[index == len(self.seqs)] = 0
+            found = self.seqs[index] == seqs
+            hashes[found] = self.seq_hashes[index[found]]
+        if self.seq_changes:
+            changed_seqs = pd.Index(list(self.seq_changes.keys()))
+            changed_hashes = np.fromiter(self.seq_changes.values(), dtype=np.uint64,
+                                         count=len(self.seq_changes))
+            rows = changed_seqs.get_indexer(seqs)
+            hashes[rows >= 0] = changed_hashes[rows[rows >= 0]]
+            found |= rows >= 0
+        return hashes, found
+
+    def add(self, hashes, coordinates):
+        records = np.empty(len(hashes), dtype=added_dtype)
+        records['hash'] = hashes
+        records['coordinates'] = coordinates
+        self.remember_added(records)
+        self.unsaved_added.append(records)
+
+    def index_seqs(self, seqs, hashes):
+        seqs = pd.to_numeric(pd.Series(seqs), errors='coerce').values
+        known = ~np.isnan(seqs)
+        seqs, hashes = seqs[known].astype(np.int64), hashes[known]
+        # a report whose description changed keeps only its newest text
+        last = ~pd.Series(seqs).duplicated(keep='last').values
+        seqs, hashes = seqs[last], hashes[last]
+        stored, found = self.seq_hash(seqs)
+        changed = ~found | (stored != hashes)
+        if not changed.any():
+            return False
+        records = np.empty(int(changed.sum()), dtype=seq_change_dtype)
+        records['seq'] = seqs[changed]
+        records['hash'] = hashes[changed]
+        self.remember_seq_changes(records)
+        self.unsaved_seq_changes.append(records)
+        return True
+
+    def transform(self, descriptions, seqs=None, remember=True):
+        '''
+        The 4-d coordinates of each description, in the same order.  Only
+        descriptions that aren't stored yet go through the pipeline, and each
+        distinct text only once.  With remember=False (for one-off queries)
+        the new ones aren't added to the store.
+        '''
+        texts = pd.Series(list(descriptions), dtype=object).astype(str).values
+        hashes = hash_texts(texts)
+        coordinates, found = self.lookup(hashes)
+        changed = False
+        if not found.all():
+            missing_hashes, first, inverse = np.unique(hashes[~found], return_index=True,
+                                                       return_inverse=True)
+            missing_texts = texts[~found][first]
+            pipe = self.pipeline if self.pipeline is not None else load_transformer(self.pipeline_path)
+            with stage('coordinate_store.transform', len(missing_texts)):
+                new_coordinates = pipe.transform(missing_texts)
+            coordinates[~found] = new_coordinates[inverse.ravel()]
+            if remember:
+                self.add(missing_hashes, new_coordinates)
+                changed = True
+        if seqs is not None and remember:
+            changed = self.index_seqs(seqs, hashes) or changed
+        if changed and self.autosave:
+            self.save()
+        return coordinates
+
+    def coordinates_for_seqs(self, seqs):
+        '''
+        Coordinates of the last description seen for each seq, with a row of
+        NaN for any seq that has never been transformed.
+        '''
+        seqs = np.asarray(seqs, dtype=np.int64)
+        result = np.full((len(seqs), 4), np.nan)
+        hashes, found = self.seq_hash(seqs)
+        result[found] = self.lookup(hashes[found])[0]
+        return result
+
+
+_stores = {}
+
+def get_store(pipeline_path=pipeline_file):
+    '''
+    The store for the current version of the pipeline, shared by the process.
+    '''
+    version = pipeline_version(pipeline_path)
+    store = _stores.get(pipeline_path)
+    if store is None or store.version != version:
+        store = CoordinateStore(pipeline_path)
+        _stores[pipeline_path] = store
+    return store
+
+def transform_descriptions(descriptions, seqs=None):
+    return get_store().transform(descriptions, seqs)
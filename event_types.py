@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+
+'''
+eventType is free text listing a report's event types, e.g.
+"['Near Miss', 'Property Damage']".  Rather than every module scanning that
+text for the types it cares about, combine_data parses it once into
+eventTypeMask, an integer with one bit per type in event_types:
+
+    mask = event_type_mask(reports.eventType)
+    type_dummies(mask, ['Near Miss', 'Security'])   # 0/1 columns
+    count_types(mask)                               # number of meaningful types
+
+The bit of a type is its position in event_types, so new types must only ever
+be added to the end of the list, or saved masks will change meaning.
+'''
+
+event_types = ['Fire/Explosion',
+               'Injury/Illness',
+               'Material Release',
+               'Near Miss',
+               'Property Damage',
+               'Security',
+               'Hazard Identification',
+               'Verification']
+
+# the event types of most reports are either empty or vague, and these aren't
+meaningful_types = ['Fire/Explosion',
+                    'Injury/Illness',
+                    'Material Release',
+                    'Near Miss',
+                    'Property Damage',
+                    'Security']
+
+mask_column = 'eventTypeMask'
+mask_dtype = np.uint16
+
+
+def type_bits(types=event_types):
+    '''
+    The mask with the bit of each of types set.
+    '''
+    bits = 0
+    for event in types:
+        bits |= 1 << event_types.index(event)
+    return mask_dtype(bits)
+
+def event_type_mask(event_type_column):
+    '''
+    Parse a column of eventType text into an eventTypeMask column.  A type is
+    set if its name appears anywhere in the text, and missing text has no types.
+    '''
+    text = pd.Series(event_type_column).fillna('').astype(str)
+    mask = np.zeros(len(text), dtype=mask_dtype)
+    for event in event_types:
+        mask |= text.str.contains(event, regex=False).values * type_bits([event])
+    return pd.Series(mask, index=text.index, name=mask_column)
+
+def event_masks(reports):
+    '''
+    The eventTypeMask column of reports, parsed from eventType if it isn't there.
+    '''
+    if mask_column in reports.columns:
+        return reports[mask_column].fillna(0).astype(mask_dtype)
+    return event_type_mask(reports.eventType)
+
+def with_event_mask(reports):
+    return reports.assign(**{mask_column: event_type_mask(reports.eventType).values})
+
+def type_dummies(masks, types=event_types, dtype=np.uint8):
+    '''
+    A 0/1 column for each of types, saying whether it is set in each mask.
+    '''
+    masks = pd.Series(masks)
+    values = masks.values.astype(mask_dtype)
+    return pd.DataFrame({event: ((values & type_bits([event])) != 0).astype(dtype)
+                         for event in types}, index=masks.index, columns=list(types))
+
+def popcount(masks):
+    '''
+    The number of bits set in each mask, as signed ints so callers can negate
+    them to sort in descending order.
+    '''
+    values = np.asarray(masks).astype('>u2')
+    bits = np.unpackbits(values.view(np.uint8).reshape(-1, 2), axis=1)
+    return bits.sum(axis=1, dtype=np.int64)
+
+def count_types(masks, types=meaningful_types):
+    '''
+    How many of types are set in each mask.
+    '''
+    return popcount(np.asarray(masks).astype(mask_dtype) & type_bits(types))
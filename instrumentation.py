@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import atexit
+import cProfile
+import resource
+import functools
+import tracemalloc
+
+'''
+Per-stage timing for the pipeline, so a slow nightly run can be pinned on the
+csv parse, the combine step, a particular feature or the SVD transforms.
+
+It is off unless switched on, either with environment variables
+    STAY_SAFE_TRACE=trace.json     record stages and write them to trace.json at exit
+    STAY_SAFE_PROFILE=1            also run the outermost stages under cProfile
+    STAY_SAFE_TRACEMALLOC=1        also record peak memory with tracemalloc
+or by calling enable().  While it is off, stage() hands back the same do-nothing
+object every time, so instrumented code only pays for one flag check.
+
+    with stage('combine_data.prepare_old_data', rows=len(old_reports)):
+        ...
+
+Each record has the stage name, the stage it ran inside, wall time, cpu time,
+rows, the process's max rss and, if tracing memory, the peak traced memory.
+Stages nest: an outer stage's peak includes the peaks of the stages inside it,
+and with profiling on only the outermost stage runs a profiler, so the inner
+stages' calls are in its profile rather than in profiles of their own.
+Records made in worker processes can be collected with drain() and added to
+the parent's with extend().
+'''
+
+_enabled = False
+_trace_path = None
+_profile = False
+_trace_memory = False
+_owner_pid = None
+_records = []
+_stack = []
+
+
+class _NullStage(object):
+
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+_null_stage = _NullStage()
+
+
+class Stage(object):
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        parent = _stack[-1] if _stack else None
+        self.parent = parent.name if parent is not None else None
+        # only the outermost profiled stage of this process runs a profiler, and
+        # the stages inside it show up in its profile
+        profiling = any(s.profiler is not None and s.pid == os.getpid() for s in _stack)
+        self.pid = os.getpid()
+        _stack.append(self)
+        if _trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            if parent is not None:
+                # the peak is about to be reset, so the parent keeps what it reached so far
+                parent.peak = max(parent.peak, peak)
+            self.memory_at_start = self.peak = current
+            tracemalloc.reset_peak()
+        self.profiler = cProfile.Profile() if _profile and not profiling else None
+        self.started = time.time()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        if self.profiler is not None:
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # another profiler is already running (one a forked worker inherited)
+                self.profiler = None
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiler is not None:
+            self.profiler.disable()
+        record = {'name': self.name,
+                  'parent': self.parent,
+                  'pid': os.getpid(),
+                  'start': self.started,
+                  'wall_seconds': time.perf_counter() - self.wall,
+                  'cpu_seconds': time.process_time() - self.cpu,
+                  'rows': self.rows,
+                  'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'failed': exc_info[0] is not None}
+        _stack.pop()
+        if _trace_memory:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            record['peak_memory_bytes'] = self.peak - self.memory_at_start
+            if _stack:
+                _stack[-1].peak = max(_stack[-1].peak, self.peak)
+        if self.profiler is not None:
+            record['profile'] = self.save_profile()
+        _records.append(record)
+        return False
+
+    def save_profile(self):
+        base = _trace_path if _trace_path is not None else 'stay_safe_trace'
+        path = '{}.{}.{}.prof'.format(base, self.name.replace('/', '_'), len(_records))
+        self.profiler.dump_stats(path)
+        return path
+
+
+def enable(trace_path=None, profile=False, trace_memory=False):
+    '''
+    Start recording stages.  With a trace_path the records are written there
+    when the process exits.
+    '''
+    global _enabled, _trace_path, _profile, _trace_memory, _owner_pid
+    _enabled = True
+    _owner_pid = os.getpid()
+    _trace_path = trace_path
+    _profile = profile
+    _trace_memory = trace_memory
+    if trace_path is not None:
+        atexit.register(write_trace)
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def is_enabled():
+    return _enabled
+
+def settings():
+    '''
+    What a worker process needs to pass to enable() to record the same way.
+    '''
+    return {'profile': _profile, 'trace_memory': _trace_memory} if _enabled else None
+
+def stage(name, rows=None):
+    if not _enabled:
+        return _null_stage
+    return Stage(name, rows)
+
+def instrumented(name=None):
+    '''
+    Decorator that runs every call of the function as a stage.
+    '''
+    def decorate(function):
+        stage_name = name or '{}.{}'.format(function.__module__, function.__name__)
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with Stage(stage_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def records():
+    return list(_records)
+
+def drain():
+    '''
+    Take the records this process has made so far, e.g. to send them back from
+    a worker process (a forked worker also starts with a copy of its parent's).
+    Records from other processes, like the ones a parent has collected from
+    its workers, are left where they are.
+    '''
+    pid = os.getpid()
+    taken = [record for record in _records if record['pid'] == pid]
+    _records[:] = [record for record in _records if record['pid'] != pid]
+    return taken
+
+def extend(more_records):
+    _records.extend(more_records)
+
+def write_trace(path=None):
+    if path is None and os.getpid() != _owner_pid:
+        # a worker that inherited the settings leaves the trace to its parent
+        return
+    path = path or _trace_path
+    if path is None or not _records:
+        return
+    with open(path, 'w') as f:
+        json.dump({'stages': _records}, f, indent=4)
+
+
+if os.environ.get('STAY_SAFE_TRACE'):
+    os.environ.setdefault('STAY_SAFE_TRACE_PID', str(os.getpid()))
+    enable(os.environ['STAY_SAFE_TRACE'],
+           profile=bool(os.environ.get('STAY_SAFE_PROFILE')),
+           trace_memory=bool(os.environ.get('STAY_SAFE_TRACEMALLOC')))
+    # spawned workers see the same variables, but only the first process writes the trace
+    _owner_pid = int(os.environ['STAY_SAFE_TRACE_PID'])
@@ -1,29 +1,214 @@
+import os
+import glob
+import json
+import hashlib
 import pandas as pd
+from instrumentation import stage
 
 
 old_safety_app_cols = '''
 _id,_rev,templateId,docType,deletedDate,createdBy,createdDate,modifiedBy,modifiedDate,serverCreatedDate,serverModifiedDate,organization,safetyPlusReportNumber,businessUnit,operatingCenter,area,userFunction,jobGroup,jobGroupOther,locationWellSite,locationWellSiteOther,locationWellSiteName,companyInvolved,companyInvolvedNotListed,reportedBy,reportedByEmail,reportedTo,eventOccurredDate,assetId,assetLatitude,assetLongitude,replicateGroup,replicateTo,eventTitle,eventDescription,immediateActionsTaken,actionCompletedOnsiteDetail,furtherActionNecessaryDetail,furtherActionNecessaryComments,fireExplosionParty,fireExplosionClassification,typeOfFire,sourceOfIgnition,sourceOfRelease,regulatoryAuthoritiesNotified,hazardClassification,biologicalHazard,chemicalHazard,ergonomicHazard,humanHazard,naturalHazard,physicalHazard,safetyHazard,hazardControlSolution,integrityRelated,oshaPsmIncident,processSafetyEvent,wellControlEvent,nearMissClassification,nearMissType,unsafeAct,unsafeCondition,propertyDamagedParty,typeOfEquipment,typeOfFailure,securityClassification,typeOfTheft,typeOfTheftOther,personInvolved,relationToEvent,personGender,jobTitle,contactNumber,localAuthoritiesNotified,estimatedValue,verifier,backToBasics,monitoringConducted,monitoringConductedComment,monitorCalibration,monitorCalibrationComment,monitorBump,monitorBumpComment,hotWork,hotWorkComment,personnelCompetent3,personelCompetent3Comment,verificationAtmosphericMonitoringGapNotListed,verificationAtmosphericMonitoringGapNotListedComment,correctClass,correctClassComment,confinedSpaceAtmosphericMonitoring,confinedSpaceAtmosphericMonitoringComment,hazardsPermit,hazardsPermitComment,energySource,energySourceComment,authorizationEnter,authorizationEnterConductedComment,personnelCompetent5,personnelCompetent5Comment,confinedSpaceGapNotListed,verificationConfinedSpaceGapNotListed,backTraining,backTrainingComment,backSticker,backStickerComment,stopJob,stopJobComment,riskAssessment,riskAssessmentComment,workPermit,workPermitComment,atomMonitor,atomMonitorComment,confinedSpace,confinedSpaceComment,safetyCritical,safetyCriticalComment,lotoDevices,lotoDevicesComment,linesCleared,linesClearedComment,workHeights,workHeightsComment,personalProtective,personalProtectiveComment,liftPump,liftPumpComment,driveSafe,driveSafeComment,contractorEngagementGapNotListed,verificationContractorEngagementGapNotListed,hazardousRoad,hazardousRoadComment,spotterBacking,spotterBackingComment,locationClearance,locationClearanceComment,vehicleMaintained,vehicleMaintainedComment,driverDistraction,driverDistractionComment,drivingLaws,drivingLawsComment,drivingSafetyGapNotListed,verificationDrivingSafetyGapNotListed,energySources,energySourcesComment,applicationUtilized,applicationUtilizedComment,storedEnergy,storedEnergyComment,isolationConducted,isolationConductedComment,monitoringFrequency,monitoringFrequencyComment,affectedEmployees,affectedEmployeesComment,authorizedEmployees,authorizedEmployeesComment,personnelCompetent4,personnelCompetent4Comment,energyIsolationGapNotListed,verificationEnergyIsolationGapNotListed,fluidHauler,fluidManagementComment,groundStrap,groundStrapComment,ppeTank,ppeTankComment,sightTube,sightTubeComment,ventHose,ventHoseComment,muscleStrain,muscleStrainComment,truckGauge,truckGaugeComment,pumpingExcess,pumpingExcessComment,avoidSpills,avoidSpillsComment,reportSpills,reportSpillsComment,fluidManagementGapNotListed,verificationFluidManagementGapNotListed,oneCall,oneCallComment,lineLocates,lineLocatesComment,digZone,digZoneComment,undergroundHazards,undergroundHazardsComment,properMark,properMarkComment,hazardsIsolated,hazardsIsolatedComment,plotPlan,plotPlanComment,excavationInspected,excavationInspectedComment,groundDisturbanceGapNotListed,verificationGroundDisturbanceGapNotListed,personnelCompetent1,personnelCompetent1Comment,jsaComplete,jsaCompleteComment,jobStepsDefined,jobStepsDefinedComment,jobStepsUnderstood,jobStepsUnderstoodComment,jobHazardsIdentified,jobHazardsIdentifiedComment,controlMeasuresInPlace,controlMeasuresInPlaceComment,simultaneousOperationsRecognized,simultaneousOperationsRecognizedComment,hazardAssessmentGapNotListed,verificationHazardAssessmentGapNotListed,deviceInpsected,deviceInspectedComment,riggingInspected,riggingInspectedComment,operatorCompetent,operatorCompetentComment,riggerCompetent,riggerCompetentComment,exclusionZone1,exclusionZone1Comment,communicationEstablished,communicationEstablishedComment,slingsRating,slingsRatingComment,safetyFunctionTest,safetyFunctionTestComment,conditionsMonitored,conditionsMonitoredComment,taglineUsed,taglineUsedComment,liftingOperationsGapNotListed,verificationLiftingOperationsGapNotListed,OtherSafetyConversation,authorizationObtained,authorizationObtainedComment,mitigationMeasures,mitigationMeasuresComment,personnelCompetent2,personnelCompetent2Comment,overridingDisablingSafetyCriticalEquipmentGapNotListed,overridingDisablingSafetyCriticalEquipmentGapNotListedComment,ppeRequirements,ppeRequirementsComment,ppeMaintained,ppeMaintainedComment,sdsReferal,sdsReferalComment,ppeAvailable,ppeAvailableComment,siteRequirements,siteRequirementsComment,personalProtectiveEquipmentGapNotListed,verificationPersonalProtectiveEquipmentGapNotListed,potentialHazardous,potentialHazardousComment,wellSigns,wellSignsComment,normalOperatingPosition,normalOperatingPositionComment,dumpValves,dumpValvesComment,fuelPots,fuelPotsComment,rainCaps,rainCapsComment,tankContainment,tankContainmentComment,safetyGuarding,safetyGuardingComment,fluidLevels,fluidLevelsComment,openEndedValves,openEndedValvesComment,automationEquipment,automationEquipmentComment,gatesFenceGuards,gatesFenceGuardsComment,routineWellsiteInspectionGapNotListed,verificationRoutineWellsiteInspectionGapNotListed,permitValid,permitValidComment,permitComplete,permitCompleteComment,permitScopeIdentified,permitScopeIdentifiedComment,validWorkPermitGapNotListed,verificationValidWorkPermitGapNotListed,personnelProtected,personnelProtectedComment,equipmentInspected,equipmentInspectedComment,equipmentWorn,equipmentWornComment,workPlatform,workPlatformComment,personnelTrained,personnelTrainedComment,freeFall,freeFallComment,workingAtHeightsGapNotListed,verificationWorkingAtHeightsGapNotListed,approvedProcedure2,approvedProcedure2Comment,overPressure4,overPressure4Comment,pressureUnderstood2,pressureUnderstood2Comment,annualBop,annualBopComment,fatigueHistory,fatigueHistoryComment,energizedIron,energizedIronComment,craneOperator,craneOperatorComment,exclusionZone5,exclusionZone5Comment,musterPoint3,musterPoint3Comment,wellsCoilTubingGapNotListed,verificationWellsCoilTubingGapNotListed,treatingIron,treatingIronComment,overPressure1,overPressure1Comment,chemicalList,chemicalListComment,chemicalSpills,chemicalSpillsComment,safetyData,safetyDataComment,ppeChemicals,ppeChemicalsComment,exclusionZone2,exclusionZone2Comment,musterPoint1,musterPoint1Comment,wellsFracOperationsGapNotListed,verificationWellsFracOperationsGapNotListed,pressureUnderstood1,pressureUnderstood1Comment,maximumWorking,maximumWorkingComment,maximumExpected,maximumExpectedComment,weakestComponent,weakestComponentComment,overPressure2,overPressure2Comment,pressureDevice,pressureDeviceComment,valveAlignment,valveAlignmentComment,monitorPressure,monitorPressureComment,pressureHoses,pressureHosesComment,exclusionZone3,exclusionZone3Comment,wellsOverPressureProtectionGapNotListed,verificationWellsOverPressureProtectionGapNotListed,pressureTest,pressureTestComment,testingCriteria,testingCriteriaComment,checkValves,checkValvesComment,flowbackEquipment,flowbackEquipmentComment,productionCasing,productionCasingComment,overPressure3,overPressure3Comment,weeklyFunction1,weeklyFunction1Comment,exclusionZone4,exclusionZone4Comment,wellsPressureTestingGapNotListed,verificationWellsPressureTestingGapNotListed,scePlan,scePlanComment,mastSubstructure,mastSubstructureComment,ramPreventers,ramPreventersComment,travelingEquipment,travelingEquipmentComment,cofoEquipment,cofoEquipmentComment,powerSwivel,powerSwivelComment,weightIndicator,weightIndicatorComment,mudPumps,mudPumpsComment,prvKill,prvKillComment,pressureIron,pressureIronComment,highPumping,highPumpingComment,whipChecks,whipChecksComment,gasDetection,gasDetectionComment,wellsSafetyCriticalEquipmentGapNotListed,verificationWellsSafetyCriticalEquipmentGapNotListed,swabProcedure,swabProcedureComment,wellCertified,wellCertifiedComment,slicklineBop,slicklineBopComment,slicklineBoom,slicklineBoomComment,sheavesInspected,sheavesInspectedComment,sheavesSecured,sheavesSecuredComment,swabTruck,swabTruckComment,swabTank,swabTankComment,downholeConditions,downholeConditionsComment,hydratePlan,hydratePlanComment,wellsSlicklineOrSwabGapNotListed,verificationWellsSlicklineOrSwabGapNotListed,snubbingProcedure,snubbingProcedureComment,equipmentRated,equipmentRatedComment,snubLoad,snubLoadComment,overPressure5,overPressure5Comment,fullOpening,fullOpeningComment,calibrationDocuments,calibrationDocumentsComment,craneControls,craneControlsComment,basketCertification,basketCertificationComment,musterPoint4,musterPoint4Comment,wellsSnubbingGapNotListed,verificationWellsSnubbingGapNotListed,accumulatorPosition,accumulatorPositionComment,remotePanel,remotePanelComment,lastInspection,lastInspectionComment,lastFunction,lastFunctionComment,closingValve,closingValveComment,hydraulicClosing,hydraulicClosingComment,surfaceAccumulator,surfaceAccumulatorComment,preCharge,preChargeComment,primaryPressure,primaryPressureComment,secondaryPressure,secondaryPressureComment,wellsWellControlAccumulatorSystemGapNotListed,verificationWellsWellControlAccumulatorSystemGapNotListed,ramHeight,ramHeightComment,tiwWrench2,tiwWrench2Comment,bopParts2,bopParts2Comment,hardShut,hardShutComment,tripSheets,tripSheetsComment,kickSheets,kickSheetsComment,flowChecks,flowChecksComment,drillerAuthority,drillerAuthorityComment,wellsWellControlDrillingGapNotListed,verificationWellsWellControlDrillingGapNotListed,approvedProcedure1,approvedProcedure1Comment,evidenceWell,evidenceWellComment,bopPressure,bopPressureComment,weeklyFunction2,weeklyFunction2Comment,bopParts1,bopParts1Comment,mechanicalBarriers,mechanicalBarriersComment,tiwWrench1,tiwWrench1Comment,checkValve,checkValveComment,manualValve,manualValveComment,weeklyDrills,weeklyDrillsComment,musterPoint2,musterPoint2Comment,wellsWellControlInterventionsGapNotListed,verificationWellsWellControlInterventionsGapNotListed,gapAssessmentNA,gapAssessmentBackToBasics,hazardAssessment,validWorkPermit,liftingOperations,atmosphericMonitoring,atmosphericMonitoringGapNotListed,workingAtHeights,personalProtectiveEquipment,drivingSafety,energyIsolation,basicsConfinedSpace,basicsConfinedSpaceGapNotListed,groundDisturbance,disablingSafetyEquipment,disablingSafetyEquipmentGapNotListed,actualConsequences,healthSafetyConsequencesLevel,environmentalConsequencesLevel,wellIntegrityConsequencesLevel,damagedLostValueConsequencesLevel,privilegeToOperateConsequencesLevel,deletedDatelday,deletedDateltime,createdDatelday,createdDateltime,modifiedDatelday,modifiedDateltime,serverCreatedDatelday,serverCreatedDateltime,serverModifiedDatelday,serverModifiedDateltime,eventOccurredDatelday,eventOccurredDateltime,adapterProcessedDate,seq,targetedVerification,eventOccurredDateLabel
 '''
 old_app_file = 'data/BPDataSafetyPlusOldApp.csv'
-old_reports = pd.read_csv(old_app_file, header=None, low_memory=False)
-old_reports.columns = old_safety_app_cols.split(',')
-old_reports.dropna(axis=1, how='all', inplace=True)
-
-
-
+old_app_columns = old_safety_app_cols.strip().split(',')
 
 
 new_safety_app_cols = '''
 businessUnit,wellFlac,name,_id,_rev,templateId,docType,deletedDate,distanceFromAssetInFeet,geoAccuracyInFeet,latitude,longitude,createdBy,createdDate,modifiedBy,modifiedDate,serverCreatedDate,serverModifiedDate,jobId,parentId,assetId,replicateTo,assetName,assetType,businessUnit,operatingCenter,area,event,eventClassification,eventType,eventTypeLabel,incidentDescription,eventOccurredDate,reportedTo,companyInvolved,companyInvolvedNotListed,operationOrDevelopment,jobTypeObserved,questionNumber,questionId,questionType,questionVerification,question,answerRadio,answerSelect,answerText,answerNumber,answerDetails,answerComments,answerIsMultiple,answerMultiple,questionList,additionalObservations,smartSearchObservations,otherSafetyObservationAnswer,otherSafetyObservationComment,immediateActionsTaken,actionCompletedOnsiteDetail,furtherActionNecessaryDetail,furtherActionNecessaryComments,stopJob,assetLatitude,assetLongitude,unitOfMeasure,replicateGroup,workManagementId,deletedDatelday,deletedDateltime,createdDatelday,createdDateltime,modifiedDatelday,modifiedDateltime,serverCreatedDatelday,serverCreatedDateltime,serverModifiedDatelday,serverModifiedDateltime,eventOccurredDatelday,eventOccurredDateltime,adapterProcessedDate,seq,answerRisk,otherSafetyObservationRisk,smartSearchObservationsTop,otherSafetyObservationCommentTop,otherSafetyObservationRiskTop,otherSafetyObservationAnswerTop,answerDate,safetyAppNumber,questionNumberText,reloadRisk
 '''
 new_app_file = 'data/BPDataSafetyPlusNewApp.csv'
-new_reports = pd.read_csv(new_app_file, header=None)
-new_reports.columns = new_safety_app_cols.split(',')
-new_reports.dropna(axis=1, how='all', inplace=True)
+new_app_columns = new_safety_app_cols.strip().split(',')
+
+cache_dir = 'my_data/cache'
+default_chunksize = 100000
+
+'''
+Parsing the exports is slow (the old one has 485 mostly empty columns), so the
+first load of each file is written to a parquet cache.  The cache file name
+includes the size and modification time of the export and the columns that
+were read, so a new export is parsed again and the stale cache is removed.
+
+Reading an export in chunks types each chunk on its own, and can't tell which
+columns are empty in the whole file.  column_types() finds both out in one
+pass over the file (remembered next to the parquet cache), so a chunked read
+can be given the same columns and dtypes as a read of the whole file.
+'''
+
+def cache_key(source_file, usecols=None):
+    stat = os.stat(source_file)
+    key = '{}-{}-{}'.format(stat.st_size, stat.st_mtime_ns,
+                            ','.join(sorted(usecols)) if usecols is not None else '')
+    return hashlib.md5(key.encode('utf-8')).hexdigest()[:12]
+
+def cache_path(source_file, usecols=None):
+    name = os.path.splitext(os.path.basename(source_file))[0]
+    return os.path.join(cache_dir, '{}-{}.parquet'.format(name, cache_key(source_file, usecols)))
+
+def remove_stale_caches(source_file):
+    # caches written before the export was last changed can never be hit again
+    name = os.path.splitext(os.path.basename(source_file))[0]
+    source_mtime = os.path.getmtime(source_file)
+    for path in glob.glob(os.path.join(cache_dir, '{}-*'.format(name))):
+        if os.path.getmtime(path) < source_mtime:
+            os.remove(path)
+
+def column_positions(columns, usecols=None):
+    if usecols is None:
+        return list(range(len(columns)))
+    wanted = set(usecols)
+    return [i for i, col in enumerate(columns) if col in wanted]
+
+def name_columns(reports, names):
+    reports.columns = names
+    # the new app export lists businessUnit twice, keep the one next to operatingCenter
+    return reports.loc[:, ~reports.columns.duplicated(keep='last')]
+
+def merged_type(kinds, missing):
+    '''
+    The dtype read_csv gives a whole column, from the dtype kinds of its
+    chunks and whether any of its values are missing.
+    '''
+    if 'O' in kinds or ('b' in kinds and (missing or len(kinds) > 1)):
+        return 'object'
+    if 'f' in kinds or ('i' in kinds and missing):
+        return 'float64'
+    return 'int64' if kinds == {'i'} else 'bool'
+
+def read_dtypes(columns, positions, types):
+    # the exports have no header, so read_csv is given dtypes by position
+    conversions = {'object': str, 'float64': float}
+    return {i: conversions[types[columns[i]]] for i in positions
+            if types.get(columns[i]) in conversions}
+
+def iter_export(source_file, columns, usecols=None, chunksize=default_chunksize,
+                types=None, **read_csv_kwargs):
+    '''
+    Yield one of the headerless exports in chunks of at most chunksize rows,
+    parsing only the columns in usecols.  Empty columns are not dropped, since
+    a column can be empty in one chunk and not in another.  chunksize can also
+    be a function that is called for the size of each chunk, so a caller can
+    shrink or grow the chunks as it goes.  types (from column_types) fixes the
+    dtype of each column, so every chunk is typed like the whole file.
+    '''
+    positions = column_positions(columns, usecols)
+    names = [columns[i] for i in positions]
+    if types is not None:
+        read_csv_kwargs['dtype'] = read_dtypes(columns, positions, types)
+    if not callable(chunksize):
+        chunks = pd.read_csv(source_file, header=None, usecols=positions,
+                             chunksize=chunksize, **read_csv_kwargs)
+        for chunk in chunks:
+            yield name_columns(chunk, names)
+        return
+    with pd.read_csv(source_file, header=None, usecols=positions, iterator=True,
+                     **read_csv_kwargs) as reader:
+        while True:
+            try:
+                chunk = reader.get_chunk(chunksize())
+            except StopIteration:
+                return
+            yield name_columns(chunk, names)
+
+def column_types(source_file, columns, usecols=None, chunksize=default_chunksize):
+    '''
+    The columns in usecols that aren't completely empty, in file order, with
+    the dtype each one gets when the whole export is read at once.  Found a
+    chunk at a time, and saved in the cache directory until the export changes.
+    '''
+    path = os.path.splitext(cache_path(source_file, usecols))[0] + '.types.json'
+    if os.path.isfile(path):
+        with open(path) as f:
+            return dict(json.load(f))
+    kinds = {}
+    missing = set()
+    with stage('load_original_data.column_types:' + os.path.basename(source_file)):
+        for chunk in iter_export(source_file, columns, usecols, chunksize):
+            for col in chunk.columns:
+                values = chunk[col]
+                nulls = values.isnull()
+                if nulls.any():
+                    missing.add(col)
+                if not nulls.all():
+                    kinds.setdefault(col, set()).add(values.dtype.kind)
+    names = [columns[i] for i in column_positions(columns, usecols)]
+    types = [(col, merged_type(kinds[col], col in missing))
+             for col in dict.fromkeys(names) if col in kinds]
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    with open(path, 'w') as f:
+        json.dump(types, f)
+    remove_stale_caches(source_file)
+    return dict(types)
+
+def uniform_text(reports):
+    '''
+    Columns of mixed numbers and text (answerNumber, or any column whose chunks
+    were typed separately) can't be written to parquet, so everything in the
+    object columns that isn't missing becomes text.
+    '''
+    conversions = {}
+    for col in reports.columns[reports.dtypes == object]:
+        values = reports[col]
+        conversions[col] = values.where(values.isnull(), values.astype(str))
+    return reports.assign(**conversions) if conversions else reports
+
+def read_export(source_file, columns, usecols=None, chunksize=None, **read_csv_kwargs):
+    '''
+    Read one of the headerless exports, name its columns and drop the columns
+    that are completely empty.  With a chunksize the file is parsed a chunk at
+    a time, so only the pruned columns are ever held in memory.
+    '''
+    with stage('load_original_data.read_export:' + os.path.basename(source_file)) as timer:
+        if chunksize is None:
+            positions = column_positions(columns, usecols)
+            reports = pd.read_csv(source_file, header=None, usecols=positions, **read_csv_kwargs)
+            reports = name_columns(reports, [columns[i] for i in positions])
+        else:
+            reports = pd.concat(iter_export(source_file, columns, usecols, chunksize,
+                                            **read_csv_kwargs), ignore_index=True)
+        timer.rows = len(reports)
+    return uniform_text(reports.dropna(axis=1, how='all'))
+
+def load_cached(source_file, columns, usecols=None, chunksize=None, use_cache=True,
+                **read_csv_kwargs):
+    if not use_cache:
+        return read_export(source_file, columns, usecols, chunksize, **read_csv_kwargs)
+    path = cache_path(source_file, usecols)
+    if os.path.isfile(path):
+        with stage('load_original_data.read_cache:' + os.path.basename(source_file)) as timer:
+            reports = pd.read_parquet(path)
+            timer.rows = len(reports)
+        return reports
+    reports = read_export(source_file, columns, usecols, chunksize, **read_csv_kwargs)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    reports.to_parquet(path, index=False)
+    remove_stale_caches(source_file)
+    return reports
+
+def load_old_reports(usecols=None, chunksize=None, use_cache=True):
+    return load_cached(old_app_file, old_app_columns, usecols, chunksize, use_cache,
+                       low_memory=False)
+
+def load_new_reports(usecols=None, chunksize=None, use_cache=True):
+    return load_cached(new_app_file, new_app_columns, usecols, chunksize, use_cache)
+
+def old_column_types(usecols=None):
+    return column_types(old_app_file, old_app_columns, usecols)
+
+def iter_old_reports(usecols=None, chunksize=default_chunksize, types=None):
+    return iter_export(old_app_file, old_app_columns, usecols, chunksize, types)
+
+def new_column_types(usecols=None):
+    return column_types(new_app_file, new_app_columns, usecols)
 
+def iter_new_reports(usecols=None, chunksize=default_chunksize, types=None):
+    return iter_export(new_app_file, new_app_columns, usecols, chunksize, types)
 
 
 if __name__ == '__main__':
+    old_reports = load_old_reports()
+    new_reports = load_new_reports()
     print('''
     The safety app data is located in variables old_reports and new_reports.
     ''')
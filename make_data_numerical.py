@@ -1,16 +1,86 @@
+import os
 import numpy as np
 import pandas as pd
-import pickle
+import json
+from concurrent.futures import ProcessPoolExecutor
+from svd_model import load_transformer
+from event_types import meaningful_types, mask_column, event_masks, type_dummies
+from combined_store import read_combined
+import instrumentation
+
+'''
+Every one-hot feature has a pinned vocabulary, so a batch always gets the same
+columns in the same order no matter which values happen to appear in it.  The
+replicateGroup vocabulary comes from the data and is saved in schema_file; if
+there isn't one yet, it is built from the combined reports the first time a
+feature needs it, never from whichever reports are in the batch.
+'''
+schema_file = 'my_data/feature_schema.json'
+
+default_schema = {
+    'immediateActionsTaken': ['Action Completed Onsite',
+                              'Further Action Necessary',
+                              'No Action Necessary',
+                              'Stop the Job'],
+    'assetType': ['Well', 'Facility'],
+    'jobType': ['Automation',
+                'Completions',
+                'Construction',
+                'Drilling',
+                'Maintenance',
+                'Operations',
+                'Well Intervention'],
+    'eventType': list(meaningful_types),
+    'replicateGroup': None
+}
+
+one_hot_features = ['immediateActionsTaken', 'assetType', 'jobType', 'eventType', 'replicateGroup']
+
+_schema = None
+
+def build_feature_schema(reports):
+    schema = dict(default_schema)
+    schema['replicateGroup'] = sorted(reports.replicateGroup.dropna().astype(str).unique())
+    return schema
+
+def save_feature_schema(schema):
+    global _schema
+    with open(schema_file, 'w') as f:
+        json.dump(schema, f, indent=4)
+    _schema = schema
+
+def get_feature_schema():
+    global _schema
+    if _schema is None:
+        if os.path.isfile(schema_file):
+            with open(schema_file) as f:
+                _schema = json.load(f)
+        else:
+            reports = read_combined(columns=['replicateGroup'])
+            if len(reports) == 0:
+                raise ValueError('there is no {} and no combined reports to build it from; '
+                                 'run combine_data.py first'.format(schema_file))
+            save_feature_schema(build_feature_schema(reports))
+    return _schema
+
+def one_hot(values, feature):
+    '''
+    uint8 dummies with one column per value in the feature's vocabulary.  Values
+    outside the vocabulary get a row of zeros.
+    '''
+    vocabulary = get_feature_schema()[feature]
+    categories = pd.Series(pd.Categorical(values, categories=vocabulary), index=values.index)
+    return pd.get_dummies(categories, dtype=np.uint8)
 
 def daysBeforeModification(reports):
     created = pd.to_datetime(reports['serverCreatedDate'])
     modified = pd.to_datetime(reports['serverModifiedDate'])
     delta = modified - created
-    days = delta.apply(lambda dt: dt.days)
-    return pd.DataFrame(days.astype(int), columns=['daysBeforeModification'])
+    days = delta.dt.days.astype(np.int32)
+    return pd.DataFrame({'daysBeforeModification': days})
 
 def transfered(reports):
-    df =  pd.DataFrame(reports['modifiedBy'] != reports['createdBy']).astype(int)
+    df =  pd.DataFrame(reports['modifiedBy'] != reports['createdBy']).astype(np.uint8)
     df.columns = ['transfered']
     return df
 
@@ -30,31 +100,10 @@ def jobType(reports):
         jobTypeObserved_dict['Produced Fluid Management'] = 'Other'
         jobTypeObserved_dict['Rig Move'] = 'Other'
     jobType = reports['jobTypeObserved'].map(jobTypeObserved_dict)
-    d =  pd.get_dummies(jobType)
-    wanted_cols = ['Automation',
-                    'Completions',
-                    'Construction',
-                    'Drilling',
-                    'Maintenance',
-                    'Operations',
-                    'Well Intervention']
-    for col in wanted_cols:
-        if col not in d.columns:
-            d[col] = np.zeros(len(d))
-    d = d[wanted_cols]
-    return d
+    return one_hot(jobType, 'jobType')
 
 def eventType(reports):
-    shared_events = {'Fire/Explosion',
-                     'Injury/Illness',
-                     'Material Release',
-                     'Near Miss',
-                     'Property Damage',
-                     'Security'}
-    event_dummies = pd.DataFrame()
-    for col in shared_events:
-        event_dummies[col] = reports.eventType.apply(lambda s: col in s).astype(int)
-    return event_dummies
+    return type_dummies(event_masks(reports), get_feature_schema()['eventType'])
 
 from string import whitespace
 def count_non_whitespace(s):
@@ -68,8 +117,7 @@ def incidentDescriptionLength(reports):
     return l
 
 def incidentDescription(reports):
-    with open('SVD_pipe.pkl', 'rb') as f:
-        pipe = pickle.load(f)
+    pipe = load_transformer()
     coords = pd.DataFrame(index=reports.index)
     coords_arrays = pipe.transform(reports.incidentDescription.astype(str))
     coords['description_x'] = coords_arrays[:,3]
@@ -77,45 +125,143 @@ def incidentDescription(reports):
     return coords
 
 def isBP(reports):
-    df =  pd.DataFrame((reports['companyInvolved'] == 'BP').astype(int))
+    df =  pd.DataFrame((reports['companyInvolved'] == 'BP').astype(np.uint8))
     df.columns = ['isBP']
     return df
 
 
 def immediateActionsTaken(reports):
-    return pd.get_dummies(reports.immediateActionsTaken)
+    return one_hot(reports.immediateActionsTaken, 'immediateActionsTaken')
 
 def assetType(reports):
-    return pd.get_dummies(reports.assetType)[['Well', 'Facility']]
+    return one_hot(reports.assetType, 'assetType')
 
 def replicateGroup(reports):
-    return pd.get_dummies(reports.replicateGroup)
+    return one_hot(reports.replicateGroup.astype(str).where(reports.replicateGroup.notnull()),
+                   'replicateGroup')
 
 def serverCreatedDate(reports):
     return pd.to_datetime(reports['serverCreatedDate'])
 
 def latlon(reports):
-    return reports[['latitude', 'longitude']].fillna(0)
+    return reports[['latitude', 'longitude']].fillna(0).astype(np.float32)
 
 def event(reports):
     return pd.DataFrame(reports.event.map({'Observation': 0, 'Incident': 1}))
 
-def concat(reports):
-    df = pd.DataFrame(index=reports.index)
-    my_cols = ['serverCreatedDate',
-               'daysBeforeModification',
-               'incidentDescription',
-               'immediateActionsTaken',
-               'transfered',
-               'assetType',
-               'jobType',
-               'eventType',
-               'isBP',
-               'replicateGroup',
-               'latlon']
-    for col in my_cols:
-        df = pd.concat([df, globals()[col](reports)], axis=1)
-    return df
+feature_functions = {
+    'serverCreatedDate': serverCreatedDate,
+    'daysBeforeModification': daysBeforeModification,
+    'incidentDescription': incidentDescription,
+    'incidentDescriptionLength': incidentDescriptionLength,
+    'immediateActionsTaken': immediateActionsTaken,
+    'transfered': transfered,
+    'assetType': assetType,
+    'jobType': jobType,
+    'eventType': eventType,
+    'isBP': isBP,
+    'replicateGroup': replicateGroup,
+    'latlon': latlon,
+    'event': event
+}
+
+# the columns each feature reads, so a worker is only sent those
+feature_columns = {
+    'serverCreatedDate': ['serverCreatedDate'],
+    'daysBeforeModification': ['serverCreatedDate', 'serverModifiedDate'],
+    'incidentDescription': ['incidentDescription'],
+    'incidentDescriptionLength': ['incidentDescription'],
+    'immediateActionsTaken': ['immediateActionsTaken'],
+    'transfered': ['modifiedBy', 'createdBy'],
+    'assetType': ['assetType'],
+    'jobType': ['jobTypeObserved'],
+    'eventType': [mask_column],
+    'isBP': ['companyInvolved'],
+    'replicateGroup': ['replicateGroup'],
+    'latlon': ['latitude', 'longitude'],
+    'event': ['event']
+}
+
+def feature_input(reports, name):
+    columns = feature_columns[name]
+    if name == 'eventType' and mask_column not in reports.columns:
+        # event_masks parses eventType when there's no mask column
+        columns = ['eventType']
+    return reports[columns]
+
+default_features = ['serverCreatedDate',
+                    'daysBeforeModification',
+                    'incidentDescription',
+                    'immediateActionsTaken',
+                    'transfered',
+                    'assetType',
+                    'jobType',
+                    'eventType',
+                    'isBP',
+                    'replicateGroup',
+                    'latlon']
+
+def build_feature(task):
+    '''
+    Build one feature, and hand back any stage timings along with it, since a
+    worker process can't add them to its parent's trace itself.
+    '''
+    name, reports, trace_settings = task
+    if trace_settings is not None and not instrumentation.is_enabled():
+        instrumentation.enable(**trace_settings)
+    with instrumentation.stage('make_data_numerical.' + name, len(reports)):
+        feature = feature_functions[name](reports)
+    return feature, instrumentation.drain() if trace_settings is not None else []
+
+def stack_chunks(parts):
+    '''
+    Put the chunks of one feature back together.  A dummy column that is
+    missing from a chunk means none of its rows had that value.
+    '''
+    if len(parts) == 1:
+        return parts[0]
+    stacked = pd.concat(parts)
+    if isinstance(stacked, pd.DataFrame):
+        in_every_part = set.intersection(*[set(part.columns) for part in parts])
+        missing = [col for col in stacked.columns if col not in in_every_part]
+        stacked[missing] = stacked[missing].fillna(0)
+    return stacked
+
+def concat(reports, features=default_features, n_jobs=1, chunksize=None, sparse=False):
+    '''
+    Build each feature and put them side by side.  The features don't depend on
+    each other, so with n_jobs > 1 they are built in a pool of processes, and
+    with a chunksize each feature is also built on chunks of that many rows.
+    With sparse=True the one-hot columns are stored as sparse uint8.
+    '''
+    if chunksize is None:
+        chunks = [reports]
+    else:
+        chunks = [reports.iloc[i:i + chunksize] for i in range(0, len(reports), chunksize)]
+    trace_settings = instrumentation.settings()
+    # load (or build) the schema once here, rather than in every worker
+    get_feature_schema()
+    with instrumentation.stage('make_data_numerical.concat', len(reports)):
+        if n_jobs == 1:
+            # built in this process, so the stages are recorded here and there's nothing to hand back
+            tasks = [(name, chunk, None) for name in features for chunk in chunks]
+            built = list(map(build_feature, tasks))
+        else:
+            # each task is pickled to a worker, so only send the columns its feature reads
+            tasks = [(name, feature_input(chunk, name), trace_settings)
+                     for name in features for chunk in chunks]
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                built = list(pool.map(build_feature, tasks))
+    results = []
+    for feature, records in built:
+        results.append(feature)
+        instrumentation.extend(records)
+    frames = [stack_chunks(results[i * len(chunks):(i + 1) * len(chunks)])
+              for i in range(len(features))]
+    if sparse:
+        frames = [frame.astype(pd.SparseDtype(np.uint8, 0)) if name in one_hot_features else frame
+                  for name, frame in zip(features, frames)]
+    return pd.concat(frames, axis=1)
 
 def selective_concat(reports):
     return pd.concat([event(reports),
@@ -124,6 +270,8 @@ def selective_concat(reports):
                    incidentDescriptionLength(reports)], axis=1)
 
 if __name__ == '__main__':
-    reports = pd.read_csv('my_data/combined_reports.csv').set_index('seq')
-    numeric_reports = concat(reports)
+    reports = read_combined().set_index('seq')
+    if not os.path.isfile(schema_file):
+        save_feature_schema(build_feature_schema(reports))
+    numeric_reports = concat(reports, n_jobs=os.cpu_count())
     numeric_reports.to_csv('my_data/numeric_reports.csv')
@@ -0,0 +1,220 @@
+import os
+import gc
+import shutil
+import argparse
+import resource
+import numpy as np
+import pandas as pd
+from instrumentation import stage
+from load_original_data import default_chunksize
+from combine_data import stream_centroids, stream_replicate_groups, iter_combined_data,\
+                         centroids_file, manifest_file, manifest_columns
+from make_data_numerical import schema_file, build_feature_schema, save_feature_schema, concat
+from scorer import ReportSorter, artifact_file
+from combined_store import combined_dir, write_partitions, replace_store
+
+'''
+Run the whole history through combine -> features -> scores a chunk of an
+export at a time, instead of running combine_data, make_data_numerical and
+scorer one after the other on whole files.  Each chunk goes from one stage to
+the next as a DataFrame and is appended to the outputs as soon as it's done:
+
+    <output_dir>/combined_reports/       the month-partitioned store
+    <output_dir>/combined_manifest.csv
+    <output_dir>/numeric_reports.csv
+    <output_dir>/scores.csv              seq, _id, action, flag, typeCount, score
+
+The outputs are written next to their final paths and only moved into place
+once every chunk has been processed, so a failed run leaves the old files alone.
+
+With a memory limit, the chunk size is adjusted as the run goes: after each
+chunk the memory it took per row is measured, and the next chunk is made as
+large as fits in what is left under the limit (with some headroom, and leaving
+room for a copy of the chunk in each feature worker).  The new export is read
+through the same chunk sizes after the old one; the replicateGroup centroids
+the old reports need are found first, in a pass over three of its columns,
+and the replicateGroup vocabulary of the features (if there isn't one yet) in
+a pass over that column of both exports.
+
+Scoring needs the scorer artifact (python scorer.py --build-artifact), since
+fitting the scorer reads the combined reports this writes.
+'''
+
+min_chunksize = 1000
+max_chunksize = 1000000
+# only plan to use this much of what's left under the memory limit
+headroom = 0.8
+
+
+def current_rss():
+    '''
+    The process's resident memory in bytes, or its peak if /proc isn't there.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ChunkSizer(object):
+    '''
+    Passed to iter_combined_data as the chunksize, so it is asked for the size
+    of each chunk just before the chunk is read.
+    '''
+
+    def __init__(self, chunksize=default_chunksize, memory_limit=None, n_jobs=1):
+        '''
+        memory_limit is in bytes.  With one, chunksize is only the size of the
+        first chunk, which the rest are sized from.
+        '''
+        self.chunksize = chunksize if memory_limit is None else min(chunksize, 10000)
+        self.memory_limit = memory_limit
+        self.copies = 1 + (n_jobs if n_jobs > 1 else 0)
+        self.bytes_per_row = None
+        self.baseline = self.peak = current_rss()
+
+    def __call__(self):
+        self.baseline = self.peak = current_rss()
+        return self.chunksize
+
+    def observe(self):
+        self.peak = max(self.peak, current_rss())
+
+    def chunk_done(self, rows):
+        self.observe()
+        if self.memory_limit is None or rows == 0:
+            return
+        per_row = max(self.peak - self.baseline, 1) / float(rows)
+        # memory that was freed isn't always handed back, so don't trust a
+        # single chunk that looked cheap
+        if self.bytes_per_row is not None:
+            per_row = max(per_row, 0.5 * self.bytes_per_row)
+        self.bytes_per_row = per_row
+        available = headroom * self.memory_limit - current_rss()
+        rows_that_fit = int(available / (self.bytes_per_row * self.copies))
+        self.chunksize = int(np.clip(rows_that_fit, min_chunksize, max_chunksize))
+
+
+class ChunkWriter(object):
+    '''
+    Appends chunks to path + '.partial', which finish() moves to path.
+    '''
+
+    def __init__(self, path, index=False):
+        self.path = path
+        self.partial_path = path + '.partial'
+        self.index = index
+        self.rows = 0
+
+    def write(self, frame):
+        frame.to_csv(self.partial_path, index=self.index, mode='w' if self.rows == 0 else 'a',
+                     header=self.rows == 0)
+        self.rows += len(frame)
+
+    def finish(self):
+        if self.rows:
+            os.replace(self.partial_path, self.path)
+
+
+class StoreWriter(ChunkWriter):
+    '''
+    Adds chunks to a combined store at path + '.partial', which finish() puts
+    in place of the store at path.
+    '''
+
+    def __init__(self, path):
+        ChunkWriter.__init__(self, path)
+        if os.path.isdir(self.partial_path):
+            shutil.rmtree(self.partial_path)
+
+    def write(self, frame):
+        write_partitions(frame, self.partial_path)
+        self.rows += len(frame)
+
+    def finish(self):
+        if self.rows:
+            replace_store(self.partial_path, self.path)
+
+
+def score_frame(reports, sorter):
+    flags, type_counts, scores = sorter.review_keys(reports)
+    return pd.DataFrame({'seq': reports.seq.values,
+                         '_id': reports._id.values,
+                         'immediateActionsTaken': reports.immediateActionsTaken.values,
+                         'flag': flags,
+                         'typeCount': type_counts,
+                         'score': scores})
+
+def run_pipeline(output_dir='my_data', chunksize=default_chunksize, memory_limit=None,
+                 n_jobs=1, features=True, scores=True, artifact=artifact_file):
+    '''
+    Combine, build features for and score every report, a chunk at a time.
+    memory_limit is in bytes.  Returns the number of reports processed.
+    '''
+    with stage('pipeline.centroids'):
+        centroids = stream_centroids(chunksize)
+    centroids.to_csv(centroids_file)
+    if features and not os.path.isfile(schema_file):
+        # from every report, like make_data_numerical's, so the columns don't depend
+        # on which of them wrote the schema
+        with stage('pipeline.replicate_groups'):
+            groups = stream_replicate_groups(chunksize)
+        save_feature_schema(build_feature_schema(groups))
+    sorter = ReportSorter.from_artifact(artifact) if scores else None
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    writers = {'combined': StoreWriter(os.path.join(output_dir,
+                                                    os.path.basename(combined_dir))),
+               'manifest': ChunkWriter(os.path.join(output_dir,
+                                                    os.path.basename(manifest_file))),
+               'numeric': ChunkWriter(os.path.join(output_dir, 'numeric_reports.csv'),
+                                      index=True),
+               'scores': ChunkWriter(os.path.join(output_dir, 'scores.csv'))}
+    sizer = ChunkSizer(chunksize, memory_limit, n_jobs)
+    total = 0
+    for chunk in iter_combined_data(sizer, centroids):
+        rows = len(chunk)
+        sizer.observe()
+        with stage('pipeline.write_combined', rows):
+            writers['combined'].write(chunk)
+            writers['manifest'].write(chunk[manifest_columns])
+        if features:
+            with stage('pipeline.features', rows):
+                numeric = concat(chunk.set_index('seq'), n_jobs=n_jobs)
+                sizer.observe()
+                writers['numeric'].write(numeric)
+            del numeric
+        if scores:
+            with stage('pipeline.scores', rows):
+                writers['scores'].write(score_frame(chunk, sorter))
+        sizer.chunk_done(rows)
+        total += rows
+        print('{:>10} reports  next chunk {:>8}  rss {:8.1f} MB'.format(
+                  total, sizer.chunksize, current_rss() / 2.0**20))
+        del chunk
+        gc.collect()
+    for writer in writers.values():
+        writer.finish()
+    return total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Combine, featurize and score every report '
+                                                 'a chunk at a time.')
+    parser.add_argument('--output-dir', default='my_data')
+    parser.add_argument('--chunksize', type=int, default=default_chunksize,
+                        help='rows of an export per chunk (the first chunk, with '
+                             '--memory-limit)')
+    parser.add_argument('--memory-limit', type=float, default=None, metavar='MB',
+                        help='size the chunks to keep the process under this much memory')
+    parser.add_argument('--n-jobs', type=int, default=1,
+                        help='processes to build the features of each chunk in')
+    parser.add_argument('--skip-features', action='store_true')
+    parser.add_argument('--skip-scores', action='store_true')
+    parser.add_argument('--artifact', default=artifact_file)
+    args = parser.parse_args()
+    memory_limit = args.memory_limit * 2**20 if args.memory_limit is not None else None
+    run_pipeline(args.output_dir, args.chunksize, memory_limit, args.n_jobs,
+                 features=not args.skip_features, scores=not args.skip_scores,
+                 artifact=args.artifact)
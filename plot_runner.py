@@ -0,0 +1,154 @@
+import os
+import time
+import argparse
+import matplotlib
+# workers only ever save figures, so never try to open a window
+matplotlib.use('Agg')
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import plots
+from instrumentation import stage
+from scorer import description_coordinates, get_coefficients_of_line
+from combined_store import combined_dir, read_combined
+
+'''
+Regenerate the plots directory in one go.  The combined reports, the graded
+reports and the SVD coordinates of both are loaded once into a
+PlotContext, and the figures are then drawn side by side in worker processes
+that all start from that context, so the whole run takes about as long as the
+slowest figure.
+
+    python plot_runner.py
+    python plot_runner.py --figures types_over_time svd_3d --comments 20469574:grayscale
+'''
+
+class PlotContext(object):
+
+    def __init__(self, reports_path=combined_dir, graded_path='my_data/graded.csv',
+                 density=False):
+        '''
+        density is passed on to the SVD scatter plots.
+        '''
+        reports = read_combined(reports_path).set_index('seq')
+        self.reports = reports
+        described = reports.incidentDescription.notnull().values
+        # one row per report, NaN for the reports without a description
+        self.coordinates = np.full((len(reports), 4), np.nan)
+        self.coordinates[described] = description_coordinates(
+            reports.incidentDescription[described], reports.index[described])
+        self.graded = pd.read_csv(graded_path)
+        self.graded_coordinates = description_coordinates(
+            self.graded.incidentDescription.astype(str))
+        self.line = get_coefficients_of_line()
+        self.density = density
+
+    def svd_data(self):
+        return {'reports': self.reports,
+                'coordinates': self.coordinates,
+                'graded': self.graded,
+                'graded_coordinates': self.graded_coordinates}
+
+
+def types_over_time(context, directory):
+    plots.reports_by_type(context.reports, os.path.join(directory, 'types_over_time.png'))
+
+def time_histograms(context, directory):
+    plots.time_plots(context.reports, directory)
+
+def action_completed_onsite_with_line(context, directory):
+    plots.plot_completed_line(2, 3, context.density, line=context.line, **context.svd_data())
+    plt.savefig(os.path.join(directory, 'action_completed_onsite_with_line.png'))
+
+def action_completed_onsite_test(context, directory):
+    plots.plot_data_and_test('Action Completed Onsite', density=context.density,
+                             **context.svd_data())
+    plt.savefig(os.path.join(directory, 'action_completed_onsite_test.png'))
+
+def no_action_necessary_test(context, directory):
+    plots.plot_data_and_test('No Action Necessary', density=context.density,
+                             **context.svd_data())
+    plt.savefig(os.path.join(directory, 'no_action_necessary_test.png'))
+
+def svd_3d(context, directory):
+    plots.plot_3d(context.density, path=os.path.join(directory, 'svd_3d.png'),
+                  **context.svd_data())
+
+def comment_picture(context, directory, seq, strand):
+    plots.save_comment_pic(seq, strand, context.reports, context.coordinates, directory,
+                           show=False)
+
+figures = {'types_over_time': types_over_time,
+           'time_histograms': time_histograms,
+           'action_completed_onsite_with_line': action_completed_onsite_with_line,
+           'action_completed_onsite_test': action_completed_onsite_test,
+           'no_action_necessary_test': no_action_necessary_test,
+           'svd_3d': svd_3d}
+
+
+_context = None
+
+def set_context(context):
+    global _context
+    _context = context
+
+def draw(task):
+    '''
+    Draw one figure from the context this process was started with, and return
+    its name and how long it took.
+    '''
+    name, directory, args = task
+    if name == 'comment':
+        name, function = '{1}_{0}'.format(*args), comment_picture
+    else:
+        function = figures[name]
+    started = time.perf_counter()
+    with stage('plot_runner.' + name):
+        function(_context, directory, *args)
+        plt.close('all')
+    return name, time.perf_counter() - started
+
+def comment_task(comment, directory):
+    '''
+    A comment picture given as 'seq:strand'.
+    '''
+    seq, strand = comment.split(':', 1)
+    return ('comment', directory, (int(seq), strand))
+
+def run_plots(context, names=None, comments=(), directory='plots', n_jobs=None):
+    '''
+    Draw the named figures (all of them by default) and a comment picture for
+    each 'seq:strand' in comments, and return how long each took.
+    '''
+    names = list(figures) if names is None else names
+    tasks = [(name, directory, ()) for name in names]
+    tasks += [comment_task(comment, directory) for comment in comments]
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    n_jobs = min(n_jobs or os.cpu_count(), len(tasks))
+    if n_jobs <= 1:
+        set_context(context)
+        return dict(map(draw, tasks))
+    # forked workers start from the parent's copy of the context instead of unpickling it
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=set_context,
+                             initargs=(context,)) as pool:
+        futures = [pool.submit(draw, task) for task in tasks]
+        return dict(future.result() for future in as_completed(futures))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Draw the plots from one load of the data.')
+    parser.add_argument('--figures', nargs='*', choices=sorted(figures), default=None,
+                        help='which figures to draw (default: all of them)')
+    parser.add_argument('--comments', nargs='*', default=[], metavar='SEQ:STRAND',
+                        help='also save a comment picture for each of these reports')
+    parser.add_argument('--directory', default='plots')
+    parser.add_argument('--n-jobs', type=int, default=None)
+    parser.add_argument('--density', action='store_true',
+                        help='draw density images instead of scattering every report')
+    args = parser.parse_args()
+    context = PlotContext(density=args.density)
+    timings = run_plots(context, args.figures, args.comments, args.directory, args.n_jobs)
+    for name, seconds in sorted(timings.items(), key=lambda item: -item[1]):
+        print('{:<40} {:8.2f}s'.format(name, seconds))
@@ -1,19 +1,61 @@
+import os
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgba_array
+from matplotlib.patches import Patch
 from mpl_toolkits.mplot3d import Axes3D
 import pickle
-from datetime import datetime, timedelta
-from scorer import get_pipeline, get_coefficients_of_line, closest_point_on_line
+from datetime import timedelta
+from scorer import get_pipeline, get_coefficients_of_line, closest_point_on_line,\
+                   description_coordinates
+from report_store import get_report_store
+from combined_store import read_combined
+from rollups import get_rollups, report_counts, type_counts
 from nltk.corpus import stopwords
 
-def reports_by_type():
+'''
+Each plot reads what it needs itself, unless it's handed the reports (indexed
+by seq), the graded reports or their SVD coordinates, which is how plot_runner
+makes every figure from one load of the data.
+'''
+
+def read_reports(columns=None):
+    return read_combined(columns=columns).set_index('seq')
+
+def read_graded():
+    return pd.read_csv('my_data/graded.csv')
+
+def labeled_reports(reports=None, coordinates=None):
+    '''
+    The reports that have an action and a description, and their coordinates.
+    coordinates, if given, has a row for every report in reports.
+    '''
+    if reports is None:
+        reports = read_reports(['seq', 'immediateActionsTaken', 'incidentDescription'])
+    keep = (reports.immediateActionsTaken.notnull() & reports.incidentDescription.notnull()).values
+    reports = reports[keep]
+    if coordinates is None:
+        return reports, description_coordinates(reports.incidentDescription, reports.index)
+    return reports, coordinates[keep]
+
+def graded_with_tag(tag, graded=None, graded_coordinates=None):
+    if graded is None:
+        graded = read_graded()
+    keep = (graded.immediateActionsTaken == tag).values
+    graded = graded[keep]
+    if graded_coordinates is None:
+        return graded, description_coordinates(graded.incidentDescription.astype(str))
+    return graded, graded_coordinates[keep]
+
+def reports_by_type(reports=None, path='plots/types_over_time.png'):
     '''
     Make a stacked bar graph for each operating center showing how many reports
-    came in of each time during each month.
+    came in of each time during each month.  The counts come from the rollup
+    cube, unless reports are given to count.
     '''
-    reports = pd.read_csv('my_data/combined_reports.csv')
-    reports.dropna(subset=['operatingCenter'], inplace=True)
+    cube = get_rollups() if reports is None else report_counts(reports)
+    cube = cube[cube.operatingCenter != 'Unknown']
     # The new reports has some very granular new types, but not enough to try to plot
     shared_events = {'Hazard Identification': 'red',
              'Material Release': 'orange',
@@ -21,21 +63,15 @@ def reports_by_type():
              'Property Damage': 'purple',
              'Security': 'yellow',
              'Verification': 'teal'}
-    type_dummies = pd.DataFrame([reports.operatingCenter]).T
-    for event in shared_events.keys():
-        type_dummies[event] = reports.eventType.apply(lambda s: event in s).astype(int)
-    dates = pd.to_datetime(reports.serverCreatedDate)
-    months = dates.apply(lambda d: datetime(d.year, d.month, 1))
-    type_dummies['month'] = months
-    type_counts = type_dummies.groupby(['operatingCenter', 'month']).sum()
-    min_month = type_dummies.month.min()
-    max_month = type_dummies.month.max()
+    counts = type_counts(cube, events=shared_events)
+    min_month = cube.month.min()
+    max_month = cube.month.max()
     active_sites = ['Wamsutter', 'East Texas', 'Farmington', 'Anadarko', 'Durango',
        'Arkoma']
     f, axes = plt.subplots(len(active_sites), 1, figsize=(12, 16))
     for index, group in enumerate(active_sites):
         ax = axes[index]
-        tc = type_counts.loc[group]
+        tc = counts.loc[group]
         N = tc.shape[0]
         bottom = np.zeros(N)
         for t in shared_events:
@@ -51,71 +87,143 @@ def reports_by_type():
             handles, labels = ax.get_legend_handles_labels()
             ax.legend(handles[::-1], labels[::-1], title='Line', loc='upper right')
     plt.tight_layout()
-    plt.savefig('plots/types_over_time.png')
+    plt.savefig(path)
 
-def time_plots():
+def time_plots(reports=None, directory='plots'):
     '''
     Save a set of histograms related to the time columns of reports.
     '''
-    reports = pd.read_csv('my_data/combined_reports.csv')
-    reports['serverCreatedDate'] = pd.to_datetime(reports.serverCreatedDate)
-    reports['serverModifiedDate'] = pd.to_datetime(reports.serverModifiedDate)
-    reports['adapterProcessedDate'] = pd.to_datetime(reports.adapterProcessedDate)
-    days_until_modified = \
-        (reports.serverModifiedDate - reports.serverCreatedDate).apply(lambda d: d.days)
-    days_until_adapted = \
-        (reports.adapterProcessedDate - reports.serverCreatedDate).apply(lambda d: d.days)
+    if reports is None:
+        reports = read_reports(['seq', 'serverCreatedDate', 'serverModifiedDate',
+                                'adapterProcessedDate'])
+    created = pd.to_datetime(reports.serverCreatedDate)
+    modified = pd.to_datetime(reports.serverModifiedDate)
+    adapted = pd.to_datetime(reports.adapterProcessedDate)
+    days_until_modified = (modified - created).dt.days
+    days_until_adapted = (adapted - created).dt.days
     days_until_modified.hist()
     plt.title('Days From Created To Modified')
     plt.xlabel('Days')
     plt.ylabel('Number of Reports')
-    plt.savefig('plots/created_to_modified_hist.png')
+    plt.savefig(os.path.join(directory, 'created_to_modified_hist.png'))
     plt.close()
     days_until_modified_two_weeks = days_until_modified[days_until_modified <= 14]
     days_until_modified_two_weeks.hist()
     plt.title('Days From Created To Modified--Two Weeks')
     plt.xlabel('Days')
     plt.ylabel('Number of Reports')
-    plt.savefig('plots/created_to_modified_hist_first_two_weeks.png')
+    plt.savefig(os.path.join(directory, 'created_to_modified_hist_first_two_weeks.png'))
     plt.close()
     days_until_adapted.hist()
     plt.title('Days From Created Until Put In Database')
     plt.xlabel('Days')
     plt.ylabel('Number of Reports')
-    plt.savefig('plots/days_until_database.png')
+    plt.savefig(os.path.join(directory, 'days_until_database.png'))
     plt.close()
-    reports.adapterProcessedDate.hist()
+    adapted.hist()
     plt.title('Adapter Processed Date')
     plt.xlabel('Days')
     plt.ylabel('Number of Reports')
-    plt.savefig('plots/adapter_processed.png')
+    plt.savefig(os.path.join(directory, 'adapter_processed.png'))
     plt.close()
 
-def scatter_and_legend(point_size=1, x=3, y=1):
-    '''
-    Plot the incident descriptions in the x-y plane using coordinates from pipe_SVD
-    where Stop the Job is in red, Further Action Necessary is in green,
-    Action Completed Onsite is in orange, and No Action Necessary is in blue.
-    '''
-    pipe_SVD = get_pipeline()
-    reports = pd.read_csv('my_data/combined_reports.csv').set_index('seq')
-    reports.dropna(subset=['immediateActionsTaken', 'incidentDescription'], inplace=True)
-    coordinates = pipe_SVD.transform(reports.incidentDescription)[:, [x, y]]
-    x_coords, y_coords = coordinates[:,0], coordinates[:,1]
-    actions = ['No Action Necessary', 'Action Completed Onsite',
-               'Further Action Necessary', 'Stop the Job']
-    color_map = {
+# drawn in this order, so Stop the Job ends up on top
+actions = ['No Action Necessary', 'Action Completed Onsite',
+           'Further Action Necessary', 'Stop the Job']
+action_colors = {
                 'Stop the Job': 'black',
                 'Further Action Necessary': 'green',
                 'Action Completed Onsite': 'orange',
                 'No Action Necessary': 'blue'
                 }
+
+'''
+With the full history, scattering every report takes minutes and most of the
+points land on top of each other.  In density mode the coordinates are binned
+into a histogram per action in one pass instead, and the histograms are drawn
+as a single image, so drawing costs the same however many reports there are.
+'''
+
+def bin_positions(values, low, high, bins):
+    '''
+    Which of bins equal bins between low and high each value falls in, or -1.
+    '''
+    width = (high - low) / bins if high > low else 1.0
+    with np.errstate(invalid='ignore'):
+        positions = np.floor((values - low) / width)
+    positions[values == high] = bins - 1
+    positions[~((positions >= 0) & (positions < bins))] = -1
+    return positions.astype(np.int64)
+
+def action_histograms(coordinates, report_actions, bins, extent=None):
+    '''
+    Counts of each action's reports in a bins^d grid over the d columns of
+    coordinates, as an array of shape (len(actions), bins, ..., bins) with the
+    last column varying fastest.  extent is (low, high) for each column.
+    '''
+    if extent is None:
+        extent = [(np.nanmin(column), np.nanmax(column)) for column in coordinates.T]
+    flat = pd.Categorical(report_actions, categories=actions).codes.astype(np.int64)
+    keep = flat >= 0
+    for column, (low, high) in zip(coordinates.T, extent):
+        positions = bin_positions(column, low, high, bins)
+        keep &= positions >= 0
+        flat = flat * bins + positions
+    counts = np.bincount(flat[keep], minlength=len(actions) * bins ** coordinates.shape[1])
+    return counts.reshape((len(actions),) + (bins,) * coordinates.shape[1]), extent
+
+def density_alpha(counts):
+    # log scaled, so the sparse outskirts still show up next to the dense strands
+    return np.log1p(counts) / np.log1p(max(counts.max(), 1))
+
+def composite_histograms(histograms):
+    '''
+    Lay each action's histogram over the ones before it as a colored layer
+    whose opacity follows the (log) density, and return the RGBA image.
+    '''
+    alpha = density_alpha(histograms)
+    image = np.zeros(histograms.shape[1:] + (4,))
+    for layer, color in zip(alpha, to_rgba_array([action_colors[a] for a in actions])):
+        layer = layer[..., np.newaxis]
+        # premultiplied 'over' compositing
+        image[..., :3] = color[:3] * layer + image[..., :3] * (1 - layer)
+        image[..., 3:] = layer + image[..., 3:] * (1 - layer)
+    filled = image[..., 3] > 0
+    image[filled, :3] /= image[filled, 3:]
+    return image
+
+def action_legend():
+    return [Patch(color=action_colors[action], label=action) for action in actions]
+
+def scatter_and_legend(point_size=1, x=3, y=1, density=False, bins=512, reports=None,
+                       coordinates=None):
+    '''
+    Plot the incident descriptions in the x-y plane using coordinates from pipe_SVD
+    where Stop the Job is in red, Further Action Necessary is in green,
+    Action Completed Onsite is in orange, and No Action Necessary is in blue.
+    With density=True they are drawn as a bins x bins density image instead of
+    one point per report.
+    '''
+    reports, coordinates = labeled_reports(reports, coordinates)
+    coordinates = coordinates[:, [x, y]]
     plt.figure(figsize=(10, 10))
+    if density:
+        histograms, ((x_low, x_high), (y_low, y_high)) = \
+            action_histograms(coordinates, reports.immediateActionsTaken, bins)
+        # the grid's rows are x, but imshow wants rows to be y
+        plt.imshow(composite_histograms(histograms.transpose(0, 2, 1)),
+                   extent=(x_low, x_high, y_low, y_high), origin='lower',
+                   interpolation='nearest')
+        plt.axis('equal')
+        plt.axis('off')
+        plt.legend(handles=action_legend(), loc=(.6, .25))
+        return
+    x_coords, y_coords = coordinates[:,0], coordinates[:,1]
     for action in actions:
         plt.scatter(x_coords[reports.immediateActionsTaken == action],
                     y_coords[reports.immediateActionsTaken == action],
                     s=point_size,
-                    c=color_map[action])#,
+                    c=action_colors[action])#,
                     #label=action)
     plt.axis('equal')
     plt.axis('off')
@@ -158,61 +266,96 @@ def words_in_corners():
     plt.text(.5, .1, 'Landscaping \n and Roads', size='large')
     plt.text(-.1, -.37, 'Conversations and Forms', size='large')
 
-def plot_test_data(tag, x=3, y=1):
-    graded = pd.read_csv('my_data/graded.csv')
-    graded = graded[graded.immediateActionsTaken == tag]
-    pipe_SVD = get_pipeline()
-    coordinates = pipe_SVD.transform(graded.incidentDescription.astype(str))[:, [x, y]]
-    x, y = coordinates[:,0], coordinates[:,1]
+def plot_test_data(tag, x=3, y=1, graded=None, graded_coordinates=None):
+    graded, coordinates = graded_with_tag(tag, graded, graded_coordinates)
+    x, y = coordinates[:, x], coordinates[:, y]
     tag_colors = {
                   'No Action Necessary':'blue',
                   'Action Completed Onsite': 'orange'
                  }
-    plt.scatter(x[graded.grade == 0], y[graded.grade == 0],
+    plt.scatter(x[(graded.grade == 0).values], y[(graded.grade == 0).values],
                 s=30, edgecolor='black', linewidth=3, c=tag_colors[tag],
                 label='Not Important--{}'.format(tag))
-    plt.scatter(x[graded.grade == 1], y[graded.grade == 1],
+    plt.scatter(x[(graded.grade == 1).values], y[(graded.grade == 1).values],
                 s=30, edgecolor='red', linewidth=3, c=tag_colors[tag],
                 label='Important--{}'.format(tag))
     plt.legend(loc=(.5, .7), markerscale=1.5)
     #plt.legend(loc=(.6, .25), markerscale=1.5)
     print(graded[(x >.2)].incidentDescription)
 
-def plot_data_and_test(tag, x=3, y=1):
-    scatter_and_legend(.1, x, y)
-    plot_test_data(tag, x, y)
+def plot_data_and_test(tag, x=3, y=1, density=False, reports=None, coordinates=None,
+                       graded=None, graded_coordinates=None):
+    scatter_and_legend(.1, x, y, density, reports=reports, coordinates=coordinates)
+    plot_test_data(tag, x, y, graded, graded_coordinates)
     #plt.show()
 
-def plot_3d():
-    pipe_SVD = get_pipeline()
-    reports = pd.read_csv('my_data/combined_reports.csv').set_index('seq')
-    reports.dropna(subset=['immediateActionsTaken', 'incidentDescription'], inplace=True)
-    coordinates = pipe_SVD.transform(reports.incidentDescription)[:, [1, 2, 3]]
-    colors = list(reports.immediateActionsTaken.map({
-                'Stop the Job': 'black',
-                'Further Action Necessary': 'green',
-                'Action Completed Onsite': 'orange',
-                'No Action Necessary': 'blue'
-                }))
-    x, y, z = coordinates[:,0], coordinates[:,1], coordinates[:,2]
+def plot_completed_line(x=2, y=3, density=False, reports=None, coordinates=None,
+                        graded=None, graded_coordinates=None, line=None):
+    '''
+    The Action Completed Onsite test reports over all the reports, with the
+    line that the completed reports are scored against.  line is
+    (intercept, slope), as from get_coefficients_of_line.
+    '''
+    plot_data_and_test('Action Completed Onsite', x, y, density, reports, coordinates,
+                       graded, graded_coordinates)
+    x_ = np.array(plt.xlim())
+    intercept, slope = line if line is not None else get_coefficients_of_line()
+    y_ = slope * x_ + intercept
+    plt.plot(x_, y_, c='gray', linestyle='dashed')
+
+def plot_3d(density=False, bins=48, reports=None, coordinates=None, graded=None,
+            graded_coordinates=None, path=None):
+    '''
+    With density=True each action is drawn as one point per occupied cell of a
+    bins^3 grid, faded by how many reports fell in it, instead of one point per
+    report.  The plot is saved to path if one is given, and shown otherwise.
+    '''
+    reports, coordinates = labeled_reports(reports, coordinates)
+    coordinates = coordinates[:, [1, 2, 3]]
     fig = plt.figure()
     ax = fig.add_subplot(111, projection='3d')
-    ax.scatter(x, y, z, c=colors, s=.01)
-    graded = pd.read_csv('my_data/graded.csv')
-    graded_tag = graded[graded.immediateActionsTaken == 'Action Completed Onsite']
-    coordinates = pipe_SVD.transform(graded_tag.incidentDescription.astype(str))[:, [1, 2, 3]]
-    x, y, z = coordinates[:,0], coordinates[:,1], coordinates[:,2]
+    if density:
+        histograms, extent = action_histograms(coordinates, reports.immediateActionsTaken, bins)
+        alpha = density_alpha(histograms)
+        centers = [low + (np.arange(bins) + .5) * (high - low) / bins for low, high in extent]
+        for action, counts, layer in zip(actions, histograms, alpha):
+            cells = np.nonzero(counts)
+            colors = np.tile(to_rgba_array(action_colors[action]), (len(cells[0]), 1))
+            colors[:, 3] = layer[cells]
+            ax.scatter(centers[0][cells[0]], centers[1][cells[1]], centers[2][cells[2]],
+                       c=colors, s=4, depthshade=False)
+    else:
+        colors = list(reports.immediateActionsTaken.map(action_colors))
+        x, y, z = coordinates[:,0], coordinates[:,1], coordinates[:,2]
+        ax.scatter(x, y, z, c=colors, s=.01)
+    graded_tag, coordinates = graded_with_tag('Action Completed Onsite', graded,
+                                              graded_coordinates)
+    x, y, z = coordinates[:,1], coordinates[:,2], coordinates[:,3]
     grade_colors = list(graded_tag.grade.map({0: 'black', 1: 'red'}))
     ax.scatter(x, y, z, c=grade_colors, s=3)
-    plt.show()
+    if path is not None:
+        plt.savefig(path)
+    else:
+        plt.show()
 
-def show_comment(seq=None, x_dim=3, y_dim=1):
-    reports = pd.read_csv('my_data/combined_reports.csv').set_index('seq')
-    if seq == None:
-        seq = reports.sample(1).index[0]
-    pipe = get_pipeline()
-    description = reports.loc[seq].incidentDescription
-    coordinates = pipe.transform([description])
+def show_comment(seq=None, x_dim=3, y_dim=1, reports=None):
+    '''
+    Mark one report on the current plot and print its description.  Without
+    reports, the report is looked up in the report store instead of reading
+    every report.
+    '''
+    if reports is None:
+        store = get_report_store()
+        if seq == None:
+            seq = store.random_seq()
+            if seq is None:
+                raise ValueError('the report store is empty; run combine_data.py first')
+        description = store.get(seq).incidentDescription
+    else:
+        if seq == None:
+            seq = reports.sample(1).index[0]
+        description = reports.loc[seq].incidentDescription
+    coordinates = description_coordinates([description], [seq])
     x, y = coordinates[:, x_dim], coordinates[:, y_dim]
     plt.scatter(x, y, s=50, color='black')
     comment = description.replace('[', '').replace(']', '').strip()
@@ -223,24 +366,21 @@ def show_comment(seq=None, x_dim=3, y_dim=1):
     print(seq)
     print(comment)
 
-def save_comment_pic(seq, strand):
-    scatter_and_legend()
-    show_comment(seq)
-    plt.savefig('plots/{}_{}.png'.format(strand, seq), bbox_inches='tight')
-    plt.show()
+def save_comment_pic(seq, strand, reports=None, coordinates=None, directory='plots',
+                     show=True):
+    scatter_and_legend(reports=reports, coordinates=coordinates)
+    show_comment(seq, reports=reports)
+    plt.savefig(os.path.join(directory, '{}_{}.png'.format(strand, seq)), bbox_inches='tight')
+    if show:
+        plt.show()
 
 
 if __name__ == '__main__':
     print('I am a plot-making machine.')
-    scatter_and_legend(point_size=.1, x=2, y=3)
-    plot_test_data('Action Completed Onsite', x=2, y=3)
+    plot_completed_line(x=2, y=3)
     #show_comment()
     # plt.xlim(-.27, .5)
     # plt.ylim(-.35, .27)
-    x_ = np.array(plt.xlim())
-    intercept, slope = get_coefficients_of_line()
-    y_ = slope * x_ + intercept
-    plt.plot(x_, y_, c='gray', linestyle='dashed')
     plt.savefig('plots/action_completed_onsite_with_line.png')
     plt.show()
 
@@ -0,0 +1,165 @@
+import os
+import sqlite3
+import argparse
+import pandas as pd
+from combined_store import combined_dir, iter_combined, store_signature, typed
+
+'''
+Random access to the combined reports without loading all of them.  The
+combined reports are copied once into an SQLite table indexed on seq and _id,
+so looking up one report (or a few hundred) for show_comment or a review
+meeting is an index lookup instead of a read of every report.
+
+The table remembers the version of the combined store (see combined_store) it
+was built from, and get_report_store() rebuilds it whenever the store has
+changed since.  update_combined_data keeps it in step itself with upsert(), so
+the incremental path doesn't pay for a rebuild.
+'''
+
+report_store_file = 'my_data/combined_reports.sqlite'
+# SQLite's default limit on the number of ? in one statement is 999
+max_variables = 900
+
+
+def source_signature(source):
+    '''
+    The version of the combined store at source, or the size and modification
+    time of a file.
+    '''
+    if os.path.isdir(source):
+        return store_signature(source)
+    stat = os.stat(source)
+    return '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+
+def sql_frame(reports):
+    # categoricals go into SQLite as their values
+    return reports.astype({col: object for col in reports.columns
+                           if isinstance(reports[col].dtype, pd.CategoricalDtype)})
+
+def build_report_store(source=combined_dir, path=report_store_file):
+    '''
+    Copy the combined reports in the store at source into a new SQLite file at path.
+    '''
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    with sqlite3.connect(temporary_path) as connection:
+        for month in iter_combined(source):
+            sql_frame(month).to_sql('reports', connection, if_exists='append', index=False)
+        connection.execute('CREATE INDEX reports_seq ON reports (seq)')
+        connection.execute('CREATE INDEX reports_id ON reports (_id)')
+        connection.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        connection.execute("INSERT INTO meta VALUES ('source', ?)", (source_signature(source),))
+    connection.close()
+    os.replace(temporary_path, path)
+
+
+class ReportStore(object):
+
+    def __init__(self, path=report_store_file):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+    def close(self):
+        self.connection.close()
+
+    def source(self):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+        return row[0] if row else None
+
+    def query(self, column, keys):
+        keys = list(keys)
+        frames = []
+        for start in range(0, len(keys), max_variables):
+            batch = keys[start:start + max_variables]
+            sql = 'SELECT * FROM reports WHERE "{}" IN ({})'.format(column,
+                                                                  ', '.join('?' * len(batch)))
+            frames.append(pd.read_sql_query(sql, self.connection, params=batch))
+        if not frames:
+            return pd.read_sql_query('SELECT * FROM reports LIMIT 0', self.connection)
+        return pd.concat(frames, ignore_index=True)
+
+    def get_many(self, seqs):
+        '''
+        The reports with these seqs, indexed by seq in the order asked for.
+        Seqs that aren't in the store are left out.
+        '''
+        seqs = [int(seq) for seq in seqs]
+        reports = self.query('seq', set(seqs)).drop_duplicates('seq', keep='last')
+        reports = reports.set_index('seq')
+        return reports.loc[[seq for seq in seqs if seq in reports.index]]
+
+    def get(self, seq):
+        '''
+        The report with this seq as a Series, or None.
+        '''
+        reports = self.get_many([seq])
+        return reports.iloc[0] if len(reports) else None
+
+    def by_id(self, ids):
+        '''
+        The reports with these _ids, indexed by seq.
+        '''
+        return self.query('_id', set(str(i) for i in ids)).set_index('seq')
+
+    def random_seq(self):
+        '''
+        The seq of a report picked at random, without scanning the table, or
+        None if there are no reports.
+        '''
+        row = self.connection.execute(
+            'SELECT seq FROM reports WHERE rowid >= '
+            '(ABS(RANDOM()) % (SELECT MAX(rowid) FROM reports)) + 1 LIMIT 1').fetchone()
+        return int(row[0]) if row is not None else None
+
+    def upsert(self, reports, source=combined_dir):
+        '''
+        Replace any stored reports with the same _id as one of reports, add the
+        rest, and record source (which should now hold the same reports) as
+        what the store matches.  reports are given the combined store's dtypes
+        first, so their dates are written like the ones already in the table.
+        '''
+        ids = list(set(reports._id.astype(str)))
+        with self.connection:
+            for start in range(0, len(ids), max_variables):
+                batch = ids[start:start + max_variables]
+                self.connection.execute('DELETE FROM reports WHERE _id IN ({})'.format(
+                                            ', '.join('?' * len(batch))), batch)
+            sql_frame(typed(reports)).to_sql('reports', self.connection, if_exists='append',
+                                             index=False)
+            self.connection.execute("UPDATE meta SET value = ? WHERE key = 'source'",
+                                    (source_signature(source),))
+
+
+_stores = {}
+
+def get_report_store(path=report_store_file, source=combined_dir):
+    '''
+    The store for the combined reports at source, built or rebuilt first if
+    it doesn't match them.
+    '''
+    store = _stores.get(path)
+    if store is None and os.path.isfile(path):
+        store = _stores[path] = ReportStore(path)
+    if store is None or store.source() != source_signature(source):
+        if store is not None:
+            store.close()
+        build_report_store(source, path)
+        store = _stores[path] = ReportStore(path)
+    return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Look up combined reports by seq or _id.')
+    parser.add_argument('seqs', nargs='*', type=int)
+    parser.add_argument('--id', nargs='*', default=[], dest='ids')
+    parser.add_argument('--rebuild', action='store_true')
+    args = parser.parse_args()
+    if args.rebuild:
+        build_report_store()
+    store = get_report_store()
+    pd.set_option('display.max_colwidth', None)
+    if args.seqs:
+        print(store.get_many(args.seqs).T)
+    if args.ids:
+        print(store.by_id(args.ids).T)
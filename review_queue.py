@@ -0,0 +1,87 @@
+import heapq
+import numpy as np
+
+
+'''
+Reviewers only look at the top few dozen reports a day, so rather than sorting
+every report again when new ones are scored, the review queue keeps them in a
+heap ordered the same way as ReportSorter.sort_reports: by flag, then by the
+number of meaningful event types, then by score.
+
+Removing a report only forgets it; its heap entry is skipped when it reaches
+the top, and the heap is rebuilt once most of it is stale.  Every push gets a
+new generation number, so an old entry never comes back to life when a
+report is queued again with a key it had before.
+'''
+
+class ReviewQueue(object):
+
+    def __init__(self):
+        self.heap = []
+        # seq -> (key, generation) of its one current heap entry
+        self.keys = {}
+        self.generation = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, seq):
+        return seq in self.keys
+
+    def push(self, seq, flag_number, type_count, score):
+        '''
+        Add a report, or move it if it was already queued with another score.
+        '''
+        key = (-flag_number, -type_count, score)
+        if seq in self.keys and self.keys[seq][0] == key:
+            return
+        self.generation += 1
+        self.keys[seq] = (key, self.generation)
+        heapq.heappush(self.heap, (key, seq, self.generation))
+        if len(self.heap) > 2 * len(self.keys) + 64:
+            self.compact()
+
+    def remove(self, seq):
+        self.keys.pop(seq, None)
+
+    def is_current(self, entry):
+        key, seq, generation = entry
+        return self.keys.get(seq) == (key, generation)
+
+    def compact(self):
+        self.heap = [(key, seq, generation) for seq, (key, generation) in self.keys.items()]
+        heapq.heapify(self.heap)
+
+    def top(self, k):
+        '''
+        The seqs of the first k reports in review order, best first.  Pops at
+        most k current entries (plus any stale ones) and pushes them back.
+        '''
+        popped = []
+        while self.heap and len(popped) < k:
+            entry = heapq.heappop(self.heap)
+            if self.is_current(entry):
+                popped.append(entry)
+        for entry in popped:
+            heapq.heappush(self.heap, entry)
+        return [seq for _, seq, _ in popped]
+
+    def pop(self, k=1):
+        '''
+        Take the first k reports off the queue, for when they've been reviewed.
+        '''
+        seqs = self.top(k)
+        for seq in seqs:
+            self.remove(seq)
+        return seqs
+
+    def add_reports(self, reports, sorter):
+        '''
+        Score reports with a ReportSorter and queue the labeled ones, keyed by
+        their seq column (or index if there isn't one).
+        '''
+        flags, type_counts, scores = sorter.review_keys(reports)
+        seqs = reports.seq.values if 'seq' in reports.columns else reports.index.values
+        for seq, flag, count, score in zip(seqs, flags, type_counts, scores):
+            if not np.isnan(flag):
+                self.push(seq, int(flag), int(count), float(score))
@@ -0,0 +1,132 @@
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+from combined_store import combined_dir, iter_combined
+from report_store import source_signature
+from event_types import mask_column, event_masks, type_dummies
+
+'''
+Counts of reports by operatingCenter, month, immediateActionsTaken and
+eventType, so the stacked bar plots and dashboards don't have to rescan the
+whole history.  The cube is kept in long form, one row per combination that
+has any reports:
+
+    operatingCenter  month       immediateActionsTaken  eventType  count
+    Wamsutter        2016-03-01  No Action Necessary    Near Miss     41
+    Wamsutter        2016-03-01  No Action Necessary    All          187
+
+A report counts once for every event type its eventType mentions, and once
+under 'All', so 'All' is the number of reports.  Reports without an operating
+center or action are counted under 'Unknown'.
+
+The cube remembers the version of the combined store it was counted from, and
+get_rollups() recounts whenever the store has changed since.
+update_combined_data keeps it in step with update_rollups instead.
+'''
+
+rollup_file = 'my_data/rollups.pkl'
+rollup_columns = ['operatingCenter', 'serverCreatedDate', 'immediateActionsTaken', 'eventType']
+cube_keys = ['operatingCenter', 'month', 'immediateActionsTaken', 'eventType']
+# The new reports have some very granular new types, but not enough to count
+rollup_event_types = ['Hazard Identification', 'Material Release', 'Near Miss',
+                      'Property Damage', 'Security', 'Verification']
+all_events = 'All'
+
+
+def report_counts(reports):
+    '''
+    The cube for a DataFrame of reports.
+    '''
+    months = pd.to_datetime(reports.serverCreatedDate).dt.to_period('M').dt.to_timestamp()
+    flags = type_dummies(event_masks(reports), rollup_event_types, np.int64)
+    flags = flags.reset_index(drop=True)
+    flags[all_events] = 1
+    flags['operatingCenter'] = reports.operatingCenter.astype(object).fillna('Unknown').values
+    flags['month'] = months.values
+    flags['immediateActionsTaken'] = \
+        reports.immediateActionsTaken.astype(object).fillna('Unknown').values
+    counts = flags.dropna(subset=['month']).groupby(cube_keys[:3]).sum()
+    counts.columns.name = 'eventType'
+    counts = counts.stack()
+    return counts[counts > 0].rename('count').reset_index()
+
+def add_counts(*cubes):
+    cubes = [cube for cube in cubes if cube is not None]
+    if not cubes:
+        # no reports at all, so an empty cube with the usual columns
+        return pd.DataFrame(columns=cube_keys + ['count'])
+    counts = pd.concat(cubes, ignore_index=True).groupby(cube_keys)['count'].sum()
+    return counts[counts > 0].reset_index()
+
+def subtract_counts(cube, removed):
+    removed = removed.assign(count=-removed['count'])
+    return add_counts(cube, removed)
+
+def build_rollups(source=combined_dir):
+    months = iter_combined(source, columns=rollup_columns + [mask_column])
+    return add_counts(*[report_counts(month) for month in months])
+
+def save_rollups(cube, source=combined_dir, path=rollup_file):
+    with open(path, 'wb') as f:
+        pickle.dump({'source': source_signature(source), 'cube': cube}, f)
+
+def load_rollups(path=rollup_file):
+    '''
+    The saved cube and the signature of the reports it matches, or (None, None).
+    '''
+    try:
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+    except FileNotFoundError:
+        return None, None
+    return saved['cube'], saved['source']
+
+def get_rollups(source=combined_dir, path=rollup_file):
+    '''
+    The cube for the combined reports at source, recounted first if the
+    saved one doesn't match them.
+    '''
+    cube, signature = load_rollups(path)
+    if cube is None or signature != source_signature(source):
+        cube = build_rollups(source)
+        save_rollups(cube, source, path)
+    return cube
+
+def update_rollups(added, removed=None, source=combined_dir, path=rollup_file):
+    '''
+    Count the reports in added, and stop counting the ones in removed (the
+    old versions of revised reports), in the saved cube.  source should
+    already hold the updated reports.
+    '''
+    cube, _ = load_rollups(path)
+    cube = add_counts(cube, report_counts(added))
+    if removed is not None and len(removed):
+        cube = subtract_counts(cube, report_counts(removed))
+    save_rollups(cube, source, path)
+    return cube
+
+def type_counts(cube, by=('operatingCenter', 'month'), events=rollup_event_types):
+    '''
+    A table of counts with a row for each combination of the by columns and a
+    column for each event type, e.g. type_counts(cube).loc['Wamsutter'] is the
+    monthly counts for Wamsutter.
+    '''
+    # every combination with any reports gets a row, even if none are of these types
+    index = cube.groupby(list(by)).size().index
+    cube = cube[cube.eventType.isin(list(events))]
+    table = cube.pivot_table(index=list(by), columns='eventType', values='count',
+                             aggfunc='sum', fill_value=0)
+    return table.reindex(index=index, columns=list(events), fill_value=0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Count reports by center, month and type.')
+    parser.add_argument('--rebuild', action='store_true')
+    args = parser.parse_args()
+    if args.rebuild:
+        cube = build_rollups()
+        save_rollups(cube)
+    else:
+        cube = get_rollups()
+    print(type_counts(cube, by=['operatingCenter']))
@@ -1,21 +1,33 @@
 import numpy as np
 import pandas as pd
 import os.path
+import argparse
+from datetime import datetime
 from sklearn.decomposition import TruncatedSVD
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.pipeline import Pipeline
 from sklearn.linear_model import LinearRegression
 import pickle
+from svd_model import pipeline_file, load_pipeline, load_transformer, pipeline_version
+from coordinate_store import CoordinateStore, get_store
+from streaming_svd import fit_streaming_pipeline
+from instrumentation import stage, instrumented
+from event_types import event_type_mask, event_masks, count_types
+from combined_store import read_combined
 
-def get_pipeline():
+def fit_pipeline(streaming=False):
     '''
-    Either load or create the pipeline that converts the incident descriptions
-    into cartesian coordinates in 4 dimensional TruncatedSVD space (dimensions 3
-    and 1 are the important ones for no action necessary and further action necessary,
-    2 and 3 are the important ones for action completed onsite)
+    Create the pipeline that converts the incident descriptions into cartesian
+    coordinates in 4 dimensional TruncatedSVD space (dimensions 3 and 1 are the
+    important ones for no action necessary and further action necessary, 2 and 3
+    are the important ones for action completed onsite), unless it already exists.
+    With streaming=True it is fitted a chunk at a time (see streaming_svd).
     '''
-    if not os.path.isfile('SVD_pipe.pkl'):
-        reports = pd.read_csv('my_data/combined_reports.csv')
+    if not os.path.isfile(pipeline_file) and streaming:
+        with open(pipeline_file, 'wb') as f:
+            pickle.dump(fit_streaming_pipeline(), f)
+    elif not os.path.isfile(pipeline_file):
+        reports = read_combined(columns=['immediateActionsTaken', 'incidentDescription'])
         reports.dropna(subset=['immediateActionsTaken', 'incidentDescription'], inplace=True)
         comments = reports.incidentDescription.values
         pipe = Pipeline([
@@ -23,12 +35,33 @@ def get_pipeline():
                             ('decomp', TruncatedSVD(n_components=4))
                         ])
         pipe.fit(comments)
-        with open('SVD_pipe.pkl', 'wb') as f:
+        with open(pipeline_file, 'wb') as f:
             pickle.dump(pipe, f)
-    else:
-        with open('SVD_pipe.pkl', 'rb') as f:
-            pipe = pickle.load(f)
-    return pipe
+
+def get_pipeline(streaming=False):
+    '''
+    Either load or create the sklearn pipeline.
+    '''
+    fit_pipeline(streaming)
+    return load_pipeline()
+
+def get_transformer(streaming=False):
+    '''
+    Either load or create something that transforms descriptions exactly like
+    the pipeline, but which loads much faster (see svd_model).
+    '''
+    fit_pipeline(streaming)
+    return load_transformer()
+
+def description_coordinates(descriptions, seqs=None, remember=True):
+    '''
+    Coordinates of the incident descriptions in the 4 dimensional SVD space.
+    They come from the coordinate store, so each text is only transformed once
+    per version of the pipeline.  With remember=False, texts that aren't in
+    the store are transformed without being added to it.
+    '''
+    fit_pipeline()
+    return get_store().transform(descriptions, seqs, remember)
 
 '''
 ACTION COMPLETED ONSITE
@@ -41,11 +74,12 @@ the reports are very unlikely to be useful.  For reports tagged actions complete
 rank the reports based on how close they are to the strand where some of the reports
 are useful
 '''
+@instrumented()
 def get_coefficients_of_line():
-    reports = pd.read_csv('my_data/combined_reports.csv')
-    stop_the_job = reports[reports.immediateActionsTaken == 'Stop the Job']
-    pipe = get_pipeline()
-    coords = pipe.transform(stop_the_job.incidentDescription.astype(str))
+    stop_the_job = read_combined(columns=['seq', 'incidentDescription'],
+                                 filters=[('immediateActionsTaken', '==', 'Stop the Job')])
+    coords = description_coordinates(stop_the_job.incidentDescription.astype(str),
+                                     stop_the_job.seq)
     x = coords[:, 2]
     y = coords[:, 3]
     line = LinearRegression(fit_intercept=True)
@@ -73,13 +107,15 @@ def count_meaningful_event_types(eventTypes_column):
     The event types of most reports are either empty or vague.  I want to prioritize
     reports that have meaningful event types.
     '''
-    meaningful_types =  {'Fire/Explosion',
-                         'Injury/Illness',
-                         'Material Release',
-                         'Near Miss',
-                         'Property Damage',
-                         'Security'}
-    return eventTypes_column.apply(lambda s: sum([typ in s for typ in meaningful_types]))
+    return pd.Series(count_types(event_type_mask(eventTypes_column)),
+                     index=eventTypes_column.index)
+
+def meaningful_type_counts(reports):
+    '''
+    count_meaningful_event_types, from the eventTypeMask column when the
+    reports have one.
+    '''
+    return pd.Series(count_types(event_masks(reports)), index=reports.index)
 
 '''
 NO ACTION NECESSARY
@@ -88,38 +124,186 @@ No Action Necessary (and probably Further Action Necessary) can be ranked based
 to the Stop the Job cluster.
 '''
 
+@instrumented()
 def find_stop_job_center():
-    pipe = get_pipeline()
-    reports = pd.read_csv('my_data/combined_reports.csv')
-    comments = reports[reports.immediateActionsTaken == 'Stop the Job'].incidentDescription.astype(str)
-    coordinates = pipe.transform(comments)
+    stop_the_job = read_combined(columns=['seq', 'incidentDescription'],
+                                 filters=[('immediateActionsTaken', '==', 'Stop the Job')])
+    coordinates = description_coordinates(stop_the_job.incidentDescription.astype(str),
+                                          stop_the_job.seq)
     x, y = coordinates[:, 3], coordinates[:, 1]
     x_center, y_center = x.mean(), y.mean()
     return (x_center, y_center)
 
 
+'''
+MODEL ARTIFACT
+
+The regression line and the Stop the Job center only change when the pipeline
+does, so they are fitted once and saved along with the pipeline in a single
+artifact.  A ReportSorter made from the artifact doesn't read any csv files.
+'''
+artifact_file = 'scorer_model.pkl'
+artifact_format = 1
+
+def build_artifact(path=artifact_file):
+    intercept, slope = get_coefficients_of_line()
+    x_center, y_center = find_stop_job_center()
+    artifact = {'format': artifact_format,
+                'created': datetime.now().isoformat(),
+                'pipeline_version': pipeline_version(),
+                'pipeline': get_pipeline(),
+                'completed_intercept': intercept,
+                'completed_slope': slope,
+                'stop_job_center': (x_center, y_center)}
+    with open(path, 'wb') as f:
+        pickle.dump(artifact, f)
+    return artifact
+
+def load_artifact(path=artifact_file):
+    with open(path, 'rb') as f:
+        artifact = pickle.load(f)
+    if artifact.get('format') != artifact_format:
+        raise ValueError('{} has artifact format {}, expected {}; rebuild it with '
+                         'python scorer.py --build-artifact'.format(
+                            path, artifact.get('format'), artifact_format))
+    return artifact
+
+
+flag_numbers = {'Stop the Job': 3,
+                'Further Action Necessary': 2,
+                'Action Completed Onsite': 1,
+                'No Action Necessary': 0}
+
+def top_k_order(flags, type_counts, scores, k):
+    '''
+    Positions of the first k labeled reports in the review order, without
+    sorting all of them.  Flag and event type count are folded into one number
+    so np.partition can find the cutoff; only the reports tied at the cutoff
+    need their scores compared, and only the ones that can make the first k
+    are fully sorted.  Every report tied with the k-th is kept until that sort,
+    so ties (every Stop the Job scores 2) go by position, as in review_order.
+    '''
+    if k <= 0:
+        return np.array([], dtype=int)
+    candidates = np.flatnonzero(~np.isnan(flags))
+    if k < len(candidates):
+        # there are only six meaningful types, so the count never reaches 100
+        priority = -(flags[candidates] * 100 + type_counts[candidates])
+        cutoff = np.partition(priority, k - 1)[k - 1]
+        above = candidates[priority < cutoff]
+        tied = candidates[priority == cutoff]
+        needed = k - len(above)
+        if needed < len(tied):
+            score_cutoff = np.partition(scores[tied], needed - 1)[needed - 1]
+            # NaN scores sort last, so a NaN cutoff keeps all of them
+            if not np.isnan(score_cutoff):
+                tied = tied[scores[tied] <= score_cutoff]
+        candidates = np.sort(np.concatenate([above, tied]))
+    order = np.lexsort((scores[candidates], -type_counts[candidates], -flags[candidates]))
+    return candidates[order][:k]
+
+
 class ReportSorter(object):
 
-    def __init__(self):
-        self.pipe_SVD = get_pipeline()
-        self.completed_intercept, self.completed_slope = get_coefficients_of_line()
-        self.stop_job_x, self.stop_job_y = find_stop_job_center()
+    def __init__(self, pipe_SVD=None, completed_line=None, stop_job_center=None,
+                 version=None):
+        '''
+        Anything that isn't passed in is fitted from the combined reports.  A
+        pipe_SVD that was passed in should come with the version it was saved
+        as, which keys its cached coordinates.
+        '''
+        if pipe_SVD is None:
+            self.pipe_SVD = get_transformer()
+            self.coordinate_store = get_store()
+        else:
+            self.pipe_SVD = pipe_SVD
+            self.coordinate_store = CoordinateStore(pipeline=pipe_SVD, version=version)
+        if completed_line is None:
+            completed_line = get_coefficients_of_line()
+        if stop_job_center is None:
+            stop_job_center = find_stop_job_center()
+        self.completed_intercept, self.completed_slope = completed_line
+        self.stop_job_x, self.stop_job_y = stop_job_center
 
-    def score_no_action_necessary(self, comments):
-        coordinates = self.pipe_SVD.transform(comments)
-        x, y = coordinates[:, 3], coordinates[:, 1]
-        return np.sqrt((self.stop_job_x - x)**2 + (self.stop_job_y - y)**2)
+    @classmethod
+    def from_artifact(cls, path=artifact_file):
+        artifact = load_artifact(path)
+        return cls(pipe_SVD=artifact['pipeline'],
+                   completed_line=(artifact['completed_intercept'], artifact['completed_slope']),
+                   stop_job_center=artifact['stop_job_center'],
+                   version=artifact['pipeline_version'])
 
-    def score_further_action_necessary(self, comments):
-        coordinates = self.pipe_SVD.transform(comments)
+    def distance_to_stop_job_center(self, coordinates):
         x, y = coordinates[:, 3], coordinates[:, 1]
         return np.sqrt((self.stop_job_x - x)**2 + (self.stop_job_y - y)**2)
 
-    def score_action_completed_onsite(self, comments):
-        coordinates = self.pipe_SVD.transform(comments)
+    def distance_to_completed_line(self, coordinates):
         x, y = coordinates[:, 2], coordinates[:, 3]
         return distance_to_line(self.completed_intercept, self.completed_slope, x, y)
 
+    def score_no_action_necessary(self, comments):
+        return self.distance_to_stop_job_center(self.coordinate_store.transform(comments))
+
+    def score_further_action_necessary(self, comments):
+        return self.distance_to_stop_job_center(self.coordinate_store.transform(comments))
+
+    def score_action_completed_onsite(self, comments):
+        return self.distance_to_completed_line(self.coordinate_store.transform(comments))
+
+    def score(self, reports):
+        '''
+        The Morrow Metric Score of each report, as an array in the same order as
+        reports.  All of the descriptions that need scoring are transformed in one
+        call, and each label is scored with a mask over those coordinates.  Stop
+        the Job always scores 2, and reports without one of the four labels get NaN.
+        '''
+        with stage('scorer.ReportSorter.score', len(reports)):
+            return self._score(reports)
+
+    def _score(self, reports):
+        actions = reports.immediateActionsTaken.values
+        scores = np.full(len(reports), np.nan)
+        scores[actions == 'Stop the Job'] = 2
+        near_center = (actions == 'Further Action Necessary') | (actions == 'No Action Necessary')
+        near_line = actions == 'Action Completed Onsite'
+        transformed = near_center | near_line
+        coordinates = np.empty((len(reports), 4))
+        coordinates[transformed] = self.coordinate_store.transform(
+                        reports.incidentDescription.values[transformed].astype(str))
+        scores[near_center] = self.distance_to_stop_job_center(coordinates[near_center])
+        scores[near_line] = self.distance_to_completed_line(coordinates[near_line])
+        return scores
+
+    def review_keys(self, reports, scores=None):
+        '''
+        The flag number, meaningful event type count and score of each report,
+        which together decide the review order.
+        '''
+        if scores is None:
+            scores = self.score(reports)
+        flags = reports.immediateActionsTaken.map(flag_numbers).values.astype(float)
+        type_counts = meaningful_type_counts(reports).values
+        return flags, type_counts, scores
+
+    def review_order(self, reports, scores=None):
+        '''
+        Positions of the labeled reports, in the order they should be reviewed:
+        by flag, then by the number of meaningful event types, then by score.
+        '''
+        flags, type_counts, scores = self.review_keys(reports, scores)
+        order = np.lexsort((scores, -type_counts, -flags))
+        return order[~np.isnan(flags[order])]
+
+    def rank(self, reports, scores=None):
+        '''
+        Where each report comes in the review order (0 is reviewed first), in
+        the same order as reports.  Unlabeled reports get -1.
+        '''
+        order = self.review_order(reports, scores)
+        ranks = np.full(len(reports), -1)
+        ranks[order] = np.arange(len(order))
+        return ranks
+
     def sort_reports(self, reports):
         '''
         Sort first by whether the report is labeled 'Stop the Job', 'Further Action Necessary',
@@ -127,42 +311,38 @@ class ReportSorter(object):
         Then sort by the number of meaningful types in the eventTypes column.
         Finally, sort by the Morrow Metric Score.
         '''
-        pipe = get_pipeline()
-        df = reports[['immediateActionsTaken', 'eventType', 'incidentDescription']].copy()
-        df['typeCount'] = count_meaningful_event_types(df.eventType)
-        df['flag_number'] = df.immediateActionsTaken.map({
-                                                        'Stop the Job': 3,
-                                                        'Further Action Necessary': 2,
-                                                        'Action Completed Onsite': 1,
-                                                        'No Action Necessary': 0
-                                                        })
-        stop_the_job = df[df.immediateActionsTaken == 'Stop the Job'].copy()
-        stop_the_job['score'] = np.full(len(stop_the_job), 2)
-        further_action_necessary = df[df.immediateActionsTaken == 'Further Action Necessary'].copy()
-        further_action_necessary['score'] = self.score_further_action_necessary(
-                        further_action_necessary.incidentDescription.astype(str)
-                        )
-        action_completed_onsite = df[df.immediateActionsTaken == 'Action Completed Onsite'].copy()
-        action_completed_onsite['score'] = self.score_action_completed_onsite(
-                        action_completed_onsite.incidentDescription.astype(str)
-                        )
-        no_action_necessary = df[df.immediateActionsTaken == 'No Action Necessary'].copy()
-        no_action_necessary['score'] = self.score_no_action_necessary(
-                        no_action_necessary.incidentDescription.astype(str)
-                        )
-        df_scored = pd.concat([stop_the_job,
-                               further_action_necessary,
-                               action_completed_onsite,
-                               no_action_necessary])
-        df_scored.sort_values(['flag_number', 'typeCount', 'score'], ascending=[False, False, True],
-                        inplace=True)
-        return df_scored[['immediateActionsTaken', 'eventType', 'score', 'incidentDescription']]
+        scores = self.score(reports)
+        order = self.review_order(reports, scores)
+        df = reports.iloc[order][['immediateActionsTaken', 'eventType', 'incidentDescription']]
+        df = df.assign(score=scores[order])
+        return df[['immediateActionsTaken', 'eventType', 'score', 'incidentDescription']]
 
+    def top_k(self, reports, k):
+        '''
+        The first k rows sort_reports would return, found with a partial
+        selection instead of a full sort.
+        '''
+        flags, type_counts, scores = self.review_keys(reports)
+        order = top_k_order(flags, type_counts, scores, k)
+        df = reports.iloc[order][['immediateActionsTaken', 'eventType', 'incidentDescription']]
+        df = df.assign(score=scores[order])
+        return df[['immediateActionsTaken', 'eventType', 'score', 'incidentDescription']]
 
 if __name__ == '__main__':
-    reports = pd.read_csv('my_data/combined_reports.csv')
-    reports.dropna(subset=['immediateActionsTaken', 'incidentDescription'], inplace=True)
-    sample = reports.sample(20)
-    comments = sample.incidentDescription.astype(str)
-    rs = ReportSorter()
-    df = rs.sort_reports(sample)
+    parser = argparse.ArgumentParser(description='Rank safety reports for review.')
+    parser.add_argument('--build-artifact', action='store_true',
+                        help='fit the scorer and save it to {}'.format(artifact_file))
+    args = parser.parse_args()
+    if args.build_artifact:
+        build_artifact()
+    else:
+        reports = read_combined(columns=['seq', 'immediateActionsTaken', 'eventType',
+                                         'eventTypeMask', 'incidentDescription'])
+        reports.dropna(subset=['immediateActionsTaken', 'incidentDescription'], inplace=True)
+        sample = reports.sample(20)
+        comments = sample.incidentDescription.astype(str)
+        if os.path.isfile(artifact_file):
+            rs = ReportSorter.from_artifact()
+        else:
+            rs = ReportSorter()
+        df = rs.sort_reports(sample)
@@ -0,0 +1,199 @@
+import os
+import time
+import json
+import socket
+import asyncio
+import argparse
+import numpy as np
+import pandas as pd
+from scorer import ReportSorter, artifact_file, flag_numbers, count_meaningful_event_types
+
+'''
+A local service that keeps one ReportSorter warm, so ranking a handful of
+reports doesn't pay for loading the model every time.
+
+Clients send one JSON object per line and get one JSON object back per line:
+    {"report": {...}} or {"reports": [{...}, ...]}
+        -> {"scores": [...], "flag_numbers": [...], "typeCounts": [...], "priority": [...]}
+    {"stats": true}
+        -> the service's counters
+Each report needs immediateActionsTaken, eventType and incidentDescription.
+priority is where each report comes in the review order of its own request,
+0 first.  Requests that arrive together are scored as one batch, so the
+descriptions go through a single transform.
+
+New descriptions are added to the sorter's coordinate store as they're
+scored.  Adding only appends to the store's delta files, which are merged
+into its memory-mapped arrays once they get big, so a long-running service
+keeps what it has transformed across restarts without holding it all in memory.
+'''
+default_port = 8765
+
+
+class ScoringService(object):
+
+    def __init__(self, sorter, max_batch_size=1024, max_wait=0.005):
+        self.sorter = sorter
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = None
+        self.started = time.time()
+        self.requests = 0
+        self.reports = 0
+        self.batches = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def stats(self):
+        uptime = time.time() - self.started
+        return {'uptime': uptime,
+                'requests': self.requests,
+                'reports': self.reports,
+                'batches': self.batches,
+                'mean_batch_size': self.reports / self.batches if self.batches else 0.0,
+                'mean_latency': self.total_latency / self.requests if self.requests else 0.0,
+                'max_latency': self.max_latency,
+                'reports_per_second': self.reports / uptime if uptime else 0.0}
+
+    async def score(self, reports):
+        '''
+        Scores of a DataFrame of reports, once their micro-batch has been scored.
+        '''
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((reports, future))
+        return await future
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            frames = [reports for reports, _ in batch]
+            try:
+                # transforming is cpu bound, so keep it off the event loop
+                scores = await loop.run_in_executor(None, self.sorter.score,
+                                                    pd.concat(frames, ignore_index=True))
+            except Exception as e:
+                for _, future in batch:
+                    # a client that hung up has already cancelled its future
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            start = 0
+            for reports, future in batch:
+                if not future.done():
+                    future.set_result(scores[start:start + len(reports)])
+                start += len(reports)
+
+    async def handle_message(self, message):
+        if message.get('stats'):
+            return self.stats()
+        records = message['reports'] if 'reports' in message else [message['report']]
+        started = time.monotonic()
+        reports = pd.DataFrame.from_records(records,
+                        columns=['immediateActionsTaken', 'eventType', 'incidentDescription'])
+        reports['eventType'] = reports.eventType.fillna('')
+        scores = await self.score(reports)
+        flags = reports.immediateActionsTaken.map(flag_numbers).values.astype(float)
+        type_counts = count_meaningful_event_types(reports.eventType).values
+        priority = np.empty(len(reports), dtype=int)
+        priority[np.lexsort((scores, -type_counts, -flags))] = np.arange(len(reports))
+        latency = time.monotonic() - started
+        self.requests += 1
+        self.reports += len(reports)
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        return {'scores': [None if np.isnan(score) else float(score) for score in scores],
+                'flag_numbers': [None if np.isnan(flag) else int(flag) for flag in flags],
+                'typeCounts': [int(count) for count in type_counts],
+                'priority': priority.tolist()}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = await self.handle_message(json.loads(line))
+                except Exception as e:
+                    response = {'error': '{}: {}'.format(type(e).__name__, e)}
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=default_port, unix_socket=None):
+        self.queue = asyncio.Queue()
+        self.batcher = asyncio.ensure_future(self.run_batches())
+        if unix_socket is not None:
+            return await asyncio.start_unix_server(self.handle_connection, unix_socket)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def serve_forever(self, host='127.0.0.1', port=default_port, unix_socket=None):
+        server = await self.start(host, port, unix_socket)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            # anything the coordinate store hasn't written to its delta yet
+            self.sorter.coordinate_store.save()
+
+
+def request(message, host='127.0.0.1', port=default_port, unix_socket=None):
+    '''
+    Send one message to a running service and return its response.
+    '''
+    if unix_socket is not None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(unix_socket)
+    else:
+        connection = socket.create_connection((host, port))
+    with connection, connection.makefile('rwb') as stream:
+        stream.write(json.dumps(message).encode('utf-8') + b'\n')
+        stream.flush()
+        return json.loads(stream.readline())
+
+def score_reports(reports, **address):
+    '''
+    Score a DataFrame (or list of dicts) of reports with a running service.
+    '''
+    if isinstance(reports, pd.DataFrame):
+        columns = ['immediateActionsTaken', 'eventType', 'incidentDescription']
+        reports = reports[columns].astype(object).where(reports[columns].notnull(), None)
+        reports = reports.to_dict('records')
+    return request({'reports': reports}, **address)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve report scores on a local socket.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=default_port)
+    parser.add_argument('--unix-socket', default=None,
+                        help='listen on this unix socket instead of host and port')
+    parser.add_argument('--artifact', default=artifact_file)
+    parser.add_argument('--max-batch-size', type=int, default=1024)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    args = parser.parse_args()
+    if os.path.isfile(args.artifact):
+        sorter = ReportSorter.from_artifact(args.artifact)
+    else:
+        sorter = ReportSorter()
+    service = ScoringService(sorter, args.max_batch_size, args.max_wait_ms / 1000.0)
+    asyncio.run(service.serve_forever(args.host, args.port, args.unix_socket))
@@ -0,0 +1,315 @@
+import os
+import json
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import KDTree
+from svd_model import pipeline_version
+from scorer import description_coordinates
+from combined_store import combined_dir, iter_combined, store_signature
+from report_store import get_report_store
+
+'''
+When a reviewer opens a report, the reports nearest to it in the 4-d SVD space
+are the past reports most like it.  The index keeps the coordinates of every
+described report in a KDTree, saved next to the arrays it was built from (one
+directory per version of the pipeline, like the coordinate store):
+
+    index = get_similarity_index()
+    index.similar_to_seq(20469574, k=10, actions='Stop the Job')
+    index.similar_to_text('valve left open on the separator', operating_centers=['Arkoma'])
+
+Reports added after the tree was built go in a small buffer that is searched
+by brute force, and the tree is rebuilt once the buffer gets too big.  A
+report that is added again (because it was revised) replaces its old row.
+
+Filters on immediateActionsTaken and operatingCenter are applied to the
+tree's answers, asking the tree for more neighbours until enough pass.  When a
+filter leaves only a few reports, it is faster to measure the distance to each
+of them directly, so that's done instead.
+'''
+
+similar_dir = 'my_data/similar_reports'
+index_columns = ['seq', 'immediateActionsTaken', 'operatingCenter', 'incidentDescription']
+# rebuild the tree when the buffer is bigger than this fraction of it
+max_buffer_fraction = 0.1
+# below this many candidate reports, skip the tree and measure them all
+brute_force_rows = 100000
+
+
+def codes(values, names):
+    '''
+    Code each value by its position in names, adding names it hasn't seen.
+    Missing values get -1.
+    '''
+    values = pd.Series(values).astype(object)
+    known = values.notnull()
+    for name in pd.unique(values[known].astype(str)):
+        if name not in names:
+            names.append(name)
+    lookup = {name: i for i, name in enumerate(names)}
+    result = np.full(len(values), -1, dtype=np.int32)
+    result[known.values] = values[known].astype(str).map(lookup).values
+    return result
+
+def wanted_codes(wanted, names):
+    if isinstance(wanted, str):
+        wanted = [wanted]
+    return [names.index(name) for name in wanted if name in names]
+
+def report_rows(reports):
+    '''
+    What extend() needs for the described reports in a DataFrame with the
+    index_columns.
+    '''
+    reports = reports[reports.incidentDescription.notnull() & reports.seq.notnull()]
+    coordinates = description_coordinates(reports.incidentDescription.astype(str), reports.seq)
+    return (reports.seq.values, coordinates, reports.immediateActionsTaken.values,
+            reports.operatingCenter.values)
+
+
+class SimilarityIndex(object):
+
+    def __init__(self, directory=None):
+        '''
+        An empty index, or the one saved in directory.
+        '''
+        self.directory = directory
+        self.seqs = np.array([], dtype=np.int64)
+        self.coordinates = np.empty((0, 4))
+        self.actions = np.array([], dtype=np.int32)
+        self.centers = np.array([], dtype=np.int32)
+        self.alive = np.array([], dtype=bool)
+        self.action_names = []
+        self.center_names = []
+        self.source = None
+        self.tree = None
+        self.tree_size = 0
+        if directory is not None and os.path.isfile(self.path('meta.json')):
+            self.load()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def load(self):
+        with open(self.path('meta.json')) as f:
+            meta = json.load(f)
+        self.action_names = meta['action_names']
+        self.center_names = meta['center_names']
+        self.source = meta['source']
+        self.tree_size = meta['tree_size']
+        for name in ['seqs', 'coordinates', 'actions', 'centers', 'alive']:
+            setattr(self, name, np.load(self.path(name + '.npy')))
+        with open(self.path('tree.pkl'), 'rb') as f:
+            self.tree = pickle.load(f)
+
+    def save(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for name in ['seqs', 'coordinates', 'actions', 'centers', 'alive']:
+            np.save(self.path(name + '.npy'), getattr(self, name))
+        with open(self.path('tree.pkl'), 'wb') as f:
+            pickle.dump(self.tree, f)
+        # written last, so a half-saved index is never loaded as a whole one
+        with open(self.path('meta.json'), 'w') as f:
+            json.dump({'action_names': self.action_names,
+                       'center_names': self.center_names,
+                       'source': self.source,
+                       'tree_size': self.tree_size}, f)
+
+    def rebuild_tree(self):
+        '''
+        Drop the replaced rows and put every row in the tree.
+        '''
+        for name in ['seqs', 'coordinates', 'actions', 'centers']:
+            setattr(self, name, getattr(self, name)[self.alive])
+        self.alive = np.ones(len(self.seqs), dtype=bool)
+        self.tree = KDTree(self.coordinates) if len(self.coordinates) else None
+        self.tree_size = len(self.coordinates)
+
+    def extend(self, seqs, coordinates, actions, operating_centers):
+        '''
+        Add reports to the buffer, replacing any rows they already have.
+        '''
+        seqs = np.asarray(seqs, dtype=np.int64)
+        self.alive[np.isin(self.seqs, seqs)] = False
+        self.seqs = np.concatenate([self.seqs, seqs])
+        self.coordinates = np.concatenate([self.coordinates, coordinates])
+        self.actions = np.concatenate([self.actions, codes(actions, self.action_names)])
+        self.centers = np.concatenate([self.centers,
+                                       codes(operating_centers, self.center_names)])
+        self.alive = np.concatenate([self.alive, np.ones(len(seqs), dtype=bool)])
+        if len(self.seqs) - self.tree_size > max_buffer_fraction * max(self.tree_size, 1):
+            self.rebuild_tree()
+
+    def add_reports(self, reports):
+        '''
+        Add the described reports in a DataFrame with the index_columns.
+        '''
+        self.extend(*report_rows(reports))
+
+    def allowed(self, actions=None, operating_centers=None):
+        mask = self.alive.copy()
+        if actions is not None:
+            mask &= np.isin(self.actions, wanted_codes(actions, self.action_names))
+        if operating_centers is not None:
+            mask &= np.isin(self.centers, wanted_codes(operating_centers, self.center_names))
+        return mask
+
+    def row_of(self, seq):
+        rows = np.flatnonzero((self.seqs == seq) & self.alive)
+        if len(rows) == 0:
+            raise KeyError('report {} is not in the similarity index'.format(seq))
+        return rows[-1]
+
+    def nearest(self, point, k=10, actions=None, operating_centers=None, exclude_row=None):
+        '''
+        Rows and distances of the k allowed rows nearest to point, nearest first.
+        '''
+        mask = self.allowed(actions, operating_centers)
+        if exclude_row is not None:
+            mask[exclude_row] = False
+        n_allowed = int(mask.sum())
+        k = min(k, n_allowed)
+        if k == 0:
+            return np.array([], dtype=int), np.array([])
+        if n_allowed <= brute_force_rows or self.tree is None:
+            rows = np.flatnonzero(mask)
+        else:
+            rows = np.concatenate([self.tree_candidates(point, k, mask, n_allowed),
+                                   self.tree_size + np.flatnonzero(mask[self.tree_size:])])
+        distances = np.sqrt(((self.coordinates[rows] - point) ** 2).sum(axis=1))
+        nearest = np.argpartition(distances, k - 1)[:k] if k < len(rows) else np.arange(len(rows))
+        nearest = nearest[np.argsort(distances[nearest], kind='stable')]
+        return rows[nearest], distances[nearest]
+
+    def tree_candidates(self, point, k, mask, n_allowed):
+        '''
+        Tree rows that include the k nearest allowed ones, asking the tree for
+        more neighbours until enough of them pass the filters.
+        '''
+        in_tree = int(mask[:self.tree_size].sum())
+        if in_tree == 0:
+            return np.array([], dtype=int)
+        # about how many neighbours it takes to find k that pass, with some to spare
+        ask = min(self.tree_size, int(2 * k * self.tree_size / float(in_tree)) + k)
+        while True:
+            rows = self.tree.query(point.reshape(1, -1), k=ask, return_distance=False)[0]
+            rows = rows[mask[rows]]
+            if len(rows) >= min(k, in_tree) or ask == self.tree_size:
+                return rows
+            ask = min(self.tree_size, ask * 4)
+
+    def results(self, rows, distances, describe=False):
+        results = pd.DataFrame({
+            'seq': self.seqs[rows],
+            'distance': distances,
+            'immediateActionsTaken': [self.action_names[i] if i >= 0 else None
+                                      for i in self.actions[rows]],
+            'operatingCenter': [self.center_names[i] if i >= 0 else None
+                                for i in self.centers[rows]]})
+        if describe and len(results):
+            descriptions = get_report_store().get_many(results.seq).incidentDescription
+            results['incidentDescription'] = descriptions.reindex(results.seq).values
+        return results
+
+    def similar_to_seq(self, seq, k=10, actions=None, operating_centers=None, describe=False):
+        '''
+        The k reports nearest to report seq (not counting itself), as a
+        DataFrame of seq, distance, immediateActionsTaken and operatingCenter,
+        plus incidentDescription if describe is set.
+        '''
+        row = self.row_of(seq)
+        rows, distances = self.nearest(self.coordinates[row], k, actions, operating_centers,
+                                       exclude_row=row)
+        return self.results(rows, distances, describe)
+
+    def similar_to_text(self, description, k=10, actions=None, operating_centers=None,
+                        describe=False):
+        '''
+        The k reports nearest to a description that may not be a report yet.
+        The description isn't added to the coordinate store, so a query
+        doesn't write anything.
+        '''
+        point = description_coordinates([description], remember=False)[0]
+        rows, distances = self.nearest(point, k, actions, operating_centers)
+        return self.results(rows, distances, describe)
+
+
+def index_directory(directory=similar_dir):
+    return os.path.join(directory, pipeline_version())
+
+def build_similarity_index(source=combined_dir, directory=similar_dir):
+    '''
+    Index every described report in the combined store at source, and save it.
+    '''
+    index = SimilarityIndex()
+    index.directory = index_directory(directory)
+    months = [report_rows(month) for month in iter_combined(source, columns=index_columns)]
+    if months:
+        # one extend into the empty index, which builds the tree once
+        index.extend(*[np.concatenate(parts) for parts in zip(*months)])
+    index.source = store_signature(source)
+    index.save()
+    return index
+
+def index_signature(directory=similar_dir):
+    '''
+    The version of the combined store the saved index matches, or None.
+    '''
+    try:
+        with open(os.path.join(index_directory(directory), 'meta.json')) as f:
+            return json.load(f)['source']
+    except FileNotFoundError:
+        return None
+
+def update_similarity_index(reports, source=combined_dir, directory=similar_dir):
+    '''
+    Add new or revised reports to the saved index.  source should already hold them.
+    '''
+    index = get_similarity_index(source, directory, rebuild=False)
+    index.add_reports(reports)
+    index.source = store_signature(source)
+    index.save()
+    return index
+
+
+_indexes = {}
+
+def get_similarity_index(source=combined_dir, directory=similar_dir, rebuild=True):
+    '''
+    The index for the current pipeline, rebuilt first if it doesn't match the
+    combined reports at source (unless rebuild is False).
+    '''
+    path = index_directory(directory)
+    index = _indexes.get(path)
+    if index is None:
+        index = _indexes[path] = SimilarityIndex(path)
+    if rebuild and (index.tree is None or index.source != store_signature(source)):
+        index = _indexes[path] = build_similarity_index(source, directory)
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the reports most like a report.')
+    parser.add_argument('--seq', type=int, default=None)
+    parser.add_argument('--text', default=None)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--action', nargs='*', default=None, dest='actions')
+    parser.add_argument('--center', nargs='*', default=None, dest='operating_centers')
+    parser.add_argument('--rebuild', action='store_true')
+    args = parser.parse_args()
+    if args.rebuild:
+        build_similarity_index()
+    index = get_similarity_index()
+    pd.set_option('display.max_colwidth', 100)
+    if args.seq is not None:
+        print(index.similar_to_seq(args.seq, args.k, args.actions, args.operating_centers,
+                                   describe=True))
+    if args.text is not None:
+        print(index.similar_to_text(args.text, args.k, args.actions, args.operating_centers,
+                                    describe=True))
@@ -0,0 +1,137 @@
+import pickle
+import argparse
+from collections import deque
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+from svd_model import pipeline_file
+from combined_store import combined_dir, iter_combined
+
+'''
+The TfidfVectorizer + TruncatedSVD pipeline has to hold the whole corpus (and
+its vocabulary) in memory to be fitted.  This is a stand-in that can be fitted
+on the full history a chunk at a time:
+    * words are hashed into a fixed number of columns instead of looked up in a
+      fitted vocabulary
+    * the idf weights are counted up chunk by chunk
+    * the SVD is a randomized range finder: X^T X Q only needs the chunks one at
+      a time, so each power iteration is one pass over the descriptions
+
+Its transform takes descriptions to 4 dimensional coordinates just like the
+sklearn pipeline, so a ReportSorter can be fitted on it unchanged.
+'''
+
+class StreamingSVDPipeline(object):
+
+    def __init__(self, n_components=4, n_features=2**18, n_oversamples=10, n_iter=5,
+                 random_state=0):
+        self.n_components = n_components
+        self.n_features = n_features
+        self.n_oversamples = n_oversamples
+        self.n_iter = n_iter
+        self.random_state = random_state
+        self.vectorizer = HashingVectorizer(n_features=n_features, alternate_sign=False,
+                                            norm=None)
+
+    def counts(self, descriptions):
+        return self.vectorizer.transform(descriptions)
+
+    def tfidf(self, descriptions):
+        # same weighting as TfidfVectorizer's defaults: smoothed idf, then l2 norm
+        return normalize(self.counts(descriptions).multiply(self.idf_).tocsr())
+
+    def transform(self, descriptions):
+        return self.tfidf(descriptions) @ self.components_.T
+
+    def fit(self, chunks, n_jobs=1):
+        '''
+        chunks is a function that returns a fresh iterable of description chunks,
+        since fitting needs several passes over them.
+        '''
+        document_counts = np.zeros(self.n_features)
+        n_documents = 0
+        for counts in map_chunks(chunk_document_counts, chunks(), n_jobs, self):
+            document_counts += counts[0]
+            n_documents += counts[1]
+        self.idf_ = np.log((1 + n_documents) / (1 + document_counts)) + 1
+        rank = self.n_components + self.n_oversamples
+        Q = np.random.RandomState(self.random_state).normal(size=(self.n_features, rank))
+        for _ in range(self.n_iter + 1):
+            Y = sum(map_chunks(chunk_gram_product, chunks(), n_jobs, self, Q))
+            Q, _ = np.linalg.qr(Y)
+        B = sum(map_chunks(chunk_projected_gram, chunks(), n_jobs, self, Q))
+        eigenvalues, eigenvectors = np.linalg.eigh(B)
+        top = np.argsort(eigenvalues)[::-1][:self.n_components]
+        components = (Q @ eigenvectors[:, top]).T
+        # make the largest weight of each component positive, like TruncatedSVD does
+        signs = np.sign(components[np.arange(self.n_components),
+                                   np.abs(components).argmax(axis=1)])
+        self.components_ = components * signs[:, np.newaxis]
+        self.singular_values_ = np.sqrt(np.maximum(eigenvalues[top], 0))
+        return self
+
+
+def chunk_document_counts(pipe, descriptions):
+    counts = pipe.counts(descriptions)
+    return (np.bincount(counts.indices, minlength=pipe.n_features), counts.shape[0])
+
+def chunk_gram_product(pipe, descriptions, Q):
+    X = pipe.tfidf(descriptions)
+    return X.T @ (X @ Q)
+
+def chunk_projected_gram(pipe, descriptions, Q):
+    XQ = pipe.tfidf(descriptions) @ Q
+    return XQ.T @ XQ
+
+def run_chunk(task):
+    function, pipe, descriptions, args = task
+    return function(pipe, descriptions, *args)
+
+def map_chunks(function, chunks, n_jobs, pipe, *args):
+    tasks = ((function, pipe, list(descriptions), args) for descriptions in chunks)
+    if n_jobs == 1:
+        for task in tasks:
+            yield run_chunk(task)
+        return
+    # only keep a couple of chunks per worker in flight, so memory stays bounded
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(run_chunk, task))
+            if len(pending) >= 2 * n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def description_chunks(path=combined_dir, chunksize=100000):
+    '''
+    The descriptions get_pipeline fits on, read a month at a time and handed
+    out at most chunksize at a time.
+    '''
+    def chunks():
+        for month in iter_combined(path, columns=['immediateActionsTaken', 'incidentDescription']):
+            month = month.dropna(subset=['immediateActionsTaken', 'incidentDescription'])
+            descriptions = month.incidentDescription.astype(str).values
+            for start in range(0, len(descriptions), chunksize):
+                yield descriptions[start:start + chunksize]
+    return chunks
+
+def fit_streaming_pipeline(path=combined_dir, chunksize=100000, n_jobs=1,
+                           **params):
+    return StreamingSVDPipeline(**params).fit(description_chunks(path, chunksize), n_jobs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit the SVD pipeline a chunk at a time.')
+    parser.add_argument('--chunksize', type=int, default=100000)
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--output', default=pipeline_file)
+    args = parser.parse_args()
+    # run as a script this module is __main__, which the pickle would name as the
+    # class's home; fit through the importable module so the consumers can load it
+    import streaming_svd
+    pipe = streaming_svd.fit_streaming_pipeline(chunksize=args.chunksize, n_jobs=args.n_jobs)
+    with open(args.output, 'wb') as f:
+        pickle.dump(pipe, f)
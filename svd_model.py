@@ -0,0 +1,157 @@
+import os
+import re
+import json
+import hashlib
+import pickle
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+
+pipeline_file = 'SVD_pipe.pkl'
+
+'''
+Unpickling the SVD pipeline is slow, and scorer, plots and make_data_numerical
+all need it, so it is loaded once per process and shared.  A cached pipeline is
+reused until the file on disk changes: a new size or modification time makes
+us hash the file again, and it is only reloaded if the contents differ.
+'''
+_pipelines = {}
+
+def file_signature(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def file_hash(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def _cached_entry(path):
+    signature = file_signature(path)
+    entry = _pipelines.get(path)
+    if entry is not None and entry['signature'] == signature:
+        return entry
+    version = file_hash(path)
+    if entry is not None and entry['version'] == version:
+        entry['signature'] = signature
+        return entry
+    with open(path, 'rb') as f:
+        entry = {'signature': signature, 'version': version, 'pipeline': pickle.load(f)}
+    _pipelines[path] = entry
+    return entry
+
+def load_pipeline(path=pipeline_file):
+    return _cached_entry(path)['pipeline']
+
+def pipeline_version(path=pipeline_file):
+    '''
+    A hash of the pickled pipeline, for anything cached from its output.
+    '''
+    return _cached_entry(path)['version']
+
+def clear_cache():
+    _pipelines.clear()
+
+
+'''
+COMPACT MODEL
+
+Most of the time spent unpickling the pipeline goes into rebuilding the
+TfidfVectorizer's vocabulary dictionary.  The compact model saves what the
+transform actually needs as flat .npy arrays (the sorted vocabulary and its
+column numbers, the idf weights and the SVD components) which are opened
+memory-mapped, so loading takes milliseconds and worker processes share the
+pages.  CompactSVDTransformer repeats the pipeline's transform step by step:
+lowercase, tokenize, count, weight by idf, l2 normalize, project.
+'''
+compact_model_dir = 'SVD_pipe'
+
+def export_compact_model(pipe, directory=compact_model_dir, version=None):
+    tfidf = pipe.named_steps['tfidf']
+    decomp = pipe.named_steps['decomp']
+    supported = (tfidf.analyzer == 'word' and tfidf.ngram_range == (1, 1) and tfidf.lowercase
+                 and tfidf.stop_words is None and tfidf.strip_accents is None
+                 and tfidf.preprocessor is None and tfidf.tokenizer is None
+                 and tfidf.norm == 'l2' and tfidf.use_idf and not tfidf.sublinear_tf)
+    if not supported:
+        raise ValueError('the compact model only supports the default TfidfVectorizer settings')
+    terms = sorted(tfidf.vocabulary_)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    np.save(os.path.join(directory, 'vocabulary.npy'), np.array(terms))
+    np.save(os.path.join(directory, 'columns.npy'),
+            np.array([tfidf.vocabulary_[term] for term in terms], dtype=np.int64))
+    np.save(os.path.join(directory, 'idf.npy'), tfidf.idf_)
+    np.save(os.path.join(directory, 'components.npy'), decomp.components_)
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump({'version': version,
+                   'token_pattern': tfidf.token_pattern,
+                   'n_features': len(terms)}, f)
+
+
+class CompactSVDTransformer(object):
+
+    def __init__(self, directory=compact_model_dir):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        self.version = meta['version']
+        self.n_features = meta['n_features']
+        self.token_pattern = re.compile(meta['token_pattern'])
+        self.vocabulary = np.load(os.path.join(directory, 'vocabulary.npy'), mmap_mode='r')
+        self.columns = np.load(os.path.join(directory, 'columns.npy'), mmap_mode='r')
+        self.idf = np.load(os.path.join(directory, 'idf.npy'), mmap_mode='r')
+        self.components = np.load(os.path.join(directory, 'components.npy'), mmap_mode='r')
+
+    def counts(self, descriptions):
+        documents = [self.token_pattern.findall(text.lower()) for text in descriptions]
+        lengths = [len(tokens) for tokens in documents]
+        tokens = np.array([token for document in documents for token in document], dtype=str)
+        counts = sparse.csr_matrix((len(documents), self.n_features))
+        if len(tokens) == 0:
+            return counts
+        positions = np.searchsorted(self.vocabulary, tokens)
+        positions[positions == len(self.vocabulary)] = 0
+        known = self.vocabulary[positions] == tokens
+        rows = np.repeat(np.arange(len(documents)), lengths)[known]
+        columns = self.columns[positions[known]]
+        counts = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)),
+                                   shape=(len(documents), self.n_features))
+        counts.sum_duplicates()
+        counts.sort_indices()
+        return counts
+
+    def transform(self, descriptions):
+        X = self.counts(descriptions) @ sparse.diags(np.asarray(self.idf))
+        return normalize(X) @ np.asarray(self.components).T
+
+
+_transformers = {}
+
+def load_transformer(path=pipeline_file, directory=compact_model_dir):
+    '''
+    Something with a transform method that matches the pipeline saved at path:
+    the compact model if it was exported from that version of the pipeline
+    (exporting it first if need be), otherwise the pipeline itself.
+    '''
+    version = pipeline_version(path)
+    transformer = _transformers.get(directory)
+    if transformer is not None and transformer.version == version:
+        return transformer
+    meta_file = os.path.join(directory, 'meta.json')
+    if os.path.isfile(meta_file):
+        transformer = CompactSVDTransformer(directory)
+    if transformer is None or transformer.version != version:
+        pipe = load_pipeline(path)
+        if not hasattr(pipe, 'named_steps'):
+            return pipe
+        export_compact_model(pipe, directory, version)
+        transformer = CompactSVDTransformer(directory)
+    _transformers[directory] = transformer
+    return transformer
+
+
+if __name__ == '__main__':
+    export_compact_model(load_pipeline(), version=pipeline_version())
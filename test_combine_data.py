@@ -0,0 +1,125 @@
+from functools import reduce
+import numpy as np
+import pandas as pd
+from combine_data import get_id, old_assetType, combined_comments, write_combined_data,\
+                         update_combined_data, stream_replicate_groups
+from make_data_numerical import build_feature_schema
+from combined_store import read_combined
+import report_store
+from load_original_data import new_app_file, new_app_columns
+from benchmark import generate_exports, generate_new_reports
+
+'''
+The vectorized derivations in combine_data should give exactly what the
+original row-by-row versions (copied below) gave, and an incremental update
+should leave the store just as a full combine would have.
+'''
+
+def original_get_id(row):
+    if not pd.isnull(row.locationWellSite):
+        return row.locationWellSite
+    if not pd.isnull(row.assetId):
+        return row.assetId
+    return np.nan
+
+def original_well_or_fac(id_string):
+    if id_string == 'Other':
+        return "Other"
+    if 'PAD' in str(id_string):
+        return "Well"
+    if 'CDP' in str(id_string):
+        return "Well"
+    if 'FAC' in str(id_string):
+        return "Facility"
+    len_dict = {16: "Well",
+                38: "Well",
+                10: "Facility",
+                17: "Facility",
+                18: "Facility",
+                19: "Other"}
+    if pd.isnull(id_string):
+        return np.nan
+    if len(id_string) in len_dict:
+        return len_dict[len(id_string)]
+    return "Well"
+
+def original_combined_comments(old_reports):
+    key_words = ['other', 'description', 'detail', 'comment', 'notlisted']
+    free_text_cols = [col for col in old_reports.columns for word in key_words\
+                      if word in col.lower()]
+    comments = old_reports[free_text_cols].fillna('')
+    return comments.apply(lambda row: reduce(lambda x, y: x + ' ' + str(y), row), axis=1)
+
+
+def sample_ids():
+    location_ids = ['Other', 'XPADX0001', 'CDP-17', 'FAC-22', 'A' * 16, 'A' * 38,
+                    'A' * 10, 'A' * 17, 'A' * 18, 'A' * 19, 'A' * 5, np.nan, np.nan,
+                    np.nan, 'FAC PAD']
+    asset_ids = [np.nan, np.nan, np.nan, np.nan, 'B' * 10, np.nan, np.nan, np.nan,
+                 np.nan, np.nan, np.nan, 'Other', 'C' * 17, np.nan, np.nan]
+    return pd.DataFrame({'locationWellSite': location_ids, 'assetId': asset_ids},
+                        index=range(100, 100 + len(location_ids)))
+
+def test_get_id():
+    reports = sample_ids()
+    expected = reports.apply(original_get_id, axis=1)
+    pd.testing.assert_series_equal(get_id(reports), expected, check_names=False)
+
+def test_old_assetType():
+    reports = sample_ids()
+    expected = reports.apply(lambda row: original_well_or_fac(original_get_id(row)), axis=1)
+    result = old_assetType(reports)
+    pd.testing.assert_index_equal(result.index, expected.index)
+    assert [None if pd.isnull(label) else label for label in result] == \
+        [None if pd.isnull(label) else label for label in expected]
+
+def test_combined_comments():
+    reports = pd.DataFrame({
+        'eventDescription': ['valve left open', np.nan, 'spill', np.nan],
+        'seq': [1, 2, 3, 4],
+        'furtherActionNecessaryComments': [np.nan, 'call vendor', 'tank 3', np.nan],
+        'jobGroupOther': ['', 'rig move', np.nan, np.nan],
+        'verificationAtmosphericMonitoringGapNotListedComment': [np.nan, np.nan, 'no gas', np.nan],
+        'estimatedValue': [10, 20, 30, 40]})
+    expected = original_combined_comments(reports)
+    pd.testing.assert_series_equal(combined_comments(reports), expected, check_names=False)
+
+def append_new_reports(size, first_seq, seed=1):
+    reports = generate_new_reports(size, np.random.RandomState(seed), first_seq)
+    # without locations they can't move a centroid, so the update stays incremental
+    for col in ['latitude', 'longitude']:
+        reports[new_app_columns.index(col)] = None
+    reports.to_csv(new_app_file, header=False, index=False, mode='a')
+
+def test_update_keeps_seq_an_integer(tmp_path, monkeypatch):
+    generate_exports(str(tmp_path), 500)
+    monkeypatch.chdir(tmp_path)
+    write_combined_data()
+    append_new_reports(20, first_seq=10000)
+    assert update_combined_data() == 20
+    reports = read_combined()
+    assert reports.seq.dtype == np.int64
+    assert len(reports) == 520 and reports.seq.is_unique
+    assert set(range(10000, 10020)) <= set(reports.seq)
+
+def test_update_keeps_the_report_store_in_step(tmp_path, monkeypatch):
+    generate_exports(str(tmp_path), 500)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(report_store, '_stores', {})
+    write_combined_data()
+    report_store.get_report_store()
+    append_new_reports(20, first_seq=10000)
+    update_combined_data()
+    store = report_store.get_report_store()
+    dates = store.query('seq', [0, 10000]).serverCreatedDate
+    # the upserted report's date is written the same way as the rest
+    assert len(dates) == 2 and not dates.str.contains('T').any()
+    assert store.get(10010) is not None
+
+def test_streamed_replicate_groups_match_the_combined_data(tmp_path, monkeypatch):
+    generate_exports(str(tmp_path), 500)
+    monkeypatch.chdir(tmp_path)
+    write_combined_data()
+    combined = build_feature_schema(read_combined(columns=['replicateGroup']))
+    streamed = build_feature_schema(stream_replicate_groups(chunksize=100))
+    assert streamed['replicateGroup'] == combined['replicateGroup']
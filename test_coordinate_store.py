@@ -0,0 +1,65 @@
+import os
+import numpy as np
+import coordinate_store
+from coordinate_store import CoordinateStore
+from conftest import LengthPipeline
+
+'''
+The coordinate store should give the pipeline's coordinates whether they come
+from the .npy files, the delta files or a new generation, and a store opened
+again should see everything the last one saved.
+'''
+
+class CountingPipeline(LengthPipeline):
+
+    def __init__(self):
+        self.transformed = 0
+
+    def transform(self, descriptions):
+        self.transformed += len(descriptions)
+        return LengthPipeline.transform(self, descriptions)
+
+def open_store(directory, pipeline=None):
+    return CoordinateStore(pipeline=pipeline or CountingPipeline(), directory=str(directory),
+                           version='test')
+
+def test_each_text_is_transformed_once(tmp_path):
+    store = open_store(tmp_path)
+    texts = ['a', 'bb', 'a', '[]', 'bb']
+    expected = LengthPipeline().transform(texts)
+    np.testing.assert_array_equal(store.transform(texts), expected)
+    np.testing.assert_array_equal(store.transform(texts), expected)
+    assert store.pipeline.transformed == 3
+    reopened = open_store(tmp_path)
+    np.testing.assert_array_equal(reopened.transform(texts), expected)
+    assert reopened.pipeline.transformed == 0
+
+def test_delta_is_appended_then_merged(tmp_path, monkeypatch):
+    monkeypatch.setattr(coordinate_store, 'min_merge_rows', 5)
+    store = open_store(tmp_path)
+    store.transform(['x' * n for n in range(1, 21)], seqs=range(20))
+    generation = store.current_generation()
+    # a few new texts only go to the delta files
+    store.transform(['y', 'yy'], seqs=[0, 100])
+    assert store.current_generation() == generation
+    assert os.path.getsize(store.path('added.bin')) == 2 * coordinate_store.added_dtype.itemsize
+    reopened = open_store(tmp_path)
+    assert reopened.delta_size() == 4
+    np.testing.assert_array_equal(reopened.coordinates_for_seqs([0, 1, 100, 7]),
+                                  LengthPipeline().transform(['y', 'xx', 'yy', 'x' * 8]))
+    # until there are enough of them to merge into a new generation
+    reopened.transform(['z' * n for n in range(1, 6)], seqs=range(200, 205))
+    assert reopened.current_generation() != generation
+    assert reopened.delta_size() == 0
+    assert not os.path.isdir(os.path.join(reopened.root, generation))
+    np.testing.assert_array_equal(open_store(tmp_path).coordinates_for_seqs([0, 204, 999])[:2],
+                                  LengthPipeline().transform(['y', 'zzzzz']))
+    assert np.isnan(open_store(tmp_path).coordinates_for_seqs([999])).all()
+
+def test_queries_are_not_remembered(tmp_path):
+    store = open_store(tmp_path)
+    store.transform(['kept'], seqs=[1])
+    store.transform(['one-off'], remember=False)
+    reopened = open_store(tmp_path)
+    assert reopened.lookup(coordinate_store.hash_texts(['one-off']))[1].tolist() == [False]
+    assert reopened.lookup(coordinate_store.hash_texts(['kept']))[1].tolist() == [True]
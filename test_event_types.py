@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+from event_types import event_type_mask, count_types, popcount, meaningful_types
+
+'''
+count_types on the eventTypeMask should count what the original text scan
+counted, and come back signed so it can be negated for a descending sort.
+'''
+
+def original_count(event_type):
+    return sum([typ in event_type for typ in set(meaningful_types)])
+
+def test_count_types_matches_the_text_scan():
+    event_types = pd.Series(['[]', "['Near Miss']", "['Hazard Identification']",
+                             "['Near Miss', 'Property Damage', 'Security']",
+                             "['Fire/Explosion', 'Injury/Illness', 'Material Release', "
+                             "'Near Miss', 'Property Damage', 'Security', 'Verification']"])
+    expected = event_types.apply(original_count).tolist()
+    assert count_types(event_type_mask(event_types)).tolist() == expected
+
+def test_counts_are_signed():
+    counts = popcount(np.array([0, 1, 0xffff], dtype=np.uint16))
+    assert counts.dtype.kind == 'i'
+    assert (-counts).tolist() == [0, -1, -16]
+    assert np.argsort(-count_types(event_type_mask(pd.Series(['[]', "['Near Miss']"])))).tolist() == [1, 0]
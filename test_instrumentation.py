@@ -0,0 +1,38 @@
+import os
+import tracemalloc
+import pytest
+import instrumentation
+
+'''
+Stages nest and records are passed between processes, and neither should
+lose or double count anything.
+'''
+
+@pytest.fixture
+def tracing(monkeypatch):
+    monkeypatch.setattr(instrumentation, '_records', [])
+    monkeypatch.setattr(instrumentation, '_stack', [])
+    monkeypatch.setattr(instrumentation, '_trace_memory', False)
+    instrumentation.enable(trace_memory=True)
+    yield
+    instrumentation.disable()
+    tracemalloc.stop()
+
+def test_drain_leaves_other_processes_records(tracing):
+    worker_records = [{'name': 'worker', 'pid': os.getpid() + 1}] * 3
+    instrumentation.extend(worker_records)
+    with instrumentation.stage('parent'):
+        pass
+    taken = instrumentation.drain()
+    assert [record['name'] for record in taken] == ['parent']
+    assert instrumentation.records() == worker_records
+
+def test_outer_peak_includes_inner_peaks(tracing):
+    with instrumentation.stage('outer'):
+        with instrumentation.stage('inner'):
+            block = bytearray(10 ** 7)
+            del block
+    inner, outer = instrumentation.records()
+    assert inner['parent'] == 'outer'
+    assert inner['peak_memory_bytes'] >= 10 ** 7
+    assert outer['peak_memory_bytes'] >= inner['peak_memory_bytes']
@@ -0,0 +1,20 @@
+import numpy as np
+import pandas as pd
+import pytest
+from load_original_data import uniform_text
+
+'''
+Whatever path an export is read by, its columns of mixed numbers and text
+should come out as text that parquet can store.
+'''
+
+@pytest.mark.filterwarnings('error')
+def test_uniform_text_on_a_slice():
+    reports = pd.DataFrame([[1, 'a', 2.5, 'x'], [np.nan, 3, 4.5, 'y']],
+                           columns=['seq', 'answerNumber', 'latitude', 'answerNumber'])
+    # read_export drops the duplicated columns with a slice like this one
+    reports = reports.loc[:, ~reports.columns.duplicated()]
+    result = uniform_text(reports)
+    assert result.answerNumber.tolist() == ['a', '3']
+    assert result.seq.dtype == np.float64 and result.latitude.dtype == np.float64
+    assert result.seq.isnull().tolist() == [False, True]
@@ -0,0 +1,41 @@
+import numpy as np
+from review_queue import ReviewQueue
+
+'''
+The review queue should hand out reports in the same order as
+ReportSorter.top_k, however the reports were pushed, moved and removed.
+'''
+
+def test_queue_matches_top_k(sorter, reports):
+    queue = ReviewQueue()
+    queue.add_reports(reports, sorter)
+    expected = reports.seq.values[sorter.review_order(reports)].tolist()
+    assert queue.top(len(reports)) == expected
+    for k in [1, 10, 50]:
+        assert queue.top(k) == sorter.top_k(reports, k).index.tolist() == expected[:k]
+
+def test_requeued_reports_keep_only_their_newest_key():
+    queue = ReviewQueue()
+    queue.push(1, 0, 0, 1.0)
+    queue.push(2, 0, 0, 2.0)
+    queue.push(1, 0, 0, 3.0)
+    # back to the key it had first; the first entry must not count twice
+    queue.push(1, 0, 0, 1.0)
+    queue.remove(2)
+    assert queue.top(5) == [1]
+    queue.push(1, 3, 0, 5.0)
+    assert queue.pop(5) == [1]
+    assert len(queue) == 0 and queue.top(5) == []
+
+def test_removed_reports_stay_removed():
+    queue = ReviewQueue()
+    for seq in range(200):
+        queue.push(seq, seq % 4, seq % 3, float(seq))
+    for seq in range(0, 200, 2):
+        queue.remove(seq)
+    for seq in range(1, 200, 4):
+        queue.push(seq, 0, 0, 0.0)
+    remaining = [(-(seq % 4), -(seq % 3), float(seq), seq) for seq in range(3, 200, 4)]
+    remaining += [(0, 0, 0.0, seq) for seq in range(1, 200, 4)]
+    assert queue.top(500) == [seq for *_, seq in sorted(remaining)]
+    assert np.all([seq % 2 == 1 for seq in queue.pop(100)])
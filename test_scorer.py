@@ -0,0 +1,22 @@
+import pandas as pd
+
+'''
+ReportSorter.top_k should always give the first k rows of sort_reports, and
+both should put the reports with more meaningful event types first, like the
+original sort_values(['flag_number', 'typeCount', 'score'],
+ascending=[False, False, True]) did.
+'''
+
+def test_more_event_types_rank_first(sorter):
+    reports = pd.DataFrame({'seq': [1, 2],
+                            'immediateActionsTaken': ['No Action Necessary'] * 2,
+                            'eventType': ['[]', "['Near Miss']"],
+                            'incidentDescription': ['valve left open'] * 2})
+    assert sorter.sort_reports(reports).index.tolist() == [1, 0]
+    assert sorter.top_k(reports, 1).index.tolist() == [1]
+    assert sorter.rank(reports).tolist() == [1, 0]
+
+def test_top_k_is_a_prefix_of_sort_reports(sorter, reports):
+    ordered = sorter.sort_reports(reports)
+    for k in [0, 1, 2, 5, 10, 50, 100, len(ordered), len(reports) + 10]:
+        pd.testing.assert_frame_equal(sorter.top_k(reports, k), ordered.head(k))
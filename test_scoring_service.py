@@ -0,0 +1,64 @@
+import json
+import asyncio
+import numpy as np
+import pandas as pd
+from scoring_service import ScoringService
+
+'''
+Requests scored together in a batch should get the scores the sorter gives
+them on their own, and a client that gives up shouldn't take the batcher
+down with it.
+'''
+
+records = [{'immediateActionsTaken': 'No Action Necessary', 'eventType': '[]',
+            'incidentDescription': 'valve left open'},
+           {'immediateActionsTaken': 'No Action Necessary', 'eventType': "['Near Miss']",
+            'incidentDescription': 'valve left open'},
+           {'immediateActionsTaken': 'Stop the Job', 'eventType': None,
+            'incidentDescription': 'dropped object'},
+           {'immediateActionsTaken': None, 'eventType': '[]',
+            'incidentDescription': 'no hard hat'}]
+
+def expected_scores(sorter, reports):
+    return sorter.score(pd.DataFrame.from_records(reports)).tolist()
+
+def test_batched_requests(sorter, tmp_path):
+    async def run():
+        service = ScoringService(sorter, max_wait=0.05)
+        server = await service.start(unix_socket=str(tmp_path / 'service.sock'))
+        responses = await asyncio.gather(*[service.handle_message({'report': record})
+                                           for record in records],
+                                         service.handle_message({'reports': records}))
+        stats = await service.handle_message({'stats': True})
+        server.close()
+        service.batcher.cancel()
+        return responses, stats
+    responses, stats = asyncio.run(run())
+    together = responses[-1]
+    assert together['priority'] == [2, 1, 0, 3]
+    assert together['typeCounts'] == [0, 1, 0, 0]
+    assert together['flag_numbers'] == [0, 0, 3, None]
+    scores = [np.nan if score is None else score for score in together['scores']]
+    np.testing.assert_allclose(scores, expected_scores(sorter, records))
+    for record, response in zip(records, responses):
+        assert response['scores'] == [together['scores'][records.index(record)]]
+    # the five requests were scored in fewer batches than that
+    assert stats['requests'] == 5 and stats['reports'] == 8 and stats['batches'] < 5
+
+def test_cancelled_requests_dont_stop_the_batcher(sorter, tmp_path):
+    async def run():
+        service = ScoringService(sorter, max_wait=0.05)
+        server = await service.start(unix_socket=str(tmp_path / 'service.sock'))
+        abandoned = asyncio.ensure_future(service.handle_message({'reports': records}))
+        await asyncio.sleep(0.01)
+        abandoned.cancel()
+        reader, writer = await asyncio.open_unix_connection(str(tmp_path / 'service.sock'))
+        writer.write(json.dumps({'report': records[1]}).encode('utf-8') + b'\n')
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        writer.close()
+        server.close()
+        service.batcher.cancel()
+        return response
+    response = asyncio.run(run())
+    assert response['priority'] == [0] and response['typeCounts'] == [1]